@@ -0,0 +1,228 @@
+# autocomplete_service.py - asyncio HTTP-сервис автодополнения поверх ElasticsearchSearchEngine
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Tuple, Optional
+from urllib.parse import urlsplit, parse_qs
+import json
+import logging
+import time
+import weakref
+
+from search_engine import ElasticsearchSearchEngine, HTTP_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8080
+DEFAULT_TOP_K = 10
+MAX_TOP_K = 50
+# Дедлайн на один запрос автодополнения: после него клиент получает 504, а не ждёт OpenSearch
+DEFAULT_DEADLINE_MS = 300.0
+# Сколько ждём заголовки запроса от клиента
+READ_TIMEOUT_S = 5.0
+# Тело запроса (сервис отвечает только на GET) до этого размера вычитывается и отбрасывается,
+# чтобы не разбирать его как следующий запрос keep-alive; более длинное - соединение закрывается
+MAX_DISCARDED_BODY_BYTES = 64 * 1024
+
+_STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 409: "Conflict", 504: "Gateway Timeout"}
+
+
+class _InFlight:
+    """Общий запрос к OpenSearch для одного (скорректированный префикс, top_k) и число его ожидающих."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class AutocompleteService:
+    """
+    Обработчик автодополнения:
+      * одинаковые одновременные префиксы (после correct(), т.е. apply_corrections и остальных
+        стадий переписывания) ждут один общий запрос к OpenSearch;
+      * у каждого запроса свой дедлайн (deadline_ms), по истечении - 504;
+      * новый запрос из той же сессии (параметр session) отменяет ожидание предыдущего - устаревшее
+        нажатие получает 409 и не держит соединение. Если у общего запроса не осталось ожидающих,
+        он отменяется, пока ещё стоит в очереди пула.
+    Сам поиск выполняется движком в пуле потоков размера pool_size: у движка свой пул keep-alive
+    соединений того же размера, так что пул потоков - это и есть пул клиента к OpenSearch.
+    """
+
+    def __init__(self, search_engine: ElasticsearchSearchEngine, pool_size: int = HTTP_POOL_SIZE,
+                 deadline_ms: float = DEFAULT_DEADLINE_MS):
+        self.search_engine = search_engine
+        self.deadline_ms = deadline_ms
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="autocomplete")
+        self._in_flight: Dict[Tuple[str, int], _InFlight] = {}
+        self._sessions: Dict[str, asyncio.Task] = {}
+        # Задачи, отменённые более новым нажатием из той же сессии (любая другая отмена пробрасывается)
+        self._superseded: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+        self.stats = {"requests": 0, "backend_requests": 0, "coalesced": 0, "superseded": 0, "deadline_exceeded": 0}
+
+    async def _backend_search(self, prefix: str, top_k: int, correction: Tuple[str, bool]):
+        loop = asyncio.get_running_loop()
+        # Дедлайн передаётся и движку, чтобы поток пула не ждал OpenSearch дольше клиента;
+        # correction уже посчитан для ключа объединения - движок его не повторяет
+        return await loop.run_in_executor(self._executor, partial(self.search_engine.search, prefix, top_k,
+                                                                  deadline_ms=self.deadline_ms,
+                                                                  correction=correction))
+
+    def _forget(self, key: Tuple[str, int], entry: _InFlight):
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+
+    async def _coalesced_search(self, prefix: str, top_k: int):
+        """Присоединяется к уже идущему запросу с тем же ключом или запускает новый."""
+        correction = self.search_engine.correct(prefix)
+        key = (correction[0], top_k)
+        entry = self._in_flight.get(key)
+        if entry is None:
+            entry = _InFlight(asyncio.create_task(self._backend_search(prefix, top_k, correction)))
+            entry.task.add_done_callback(lambda _, key=key, entry=entry: self._forget(key, entry))
+            self._in_flight[key] = entry
+            self.stats["backend_requests"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        entry.waiters += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять запрос для остальных
+            return await asyncio.shield(entry.task)
+        finally:
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                self._forget(key, entry)
+                entry.task.cancel()
+
+    async def autocomplete(self, prefix: str, top_k: int = DEFAULT_TOP_K,
+                           session_id: Optional[str] = None) -> Tuple[int, Dict]:
+        """Возвращает (HTTP-статус, тело ответа) для одного нажатия."""
+        self.stats["requests"] += 1
+        start_time = time.perf_counter()
+        current = asyncio.current_task()
+        if session_id:
+            previous = self._sessions.get(session_id)
+            if previous is not None and not previous.done():
+                self._superseded.add(previous)
+                previous.cancel()
+            self._sessions[session_id] = current
+        try:
+            products = await asyncio.wait_for(self._coalesced_search(prefix, top_k), self.deadline_ms / 1000)
+            status, body = 200, {"prefix": prefix, "results": products,
+                                 "status": getattr(products, "status", "full")}
+        except asyncio.TimeoutError:
+            self.stats["deadline_exceeded"] += 1
+            status, body = 504, {"prefix": prefix, "error": "deadline exceeded"}
+        except asyncio.CancelledError:
+            superseded = current in self._superseded
+            self._superseded.discard(current)
+            # Отмена остановкой сервера (в том числе одновременно с новым нажатием) не превращается в 409
+            if not superseded or current.uncancel() > 0:
+                raise
+            self.stats["superseded"] += 1
+            status, body = 409, {"prefix": prefix, "error": "superseded"}
+        finally:
+            if session_id and self._sessions.get(session_id) is current:
+                del self._sessions[session_id]
+        body["took_ms"] = round((time.perf_counter() - start_time) * 1000, 3)
+        return status, body
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP/1.1 с keep-alive: GET /autocomplete?q=<префикс>&top_k=<n>&session=<id>, GET /stats."""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT_S)
+                    if not request_line:
+                        break
+                    headers = {}
+                    while True:
+                        line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT_S)
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    content_length = headers.get("content-length", "0")
+                    if "transfer-encoding" in headers or not content_length.isdigit() \
+                            or int(content_length) > MAX_DISCARDED_BODY_BYTES:
+                        keep_alive = False
+                    elif int(content_length):
+                        await asyncio.wait_for(reader.readexactly(int(content_length)), READ_TIMEOUT_S)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                status, body = await self._dispatch(request_line.decode('latin-1'))
+                payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} {_STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request_line: str) -> Tuple[int, Dict]:
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != "GET":
+            return 400, {"error": "bad request"}
+        url = urlsplit(parts[1])
+        if url.path == "/stats":
+            return 200, dict(self.stats, in_flight=len(self._in_flight))
+        if url.path != "/autocomplete":
+            return 404, {"error": "not found"}
+        params = parse_qs(url.query)
+        prefix = params.get("q", [""])[0]
+        try:
+            top_k = min(int(params.get("top_k", [DEFAULT_TOP_K])[0]), MAX_TOP_K)
+        except ValueError:
+            return 400, {"error": "top_k must be an integer"}
+        if not prefix.strip() or top_k <= 0:
+            return 200, {"prefix": prefix, "results": []}
+        return await self.autocomplete(prefix, top_k, params.get("session", [None])[0])
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"Сервис автодополнения слушает http://{host}:{port}/autocomplete?q=...")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from result_cache import PrefixResultCache
+
+    parser = argparse.ArgumentParser(description="asyncio HTTP-сервис автодополнения поверх OpenSearch")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--pool-size", type=int, default=HTTP_POOL_SIZE,
+                        help="Размер пула соединений/потоков к OpenSearch")
+    parser.add_argument("--deadline-ms", type=float, default=DEFAULT_DEADLINE_MS, help="Дедлайн одного запроса")
+    parser.add_argument("--cache", action="store_true", help="Кэшировать результаты префиксов (LRU + TTL)")
+    parser.add_argument("--prefix-table", default="",
+                        help="Файл таблицы коротких префиксов (setup_elasticsearch.py --build-prefix-table)")
+    args = parser.parse_args()
+
+    short_prefix_table = None
+    if args.prefix_table:
+        from short_prefix_table import ShortPrefixTable
+        short_prefix_table = ShortPrefixTable(args.prefix_table)
+    # Таблица передаётся в конструктор: только тогда движок запускает фоновую проверку версии каталога
+    search_engine = ElasticsearchSearchEngine(pool_size=args.pool_size,
+                                              cache=PrefixResultCache() if args.cache else None,
+                                              short_prefix_table=short_prefix_table)
+    service = AutocompleteService(search_engine, pool_size=args.pool_size, deadline_ms=args.deadline_ms)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        logger.info(f"Сервис остановлен: {service.stats}")
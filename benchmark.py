@@ -0,0 +1,299 @@
+# benchmark.py - нагрузочный бенчмарк задержки для любого движка с методом search()
+
+import csv
+import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_WARMUP_ITERATIONS = 1 # Сколько раз прогнать весь набор запросов до замеров
+PERCENTILES = (50, 90, 99)
+
+
+def load_queries(queries_csv_path: str, keystrokes: bool = False) -> List[str]:
+    """
+    Читает запросы из CSV (колонка query).
+    keystrokes=True разворачивает каждый запрос в последовательность нажатий:
+    "йог" -> "й", "йо", "йог" (так выглядит реальный трафик автокомплита).
+    """
+    with open(queries_csv_path, 'r', encoding='utf-8') as f:
+        queries = [row['query'] for row in csv.DictReader(f)]
+    if not keystrokes:
+        return queries
+    expanded = []
+    for query in queries:
+        expanded.extend(query[:length] for length in range(1, len(query) + 1) if query[:length].strip())
+    return expanded
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Перцентиль по ближайшему рангу для уже отсортированного списка."""
+    if not sorted_values:
+        return 0.0
+    # Ближайший ранг: ceil(p * n) - 1 (round() здесь не подходит - банковское округление)
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def _timed_call(search_engine, query: str, top_k: int, start_ns: Optional[int] = None):
+    """
+    Выполняет один search() и возвращает (задержка в нс, была ли ошибка).
+    Ошибкой считается и исключение, и деградированный ответ (SearchResults.degraded):
+    ElasticsearchSearchEngine перехватывает ошибки OpenSearch и возвращает пустой или запасной ответ.
+    start_ns - плановое время отправки (open-loop): задержка считается от него,
+    чтобы отставание генератора нагрузки не пряталось (coordinated omission).
+    """
+    if start_ns is None:
+        start_ns = time.perf_counter_ns()
+    try:
+        results = search_engine.search(query, top_k=top_k)
+        error = bool(getattr(results, "degraded", False))
+    except Exception as e:
+        logger.debug(f"Ошибка search('{query}'): {e}")
+        error = True
+    return time.perf_counter_ns() - start_ns, error
+
+
+def run_closed_loop(search_engine, queries: List[str], concurrency: int = 1, top_k: int = 3):
+    """
+    Closed-loop: concurrency клиентов, каждый отправляет следующий запрос сразу после ответа.
+    Возвращает (список задержек в нс, число ошибок, длительность в секундах).
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    query_iter = iter(queries)
+
+    def client():
+        nonlocal errors
+        while True:
+            with lock:
+                query = next(query_iter, None)
+            if query is None:
+                return
+            latency_ns, error = _timed_call(search_engine, query, top_k)
+            with lock:
+                latencies.append(latency_ns)
+                errors += error
+
+    start_ns = time.perf_counter_ns()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, (time.perf_counter_ns() - start_ns) / 1e9
+
+
+def run_open_loop(search_engine, queries: List[str], target_qps: float, max_workers: int = 64, top_k: int = 3):
+    """
+    Open-loop: запросы приходят с фиксированной частотой target_qps независимо от того,
+    успевает ли движок. Задержка считается от планового времени прихода запроса.
+    Возвращает (список задержек в нс, число ошибок, длительность в секундах).
+    """
+    if target_qps <= 0:
+        raise ValueError(f"target_qps должен быть больше нуля: {target_qps}")
+    interval_ns = int(1e9 / target_qps)
+    start_ns = time.perf_counter_ns()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for index, query in enumerate(queries):
+            scheduled_ns = start_ns + index * interval_ns
+            delay_ns = scheduled_ns - time.perf_counter_ns()
+            if delay_ns > 0:
+                time.sleep(delay_ns / 1e9)
+            futures.append(executor.submit(_timed_call, search_engine, query, top_k, scheduled_ns))
+        results = [future.result() for future in futures]
+    duration_s = (time.perf_counter_ns() - start_ns) / 1e9
+    return [latency for latency, _ in results], sum(error for _, error in results), duration_s
+
+
+def summarize(latencies_ns: List[int], errors: int, duration_s: float, **params) -> Dict:
+    """Сводка прогона в миллисекундах: перцентили, max, mean, throughput, error rate."""
+    latencies_ms = sorted(latency / 1e6 for latency in latencies_ns)
+    count = len(latencies_ms)
+    summary = dict(params)
+    summary.update({
+        'queries': count,
+        'errors': errors,
+        'error_rate': errors / count if count else 0.0,
+        'duration_s': duration_s,
+        'throughput_qps': count / duration_s if duration_s > 0 else 0.0,
+        'mean_ms': sum(latencies_ms) / count if count else 0.0,
+        'max_ms': latencies_ms[-1] if latencies_ms else 0.0,
+    })
+    for pct in PERCENTILES:
+        summary[f'p{pct}_ms'] = percentile(latencies_ms, pct)
+    return summary
+
+
+def run_benchmark(search_engine, queries: List[str], mode: str = "closed", concurrency: int = 1,
+                  target_qps: float = 100.0, warmup_iterations: int = DEFAULT_WARMUP_ITERATIONS,
+                  top_k: int = 3, **params) -> Dict:
+    """
+    Прогревает движок warmup_iterations проходами по queries, затем выполняет замер в режиме closed
+    или open и возвращает сводку прогретого движка. Первый проход прогрева (холодный движок) замеряется
+    в том же режиме и попадает в сводку отдельно, ключом cold; при warmup_iterations=0 его нет.
+    """
+    def measure():
+        if mode == "open":
+            return run_open_loop(search_engine, queries, target_qps, top_k=top_k)
+        return run_closed_loop(search_engine, queries, concurrency, top_k=top_k)
+
+    cold = summarize(*measure()) if warmup_iterations > 0 else None
+    for _ in range(warmup_iterations - 1):
+        for query in queries:
+            try:
+                search_engine.search(query, top_k=top_k)
+            except Exception:
+                pass
+
+    latencies, errors, duration_s = measure()
+    if mode == "open":
+        params.update(mode=mode, target_qps=target_qps)
+    else:
+        params.update(mode=mode, concurrency=concurrency)
+    params.update(warmup_iterations=warmup_iterations)
+    summary = summarize(latencies, errors, duration_s, **params)
+    if cold is not None:
+        summary['cold'] = cold
+    return summary
+
+
+def check_regression(summary: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """
+    Сравнивает сводку с базовой. Возвращает список нарушений: рост p50/p99 больше чем
+    на max_regression (доля) или рост доли ошибок.
+    """
+    violations = []
+    for metric in ('p50_ms', 'p99_ms'):
+        if baseline.get(metric) and summary[metric] > baseline[metric] * (1 + max_regression):
+            violations.append(f"{metric}: {summary[metric]:.3f} > {baseline[metric]:.3f} * {1 + max_regression:.2f}")
+    if summary['error_rate'] > baseline.get('error_rate', 0.0):
+        violations.append(f"error_rate: {summary['error_rate']:.4f} > {baseline.get('error_rate', 0.0):.4f}")
+    return violations
+
+
+def compare_query_modes(queries: List[str], top_k: int = 3, warmup_iterations: int = DEFAULT_WARMUP_ITERATIONS,
+                        **engine_kwargs) -> List[Dict]:
+    """
+    Сравнивает полный запрос (build_query_body + весь hits) и stored search template с урезанным ответом:
+    средний размер тела запроса и ответа, CPU клиента (process_time) и p50/p99 на запрос.
+    Шаблоны должны быть зарегистрированы (setup_elasticsearch.register_search_templates).
+    """
+    from search_engine import ElasticsearchSearchEngine
+    from search_metrics import SearchMetrics
+
+    rows = []
+    for use_template in (False, True):
+        engine = ElasticsearchSearchEngine(use_template=use_template, log_sample_rate=0.0, **engine_kwargs)
+        for _ in range(warmup_iterations):
+            for query in queries:
+                engine.search(query, top_k=top_k)
+        engine.metrics = SearchMetrics()
+        latencies_ns = []
+        cpu_start = time.process_time()
+        for query in queries:
+            start_ns = time.perf_counter_ns()
+            engine.search(query, top_k=top_k)
+            latencies_ns.append(time.perf_counter_ns() - start_ns)
+        cpu_s = time.process_time() - cpu_start
+        counters = engine.metrics.counters
+        answered = max(1, counters["queries"] - counters["errors"])
+        summary = summarize(latencies_ns, counters["errors"], 0.0, mode="template" if use_template else "full")
+        rows.append({
+            "mode": summary["mode"],
+            "request_bytes": counters["request_bytes"] / answered,
+            "response_bytes": counters["response_bytes"] / answered,
+            "client_cpu_us": cpu_s * 1e6 / len(queries) if queries else 0.0,
+            "p50_ms": summary["p50_ms"],
+            "p99_ms": summary["p99_ms"],
+            "errors": counters["errors"],
+        })
+
+    print(f"{'режим':<10} {'запрос, Б':>10} {'ответ, Б':>10} {'CPU, мкс':>10} {'p50, мс':>9} {'p99, мс':>9}")
+    for row in rows:
+        print(f"{row['mode']:<10} {row['request_bytes']:>10.0f} {row['response_bytes']:>10.0f} "
+              f"{row['client_cpu_us']:>10.1f} {row['p50_ms']:>9.3f} {row['p99_ms']:>9.3f}")
+    return rows
+
+
+def print_summary(summary: Dict):
+    print(f"Режим: {summary['mode']}, запросов: {summary['queries']}, ошибок: {summary['errors']} "
+          f"({summary['error_rate'] * 100:.2f}%)")
+    print(f"Пропускная способность: {summary['throughput_qps']:.1f} QPS за {summary['duration_s']:.2f} с")
+    print("Задержка, мс: " + ", ".join(f"p{pct} {summary[f'p{pct}_ms']:.3f}" for pct in PERCENTILES)
+          + f", max {summary['max_ms']:.3f}, mean {summary['mean_ms']:.3f}")
+    if 'cold' in summary:
+        cold = summary['cold']
+        print("Холодный проход, мс: " + ", ".join(f"p{pct} {cold[f'p{pct}_ms']:.3f}" for pct in PERCENTILES)
+              + f", max {cold['max_ms']:.3f}, mean {cold['mean_ms']:.3f}, ошибок: {cold['errors']}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    def positive_float(value: str) -> float:
+        number = float(value)
+        if number <= 0:
+            raise argparse.ArgumentTypeError(f"должно быть больше нуля: {value}")
+        return number
+
+    parser = argparse.ArgumentParser(description="Бенчмарк задержки префиксного поиска")
+    parser.add_argument("--engine", choices=["opensearch", "local"], default="opensearch")
+    parser.add_argument("--catalog", default="data/catalog_products.xml", help="XML каталога для --engine local")
+    parser.add_argument("--queries", default="data/prefix_queries.csv")
+    parser.add_argument("--keystrokes", action="store_true", help="Развернуть запросы в последовательность нажатий")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=1, help="Число клиентов в closed-loop")
+    parser.add_argument("--target-qps", type=positive_float, default=100.0, help="Частота запросов в open-loop")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP_ITERATIONS, help="Проходов прогрева")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз повторить набор запросов при замере")
+    parser.add_argument("--output", default="reports/benchmark_summary.json", help="JSON-сводка прогона")
+    parser.add_argument("--baseline", default=None, help="JSON-сводка для сравнения (gate регрессий)")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="Допустимый рост p50/p99 (доля)")
+    parser.add_argument("--compare-template", action="store_true",
+                        help="Сравнить размер запроса/ответа и CPU клиента: полный запрос vs stored search template")
+    args = parser.parse_args()
+
+    if args.compare_template:
+        logging.getLogger("search_engine").setLevel(logging.WARNING)
+        comparison = compare_query_modes(load_queries(args.queries, keystrokes=args.keystrokes) * args.repeat,
+                                         warmup_iterations=args.warmup)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(comparison, f, ensure_ascii=False, indent=2)
+        exit(0)
+
+    if args.engine == "local":
+        from local_search_engine import LocalPrefixSearchEngine
+        engine = LocalPrefixSearchEngine.from_xml(args.catalog)
+    else:
+        from search_engine import ElasticsearchSearchEngine
+        engine = ElasticsearchSearchEngine()
+        # Поштучные INFO-логи движка искажают замеры
+        logging.getLogger("search_engine").setLevel(logging.WARNING)
+
+    benchmark_queries = load_queries(args.queries, keystrokes=args.keystrokes) * args.repeat
+    result = run_benchmark(engine, benchmark_queries, mode=args.mode, concurrency=args.concurrency,
+                           target_qps=args.target_qps, warmup_iterations=args.warmup,
+                           engine=args.engine, keystrokes=args.keystrokes)
+    print_summary(result)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    logger.info(f"Сводка сохранена в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline_summary = json.load(f)
+        problems = check_regression(result, baseline_summary, args.max_regression)
+        if problems:
+            for problem in problems:
+                logger.error(f"Регрессия: {problem}")
+            exit(1)
+        logger.info("Регрессий относительно базовой сводки нет.")
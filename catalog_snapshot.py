@@ -0,0 +1,251 @@
+# catalog_snapshot.py - компактный колоночный снапшот каталога для быстрого холодного старта
+
+from array import array
+from typing import List, Dict, Iterator, Optional
+import logging
+import math
+import mmap
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIX = ".snap"
+DEFAULT_SNAPSHOT_PATH = "data/catalog_products" + SNAPSHOT_SUFFIX
+
+# Числовые колонки хранятся как float64 (NaN - нет значения), строковые - как uint32 номера
+# строк в общем пуле (одинаковые бренды/категории/магазины хранятся один раз).
+# price - строка: float64 теряет исходную запись ("986.70" вернулась бы как "986.7"), а цена отдаётся в выдаче как есть
+NUMERIC_COLUMNS = ("weight",)
+STRING_COLUMNS = ("id", "name", "brand", "category", "price", "store", "url")
+# Остальные теги товара (image_url, description, keywords, ...) и значения числовых колонок, которые
+# не восстанавливаются из float64 дословно ("500 г"), - пары строк ключ/значение:
+#   extra_start            : начало пар товара (число товаров + 1)
+#   extra_key, extra_value : номера строк в пуле
+EXTRA_COLUMNS = ("extra_start", "extra_key", "extra_value")
+_MISSING = 0xFFFFFFFF
+
+# Готовый индекс LocalPrefixSearchEngine (LocalPrefixSearchEngine.export_index) - тоже колонки:
+#   index_top_k            : [precomputed_top_k]
+#   term, term_start       : отсортированные токены (номера в пуле) и начало их постингов (длина токенов + 1)
+#   posting_doc/_score     : постинги всех токенов подряд
+#   prefix, prefix_start   : отсортированные префиксы и начало их топ-K (длина префиксов + 1)
+#   prefix_doc             : топ-K doc_id всех префиксов подряд
+INDEX_COLUMNS = ("index_top_k", "term", "term_start", "posting_doc", "posting_score",
+                 "prefix", "prefix_start", "prefix_doc")
+
+# Формат файла (little-endian, секции выровнены по 8 байт):
+#   заголовок : magic, версия, число колонок, число товаров, число строк в пуле, offset пула
+#   каталог   : на колонку - имя (16 байт), тип ('d' или 'I'), offset и длина данных
+#   колонки   : массивы float64 / uint32 (колонки товаров - длиной в число товаров)
+#   пул строк : uint32 offsets (число строк + 1), затем UTF-8 байты
+_MAGIC = b"CSN1"
+_VERSION = 3
+_HEADER = struct.Struct("<4sHHIIQ")
+_COLUMN = struct.Struct("<16scxxxxxxxQQ")
+
+
+def _align(position: int) -> int:
+    return (position + 7) & ~7
+
+
+def build_catalog_snapshot(xml_path: str, output_path: str = DEFAULT_SNAPSHOT_PATH,
+                           with_index: bool = True) -> int:
+    """
+    Строит снапшот из XML каталога (XML читается потоково один раз). Сохраняются все теги товара:
+    известные поля - колонками, остальные - парами ключ/значение (EXTRA_COLUMNS).
+    with_index=True - заодно строит LocalPrefixSearchEngine и сохраняет его индекс, чтобы
+    LocalPrefixSearchEngine.from_xml(".snap") подключался к нему без перестроения.
+    Возвращает число товаров.
+    """
+    from setup_elasticsearch import iter_catalog_products
+
+    start_time = time.perf_counter()
+    numeric = {column: array('d') for column in NUMERIC_COLUMNS}
+    strings = {column: array('I') for column in STRING_COLUMNS}
+    extra_start, extra_key, extra_value = array('I', [0]), array('I'), array('I')
+    pool_index: Dict[str, int] = {}
+    pool: List[bytes] = []
+
+    def intern(value: str) -> int:
+        if value not in pool_index:
+            pool_index[value] = len(pool)
+            pool.append(value.encode('utf-8'))
+        return pool_index[value]
+
+    products = []
+    for product in iter_catalog_products(xml_path):
+        for column in NUMERIC_COLUMNS:
+            try:
+                numeric[column].append(float(product.get(column)))
+            except (TypeError, ValueError):
+                numeric[column].append(math.nan)
+        for column in STRING_COLUMNS:
+            value = product.get(column)
+            strings[column].append(_MISSING if value is None else intern(value))
+        for key, value in product.items():
+            if key in STRING_COLUMNS or value is None:
+                continue
+            if key in NUMERIC_COLUMNS and not math.isnan(numeric[key][-1]) \
+                    and format(numeric[key][-1], '.15g') == value:
+                continue
+            extra_key.append(intern(key))
+            extra_value.append(intern(value))
+        extra_start.append(len(extra_key))
+        products.append(product)
+    count = len(products)
+
+    columns = [(column, 'd', numeric[column]) for column in NUMERIC_COLUMNS] + \
+              [(column, 'I', strings[column]) for column in STRING_COLUMNS] + \
+              [("extra_start", 'I', extra_start), ("extra_key", 'I', extra_key), ("extra_value", 'I', extra_value)]
+    if with_index:
+        from local_search_engine import LocalPrefixSearchEngine
+
+        engine = LocalPrefixSearchEngine(products)
+        terms, postings, prefix_top = engine.export_index()
+        term_start, posting_doc, posting_score = array('I', [0]), array('I'), array('d')
+        for term_postings in postings:
+            for doc_id, score in term_postings:
+                posting_doc.append(doc_id)
+                posting_score.append(score)
+            term_start.append(len(posting_doc))
+        prefixes = sorted(prefix_top)
+        prefix_start, prefix_doc = array('I', [0]), array('I')
+        for prefix in prefixes:
+            prefix_doc.extend(prefix_top[prefix])
+            prefix_start.append(len(prefix_doc))
+        columns += [
+            ("index_top_k", 'I', array('I', [engine.precomputed_top_k])),
+            ("term", 'I', array('I', (intern(term) for term in terms))),
+            ("term_start", 'I', term_start),
+            ("posting_doc", 'I', posting_doc),
+            ("posting_score", 'd', posting_score),
+            ("prefix", 'I', array('I', (intern(prefix) for prefix in prefixes))),
+            ("prefix_start", 'I', prefix_start),
+            ("prefix_doc", 'I', prefix_doc),
+        ]
+    del products
+    position = _align(_HEADER.size + len(columns) * _COLUMN.size)
+    directory = []
+    for name, type_code, values in columns:
+        directory.append((name, type_code, position, len(values)))
+        position = _align(position + len(values) * values.itemsize)
+    pool_offset = position
+    pool_offsets = array('I', [0])
+    for value in pool:
+        pool_offsets.append(pool_offsets[-1] + len(value))
+
+    with open(output_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(columns), count, len(pool), pool_offset))
+        for name, type_code, offset, length in directory:
+            f.write(_COLUMN.pack(name.encode('ascii'), type_code.encode('ascii'), offset, length))
+        for (_, _, values), (_, _, offset, _) in zip(columns, directory):
+            f.write(b"\0" * (offset - f.tell()))
+            values.tofile(f)
+        f.write(b"\0" * (pool_offset - f.tell()))
+        pool_offsets.tofile(f)
+        f.write(b"".join(pool))
+
+    logger.info(f"Снапшот каталога: {count} товаров, {len(pool)} уникальных строк -> {output_path} "
+                f"за {(time.perf_counter() - start_time) * 1000:.1f} мс")
+    return count
+
+
+class CatalogSnapshot:
+    """
+    Чтение снапшота через mmap без копирования: колонки - memoryview поверх файла,
+    строка декодируется из пула только при обращении к полю.
+    """
+
+    def __init__(self, path: str = DEFAULT_SNAPSHOT_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        magic, version, column_count, self._count, pool_size, pool_offset = _HEADER.unpack_from(buffer, 0)
+        if magic != _MAGIC:
+            buffer.release()
+            self._mmap.close()
+            raise ValueError(f"{path}: не файл снапшота каталога")
+        if version != _VERSION:
+            buffer.release()
+            self._mmap.close()
+            raise ValueError(f"{path}: снапшот версии {version}, ожидается {_VERSION} - пересоберите его")
+        self._columns: Dict[str, memoryview] = {}
+        for index in range(column_count):
+            raw_name, raw_type, offset, length = _COLUMN.unpack_from(buffer, _HEADER.size + index * _COLUMN.size)
+            type_code = raw_type.decode('ascii')
+            size = length * (8 if type_code == 'd' else 4)
+            self._columns[raw_name.rstrip(b"\0").decode('ascii')] = buffer[offset:offset + size].cast(type_code)
+        self._pool_offsets = buffer[pool_offset:pool_offset + (pool_size + 1) * 4].cast('I')
+        self._pool_start = pool_offset + (pool_size + 1) * 4
+        self._buffer = buffer
+
+    def __len__(self) -> int:
+        return self._count
+
+    def number(self, column: str, row: int) -> Optional[float]:
+        """Числовое поле товара (weight) или None."""
+        value = self._columns[column][row]
+        return None if math.isnan(value) else value
+
+    def string(self, column: str, row: int) -> Optional[str]:
+        """Строковое поле товара из пула или None."""
+        return self.pool_string(self._columns[column][row])
+
+    def pool_string(self, string_id: int) -> Optional[str]:
+        """Строка пула по номеру (_MISSING - None)."""
+        if string_id == _MISSING:
+            return None
+        start = self._pool_start + self._pool_offsets[string_id]
+        end = self._pool_start + self._pool_offsets[string_id + 1]
+        return bytes(self._buffer[start:end]).decode('utf-8')
+
+    @property
+    def has_index(self) -> bool:
+        """Сохранён ли в снапшоте индекс LocalPrefixSearchEngine (колонки INDEX_COLUMNS)."""
+        return all(column in self._columns for column in INDEX_COLUMNS)
+
+    def column(self, name: str) -> memoryview:
+        """Колонка целиком (memoryview поверх mmap, без копирования)."""
+        return self._columns[name]
+
+    def product(self, row: int) -> Dict[str, str]:
+        """Товар в том же виде, что и load_catalog_products (значения - строки, пустые теги опущены)."""
+        product = {}
+        for column in STRING_COLUMNS:
+            value = self.string(column, row)
+            if value is not None:
+                product[column] = value
+        for column in NUMERIC_COLUMNS:
+            value = self.number(column, row)
+            if value is not None:
+                product[column] = format(value, '.15g')
+        extra_start, extra_key, extra_value = (self._columns[column] for column in EXTRA_COLUMNS)
+        for position in range(extra_start[row], extra_start[row + 1]):
+            product[self.pool_string(extra_key[position])] = self.pool_string(extra_value[position])
+        return product
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return (self.product(row) for row in range(self._count))
+
+    def close(self):
+        for column in self._columns.values():
+            column.release()
+        self._columns.clear()
+        self._pool_offsets.release()
+        self._buffer.release()
+        self._mmap.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Сборка колоночного снапшота каталога из XML")
+    parser.add_argument("--catalog", default="data/catalog_products.xml")
+    parser.add_argument("--output", default=DEFAULT_SNAPSHOT_PATH)
+    parser.add_argument("--no-index", action="store_true",
+                        help="Не сохранять индекс LocalPrefixSearchEngine (только колонки товаров)")
+    args = parser.parse_args()
+    build_catalog_snapshot(args.catalog, args.output, with_index=not args.no_index)
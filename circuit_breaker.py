@@ -0,0 +1,91 @@
+# circuit_breaker.py - автомат размыкания для вызовов OpenSearch
+
+from collections import deque
+from typing import Dict
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Скользящее окно последних window_size вызовов. Автомат размыкается (OPEN), когда в окне
+    не меньше min_calls вызовов и доля ошибок >= error_rate_threshold или доля медленных
+    (дольше slow_call_ms) >= slow_rate_threshold. Через open_seconds пропускается один пробный
+    вызов (HALF_OPEN): успех замыкает автомат, ошибка или медленный ответ - снова размыкает.
+    """
+
+    def __init__(self, window_size: int = 50, min_calls: int = 20, error_rate_threshold: float = 0.5,
+                 slow_call_ms: float = 500.0, slow_rate_threshold: float = 0.5, open_seconds: float = 5.0):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_ms = slow_call_ms
+        self.slow_rate_threshold = slow_rate_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window_size)  # (ошибка, медленный)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow_request(self) -> bool:
+        """Можно ли сейчас идти в бэкенд (в HALF_OPEN - только один пробный вызов)."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record(self, success: bool, latency_ms: float):
+        """Результат вызова, разрешённого allow_request()."""
+        slow = latency_ms >= self.slow_call_ms
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if success and not slow:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    logger.info("CircuitBreaker: пробный вызов успешен, автомат замкнут")
+                else:
+                    self._open()
+                return
+            self._calls.append((not success, slow))
+            if self._state != CLOSED or len(self._calls) < self.min_calls:
+                return
+            error_rate = sum(error for error, _ in self._calls) / len(self._calls)
+            slow_rate = sum(slow for _, slow in self._calls) / len(self._calls)
+            if error_rate >= self.error_rate_threshold or slow_rate >= self.slow_rate_threshold:
+                logger.warning(f"CircuitBreaker: доля ошибок {error_rate:.2f}, доля медленных {slow_rate:.2f} - "
+                               f"автомат разомкнут на {self.open_seconds} с")
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self.trips += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"state": self._current_state(), "trips": self.trips, "window_calls": len(self._calls)}
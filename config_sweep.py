@@ -0,0 +1,199 @@
+# config_sweep.py - перебор параметров запроса и маппинга: покрытие vs задержка vs размер индекса
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from typing import List, Dict, Optional, Tuple
+import json
+import logging
+import os
+import requests
+
+from benchmark import load_queries, run_benchmark
+from evaluate_coverage import evaluate_report
+from search_engine import ElasticsearchSearchEngine, run_evaluation, DEFAULT_QUERY_PARAMS
+from setup_elasticsearch import (OPENSEARCH_HOST, OPENSEARCH_INDEX_NAME, MAPPING_MODES, DEFAULT_MAPPING_MODE,
+                                 BULK_WORKERS, build_comparison_index, index_store_size, wait_for_opensearch)
+
+logger = logging.getLogger(__name__)
+
+# Сетка по умолчанию - текущая боевая конфигурация (один вариант)
+DEFAULT_GRID = {
+    "mapping": [DEFAULT_MAPPING_MODE],
+    "edge_ngram": [(1, 20)],
+    "fuzziness": [DEFAULT_QUERY_PARAMS["fuzziness"]],
+    "prefix_length": [DEFAULT_QUERY_PARAMS["prefix_length"]],
+    "boosts": [DEFAULT_QUERY_PARAMS["boosts"]],
+}
+# Сколько вариантов оценивается одновременно
+DEFAULT_PARALLEL = 4
+
+
+def parse_boosts(text: str) -> Dict[str, float]:
+    """"name=3,brand=2" -> {"name": 3.0, "brand": 2.0}; пустая строка - без бустов."""
+    boosts = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        field, _, boost = item.partition('=')
+        boosts[field.strip()] = float(boost)
+    return boosts
+
+
+def _format_boosts(boosts: Dict[str, float]) -> str:
+    return ",".join(f"{field}={boost:g}" for field, boost in boosts.items()) or "-"
+
+
+def index_variants(grid: Dict) -> List[Tuple[str, Optional[Tuple[int, int]]]]:
+    """Уникальные (mapping, edge_ngram) - индексы, которые нужно построить. search_as_you_type не зависит от edge_ngram."""
+    variants = []
+    for mapping_mode, edge_ngram_range in product(grid["mapping"], grid["edge_ngram"]):
+        variant = (mapping_mode, None if mapping_mode == "search_as_you_type" else tuple(edge_ngram_range))
+        if variant not in variants:
+            variants.append(variant)
+    return variants
+
+
+def sweep_index_name(mapping_mode: str, edge_ngram_range: Optional[Tuple[int, int]]) -> str:
+    suffix = f"_{edge_ngram_range[0]}_{edge_ngram_range[1]}" if edge_ngram_range else ""
+    return f"{OPENSEARCH_INDEX_NAME}_sweep_{mapping_mode}{suffix}"
+
+
+def pareto_front(rows: List[Dict]) -> List[bool]:
+    """
+    Для каждого варианта - входит ли он во фронт Парето: нет другого варианта, который не хуже
+    по покрытию (больше - лучше), p50, p99 и размеру индекса (меньше - лучше) и строго лучше хотя бы в одном.
+    Варианты с ошибками (error_rate > 0, например HTTP 400 на невалидный запрос - «быстрый» пустой ответ)
+    во фронт не попадают и другие варианты не вытесняют.
+    """
+    def key(row):
+        return (-row["coverage"], row["p50_ms"], row["p99_ms"], row["size_bytes"])
+
+    valid = [row for row in rows if not row["error_rate"]]
+    front = []
+    for row in rows:
+        dominated = any(all(a <= b for a, b in zip(key(other), key(row))) and key(other) != key(row)
+                        for other in valid)
+        front.append(not row["error_rate"] and not dominated)
+    return front
+
+
+def _evaluate_variant(variant: Dict, queries_csv_path: str, queries: List[str], report_dir: str,
+                      warmup_iterations: int) -> Dict:
+    """Отчёт run_evaluation + evaluate_report (покрытие) и run_benchmark (p50/p99) для одного варианта."""
+    engine = ElasticsearchSearchEngine(pool_size=2, index_name=variant["index_name"],
+                                       mapping_mode=variant["mapping"], log_sample_rate=0.0,
+                                       query_params={"fuzziness": variant["fuzziness"],
+                                                     "prefix_length": variant["prefix_length"],
+                                                     "boosts": variant["boosts"]})
+    report_path = os.path.join(report_dir, f"{variant['label']}.csv")
+    run_evaluation(engine, queries_csv_path, report_path)
+    coverage = evaluate_report(report_path)
+    latency = run_benchmark(engine, queries, mode="closed", concurrency=1, warmup_iterations=warmup_iterations)
+    return dict(variant, coverage=coverage["coverage"], mrr=coverage["mrr"],
+                p50_ms=latency["p50_ms"], p99_ms=latency["p99_ms"], error_rate=latency["error_rate"])
+
+
+def run_config_sweep(xml_path: str, queries_csv_path: str, grid: Dict = DEFAULT_GRID, parallel: int = DEFAULT_PARALLEL,
+                     workers: int = BULK_WORKERS, warmup_iterations: int = 1, report_dir: str = "reports/sweep",
+                     output_path: str = "reports/config_sweep.json", keep_indices: bool = False) -> List[Dict]:
+    """
+    Перебирает сетку параметров: mapping и edge_ngram задают индекс, fuzziness, prefix_length и boosts -
+    запрос. Каждый нужный индекс строится один раз (как в compare_mappings, отдельными индексами рядом
+    с боевым), затем все варианты оцениваются на одном наборе префиксов в parallel потоков.
+    Варианты делят один кластер: при parallel > 1 задержки сравнимы между собой, но выше, чем
+    в изолированном прогоне (parallel=1).
+    Печатает таблицу покрытие / p50 / p99 / размер индекса с отметкой фронта Парето и сохраняет её в output_path.
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    indices = {}
+    for mapping_mode, edge_ngram_range in index_variants(grid):
+        index_name = sweep_index_name(mapping_mode, edge_ngram_range)
+        build = build_comparison_index(index_name, xml_path, mapping_mode, workers, edge_ngram_range)
+        if build is None:
+            continue
+        indices[(mapping_mode, edge_ngram_range)] = dict(build, index_name=index_name,
+                                                         size_bytes=index_store_size(index_name))
+        logger.info(f"Индекс '{index_name}': {build['docs']} документов, {build['indexing_s']:.2f} с")
+
+    variants = []
+    for (mapping_mode, edge_ngram_range), index in indices.items():
+        for fuzziness, prefix_length, boosts in product(grid["fuzziness"], grid["prefix_length"], grid["boosts"]):
+            label = (f"{index['index_name'][len(OPENSEARCH_INDEX_NAME) + len('_sweep_'):]}"
+                     f"_f{fuzziness}_p{prefix_length}_b{_format_boosts(boosts).replace(',', '_').replace('=', '')}")
+            variants.append({
+                "label": label,
+                "index_name": index["index_name"],
+                "mapping": mapping_mode,
+                "edge_ngram": list(edge_ngram_range) if edge_ngram_range else None,
+                "fuzziness": fuzziness,
+                "prefix_length": prefix_length,
+                "boosts": boosts,
+                "size_bytes": index["size_bytes"],
+            })
+
+    queries = load_queries(queries_csv_path)
+    logger.info(f"Оценка {len(variants)} вариантов на {len(indices)} индексах ({parallel} параллельно)")
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        rows = list(executor.map(lambda variant: _evaluate_variant(variant, queries_csv_path, queries, report_dir,
+                                                                   warmup_iterations), variants))
+
+    for row, optimal in zip(rows, pareto_front(rows)):
+        row["pareto"] = optimal
+    rows.sort(key=lambda row: (not row["pareto"], -row["coverage"], row["p99_ms"], row["size_bytes"]))
+
+    print(f"{'':<2}{'mapping':<20} {'ngram':>6} {'fuzz':>5} {'pref':>5} {'boosts':<22} {'размер, МБ':>11} "
+          f"{'покрытие, %':>12} {'MRR':>7} {'p50, мс':>9} {'p99, мс':>9} {'ошибок, %':>10}")
+    for row in rows:
+        ngram = "-".join(map(str, row["edge_ngram"])) if row["edge_ngram"] else "-"
+        print(f"{'*' if row['pareto'] else '':<2}{row['mapping']:<20} {ngram:>6} {row['fuzziness']:>5} "
+              f"{row['prefix_length']:>5} {_format_boosts(row['boosts']):<22} {row['size_bytes'] / 2**20:>11.2f} "
+              f"{row['coverage']:>12.2f} {row['mrr']:>7.4f} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} "
+              f"{row['error_rate'] * 100:>10.1f}")
+    print("* - фронт Парето (покрытие / p50 / p99 / размер индекса) среди вариантов без ошибок")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    logger.info(f"Результаты перебора сохранены в {output_path}")
+
+    if not keep_indices:
+        for index in indices.values():
+            requests.delete(f"{OPENSEARCH_HOST}/{index['index_name']}")
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Перебор fuzziness/prefix_length/бустов/edge_ngram: таблица Парето")
+    parser.add_argument("--catalog", default="data/catalog_products.xml", help="XML каталога")
+    parser.add_argument("--queries", default="data/prefix_queries.csv")
+    parser.add_argument("--grid", default=None,
+                        help="JSON-файл сетки с ключами mapping, edge_ngram, fuzziness, prefix_length, boosts "
+                             "(вместо флагов ниже)")
+    parser.add_argument("--mappings", nargs="+", choices=MAPPING_MODES, default=DEFAULT_GRID["mapping"])
+    parser.add_argument("--edge-ngram", nargs="+", default=["1-20"], help="Диапазоны min-max для edge_ngram_filter")
+    parser.add_argument("--fuzziness", nargs="+", default=DEFAULT_GRID["fuzziness"], help="Например: AUTO 0 1 2")
+    parser.add_argument("--prefix-length", nargs="+", type=int, default=DEFAULT_GRID["prefix_length"])
+    parser.add_argument("--boosts", nargs="+", default=[""],
+                        help='Наборы бустов полей, например "name=3,brand=2" ("" - без бустов)')
+    parser.add_argument("--parallel", type=int, default=DEFAULT_PARALLEL, help="Вариантов одновременно")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="Число параллельных bulk-запросов")
+    parser.add_argument("--warmup", type=int, default=1, help="Проходов прогрева перед замером задержки")
+    parser.add_argument("--output", default="reports/config_sweep.json")
+    parser.add_argument("--keep-indices", action="store_true", help="Не удалять индексы вариантов после перебора")
+    args = parser.parse_args()
+
+    if args.grid:
+        with open(args.grid, 'r', encoding='utf-8') as f:
+            sweep_grid = dict(DEFAULT_GRID, **json.load(f))
+    else:
+        sweep_grid = {
+            "mapping": args.mappings,
+            "edge_ngram": [tuple(int(value) for value in item.split('-')) for item in args.edge_ngram],
+            "fuzziness": args.fuzziness,
+            "prefix_length": args.prefix_length,
+            "boosts": [parse_boosts(item) for item in args.boosts],
+        }
+
+    if not wait_for_opensearch():
+        exit(1)
+    logging.getLogger("search_engine").setLevel(logging.WARNING)
+    run_config_sweep(args.catalog, args.queries, sweep_grid, parallel=args.parallel, workers=args.workers,
+                     warmup_iterations=args.warmup, output_path=args.output, keep_indices=args.keep_indices)
@@ -1,5 +1,7 @@
 # corrections.py
 
+from collections import deque
+
 # Словарь для исправления опечаток, транслитерации и нормализации запросов
 # Ключ - оригинальный запрос или его часть, значение - исправленный/нормализованный вариант
 CORRECTIONS = {
@@ -19,29 +21,119 @@ CORRECTIONS = {
     # "10л": "10 liters" # Не будем пока менять числа, это сложнее
 }
 
+
+class CorrectionRewriter:
+    """
+    Скомпилированный набор правил корректировки (автомат Ахо-Корасик).
+    Переписывает запрос за один проход слева направо:
+      * из совпадений, начинающихся в одной позиции, выигрывает самое длинное;
+      * правило срабатывает только на границах токенов (не внутри слова);
+      * результат замены повторно не переписывается (правила не каскадируются).
+    Стоимость прохода - O(длина запроса + число совпадений), от числа правил не зависит.
+    """
+
+    def __init__(self, rules: dict):
+        self.rules = {wrong.lower(): correct for wrong, correct in rules.items() if wrong}
+        # Узел автомата: переходы, suffix-ссылка, длина правила, заканчивающегося в узле (0 - нет),
+        # и ссылка на ближайший по suffix-цепочке узел с правилом (dictionary suffix link).
+        self._goto = [{}]
+        self._fail = [0]
+        self._pattern = [None]
+        self._dict_link = [0]
+        for wrong in self.rules:
+            node = 0
+            for char in wrong:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._pattern.append(None)
+                    self._dict_link.append(0)
+                node = next_node
+            self._pattern[node] = wrong
+
+        # BFS по автомату для построения suffix- и dictionary-ссылок (у узлов глубины 1 они ведут в корень)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                suffix = self._fail[child]
+                self._dict_link[child] = suffix if self._pattern[suffix] is not None else self._dict_link[suffix]
+                queue.append(child)
+
+    @staticmethod
+    def _is_boundary(text: str, position: int) -> bool:
+        """Граница токена: начало/конец строки или соседство с небуквенным символом."""
+        if position == 0 or position == len(text):
+            return True
+        return not _is_word_char(text[position - 1]) or not _is_word_char(text[position])
+
+    def rewrite(self, query: str) -> str:
+        """Применяет правила к запросу (в нижнем регистре) за один проход."""
+        text = query.lower()
+        # Самое длинное правило, начинающееся в каждой позиции: start -> wrong
+        best_at = {}
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            end = index + 1
+            if not self._is_boundary(text, end):
+                continue
+            match_node = node if self._pattern[node] is not None else self._dict_link[node]
+            while match_node:
+                wrong = self._pattern[match_node]
+                start = end - len(wrong)
+                if self._is_boundary(text, start) and len(wrong) > len(best_at.get(start, '')):
+                    best_at[start] = wrong
+                match_node = self._dict_link[match_node]
+
+        if not best_at:
+            return text
+        parts = []
+        position = 0
+        while position < len(text):
+            wrong = best_at.get(position)
+            if wrong is not None:
+                parts.append(self.rules[wrong])
+                position += len(wrong)
+            else:
+                parts.append(text[position])
+                position += 1
+        return ''.join(parts)
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+# Правила компилируются один раз при импорте модуля.
+# Если CORRECTIONS меняется во время работы, нужно вызвать compile_corrections().
+_rewriter = CorrectionRewriter(CORRECTIONS)
+
+
+def compile_corrections(rules: dict = None) -> CorrectionRewriter:
+    """Перекомпилирует правила (по умолчанию CORRECTIONS), которые использует apply_corrections."""
+    global _rewriter
+    _rewriter = CorrectionRewriter(CORRECTIONS if rules is None else rules)
+    return _rewriter
+
+
 # Функция для применения корректировок
 def apply_corrections(query: str) -> str:
     """
     Применяет правила корректировки к запросу.
-    Пока простая реализация: заменяет точные совпадения токенов или сам запрос целиком.
+    Все правила из CORRECTIONS проверяются за один проход скомпилированного автомата:
+    самое длинное совпадение выигрывает, замены делаются только по границам токенов.
     """
-    # Приводим к нижнему регистру для сопоставления
-    query_lower = query.lower()
-    # Проверяем, есть ли весь запрос в словаре
-    if query_lower in CORRECTIONS:
-        return CORRECTIONS[query_lower]
-
-    # Проверяем и заменяем части запроса (токены)
-    # Это простая версия, заменяет по одному вхождению за раз
-    corrected_query = query_lower
-    for wrong, correct in CORRECTIONS.items():
-        # Заменяем *точное* вхождение wrong на correct в corrected_query
-        # Это может не сработать, если wrong является частью другого слова
-        # или если слова в неправильном порядке.
-        # Для более сложных случаев нужен NLP.
-        corrected_query = corrected_query.replace(wrong, correct)
-
-    return corrected_query
+    return _rewriter.rewrite(query)
 
 # Пример использования (можно закомментировать или удалить после тестирования)
 # if __name__ == "__main__":
@@ -1,126 +1,178 @@
 import csv
 import logging
+import math
+import re
+from collections import defaultdict
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
 
 # Настройка логирования (опционально, для отладки)
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 # logger = logging.getLogger(__name__)
 
+_SPLIT_RE = re.compile(r'\s+|[^\w]')
+RANK_CUTOFF = 3 # Метрики ранжирования считаются по top_3
+# Начиная с этого числа уникальных строк имеет смысл раздавать оценку по процессам
+PARALLEL_MIN_UNIQUE_ROWS = 50000
+# Размеры кэшей разбора строк: ограничены, чтобы длинный лог запросов не держал все строки в памяти
+TEXT_CACHE_SIZE = 1 << 16
+MATCH_CACHE_SIZE = 1 << 20
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _tokens(text: str) -> Tuple[str, ...]:
+    """Токены строки в нижнем регистре (кэшируются: запросы и названия в отчёте повторяются)."""
+    return tuple(token for token in _SPLIT_RE.split(text.lower()) if token)
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _result_index(result_part: str) -> Tuple[str, Tuple[str, ...]]:
+    """Индекс результата: нормализованная строка и её слова."""
+    result_lower = result_part.lower().strip()
+    return result_lower, _tokens(result_lower)
+
+
+@lru_cache(maxsize=MATCH_CACHE_SIZE)
+def _token_matches_result(token: str, result_part: str) -> bool:
+    """
+    Совпадает ли токен запроса/notes с результатом:
+    токен - подстрока результата, либо токен и одно из слов результата вложены друг в друга
+    (это ловит "кар" -> "картофель").
+    """
+    result_lower, result_words = _result_index(result_part)
+    if token in result_lower:
+        return True
+    return any(token in word or word in token for word in result_words)
+
+
+def result_relevance(query: str, notes: str, top_3_results: str) -> List[bool]:
+    """Релевантность каждого результата из top_3 (в порядке выдачи)."""
+    if not top_3_results.strip():
+        return []
+    tokens = set(_tokens(query)) | set(_tokens(notes))
+    return [any(_token_matches_result(token, result_part) for token in tokens)
+            for result_part in top_3_results.split('|')]
+
+
 def is_result_relevant(query: str, notes: str, top_3_results: str) -> bool:
     """
     Проверяет, является ли хотя бы один из top_3 результатов релевантным для query и notes.
     Это упрощённая логика. В идеале - ручная оценка.
+    Результат релевантен, если содержит токен запроса/notes как подстроку или
+    одно из его слов вложено в токен (или наоборот): "кар" -> "картофель".
+    Проверяются все результаты (раньше мягкая проверка смотрела только на последний).
     """
-    # Приводим к нижнему регистру для простоты
-    query_lower = query.lower()
-    notes_lower = notes.lower()
-    results_lower = top_3_results.lower()
-
-    # Проверяем, содержит ли хотя бы один из результатов часть запроса или ключевые слова из notes
-    # Это базовая эвристика, может не учитывать транслитерацию, опечатки, семантику.
-    # Пример: query "йогурт гр" -> результаты с "йогурт" и "греческий"
-    # Пример: notes "butter/oil" -> результаты с "масло"
-    # Пример: notes "чай" (через xfq) -> результаты с "чай" (если найдены)
-
-    # Простая проверка: содержится ли query (или его части) в результатах?
-    # Или содержатся ли ключевые слова из notes в результатах?
-    # Разбиваем query и notes на токены для грубого сравнения
-    import re
-    query_tokens = re.split(r'\s+|[^\w]', query_lower)
-    query_tokens = [token for token in query_tokens if token]
-    notes_tokens = re.split(r'\s+|[^\w]', notes_lower)
-    notes_tokens = [token for token in notes_tokens if token]
-
-    # Проверяем, содержит ли хотя бы один результат токены из query или notes
-    for result_part in results_lower.split('|'): # Разбиваем top_3 по |
-        result_part_lower = result_part.strip()
-        # Проверяем, содержит ли результат токены из query
-        if any(token in result_part_lower for token in query_tokens):
-            return True
-        # Проверяем, содержит ли результат токены из notes (например, 'чай', 'масло', 'йогурт')
-        if any(token in result_part_lower for token in notes_tokens):
-            return True
-
-    # Если ни одна проверка не сработала, считаем результат нерелевантным
-    # Это грубая эвристика. xfq -> чай не сработает, так как "чай" не содержится в результатах.
-    # xfqyfz сервиз -> xfqyfz (токен) не найдёт "сервиз".
-    # "кар тофель" -> "картофель" в результатах: "кар" не найдётся как токен в "картофель".
-    # Это показывает, что автоматическая оценка сложна.
-
-    # Попробуем более простую эвристику: если в top_3 есть хоть какие-то результаты,
-    # и query/notes содержат общеупотребительные слова, которые могут совпасть.
-    # Это всё ещё не идеально.
-    # Для более точной оценки нужна ручная проверка или более умная модель.
-
-    # Более простой способ: если top_3 не пустой, и query/notes не слишком общие/абстрактные,
-    # считать релевантным. Но это тоже может быть неточно.
-    # xfq -> 0 результатов -> нерелевантно (это правильно).
-    # xfqyfz сервиз -> 0 результатов -> нерелевантно (это правильно).
-    # adapter usb c -> результаты с "usb c" -> релевантно (это правильно).
-    # йогурт гр -> результаты с "йогурт греческий" -> релевантно (это правильно).
-    # кар тофель -> (предположим, что OpenSearch нашёл "Картофель фри") -> релевантно (если "картофель" в результатах).
-
-    # Давайте улучшим эвристику: если есть результаты и они содержат *что-то* похожее на query/notes.
-    # Используем более мягкую проверку.
-    # Если результаты пусты, запрос точно нерелевантен.
-    if not results_lower.strip():
-        return False
-
-    # Проверим снова, но с более широким подходом.
-    # Проверим, содержит ли хотя бы одна часть результата *часть* query или notes.
-    # Это может помочь с "кар" -> "картофель".
-    # Разбиваем результат на слова и сравниваем с токенами запроса/заметки.
-    result_words = re.split(r'\s+|[^\w]', result_part_lower)
-    result_words = [word for word in result_words if word]
-    for res_word in result_words:
-        for q_token in query_tokens:
-            if q_token in res_word or res_word in q_token: # Проверка "кар" в "картофель" или "картофель" в "кар"
-                return True
-        for n_token in notes_tokens:
-            if n_token in res_word or res_word in n_token:
-                return True
-
-    # Если после всех проверок не нашли совпадений, считаем нерелевантным.
-    return False
-
-
-def evaluate_coverage(csv_path: str):
+    return any(result_relevance(query, notes, top_3_results))
+
+
+def ranking_metrics(relevance: List[bool]) -> Tuple[float, float]:
+    """Reciprocal rank и nDCG@RANK_CUTOFF для бинарной релевантности одной выдачи."""
+    relevance = relevance[:RANK_CUTOFF]
+    reciprocal_rank = next((1.0 / (rank + 1) for rank, relevant in enumerate(relevance) if relevant), 0.0)
+    dcg = sum(1.0 / math.log2(rank + 2) for rank, relevant in enumerate(relevance) if relevant)
+    ideal_dcg = sum(1.0 / math.log2(rank + 2) for rank in range(sum(relevance)))
+    return reciprocal_rank, dcg / ideal_dcg if ideal_dcg else 0.0
+
+
+def _clear_caches():
+    """Освобождает кэши разбора строк после оценки отчёта."""
+    _tokens.cache_clear()
+    _result_index.cache_clear()
+    _token_matches_result.cache_clear()
+
+
+def _score_keys(keys: List[Tuple[str, str, str]]) -> List[Tuple[bool, float, float]]:
+    """Оценивает пачку уникальных (query, notes, top_3): (релевантен ли, RR, nDCG@3)."""
+    scored = []
+    for query, notes, top_3 in keys:
+        relevance = result_relevance(query, notes, top_3)
+        scored.append((any(relevance),) + ranking_metrics(relevance))
+    return scored
+
+
+def evaluate_report(csv_path: str, processes: int = 1) -> Dict:
     """
-    Оценивает покрытие релевантных open запросов.
+    Пакетная оценка отчёта run_evaluation по open-запросам.
+    Отчёт читается один раз, одинаковые строки (query, notes, top_3) оцениваются один раз,
+    при processes > 1 и большом числе уникальных строк оценка раздаётся по процессам.
+    Возвращает общие метрики (coverage, MRR, nDCG@3) и разбивку по site.
+    Кэши разбора строк живут только в пределах одного вызова (в процессах пула - вместе с пулом).
     """
-    total_open = 0
-    relevant_open = 0
-
+    open_rows = []
     with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            query_type = row['type']
-            if query_type != 'open':
+        for row in csv.DictReader(f):
+            if row['type'] != 'open':
                 continue # Пропускаем hidden запросы
-
-            total_open += 1
-            query = row['query']
-            notes = row['notes']
-            top_3 = row['top_3']
-
-            # Проверяем релевантность
-            if is_result_relevant(query, notes, top_3):
-                relevant_open += 1
-                # print(f"RELEVANT: '{query}' -> {top_3}") # Опционально: логировать релевантные
-            # else:
-            #     print(f"NOT RELEVANT: '{query}' -> {top_3}") # Опционально: логировать нерелевантные
-
-    if total_open > 0:
-        coverage_percentage = (relevant_open / total_open) * 100
-        print(f"Всего open запросов: {total_open}")
-        print(f"Релевантных open запросов: {relevant_open}")
-        print(f"Процент покрытия (релевантные open): {coverage_percentage:.2f}%")
-        return coverage_percentage
+            open_rows.append((row.get('site', ''), (row['query'], row['notes'], row['top_3'])))
+
+    unique_keys = list(dict.fromkeys(key for _, key in open_rows))
+    if processes > 1 and len(unique_keys) >= PARALLEL_MIN_UNIQUE_ROWS:
+        chunk = math.ceil(len(unique_keys) / (processes * 4))
+        with Pool(processes) as pool:
+            parts = pool.map(_score_keys, [unique_keys[i:i + chunk] for i in range(0, len(unique_keys), chunk)])
+        scores = dict(zip(unique_keys, (score for part in parts for score in part)))
+    else:
+        try:
+            scores = dict(zip(unique_keys, _score_keys(unique_keys)))
+        finally:
+            _clear_caches()
+
+    def new_totals():
+        return {'total': 0, 'relevant': 0, 'rr_sum': 0.0, 'ndcg_sum': 0.0}
+
+    overall = new_totals()
+    per_site = defaultdict(new_totals)
+    for site, key in open_rows:
+        relevant, reciprocal_rank, ndcg = scores[key]
+        for totals in (overall, per_site[site]):
+            totals['total'] += 1
+            totals['relevant'] += relevant
+            totals['rr_sum'] += reciprocal_rank
+            totals['ndcg_sum'] += ndcg
+
+    def finalize(totals):
+        total = totals['total']
+        return {
+            'total': total,
+            'relevant': totals['relevant'],
+            'coverage': totals['relevant'] / total * 100 if total else 0.0,
+            'mrr': totals['rr_sum'] / total if total else 0.0,
+            'ndcg_at_3': totals['ndcg_sum'] / total if total else 0.0,
+        }
+
+    report = finalize(overall)
+    report['sites'] = {site: finalize(totals) for site, totals in sorted(per_site.items())}
+    return report
+
+
+def evaluate_coverage(csv_path: str, processes: int = 1):
+    """
+    Оценивает покрытие релевантных open запросов.
+    Дополнительно печатает MRR, nDCG@3 и разбивку по site.
+    """
+    report = evaluate_report(csv_path, processes=processes)
+
+    if report['total'] > 0:
+        print(f"Всего open запросов: {report['total']}")
+        print(f"Релевантных open запросов: {report['relevant']}")
+        print(f"Процент покрытия (релевантные open): {report['coverage']:.2f}%")
+        print(f"MRR@{RANK_CUTOFF}: {report['mrr']:.4f}, nDCG@{RANK_CUTOFF}: {report['ndcg_at_3']:.4f}")
+        print(f"{'site':<20} {'open':>8} {'покрытие, %':>12} {'MRR':>8} {'nDCG@3':>8}")
+        for site, site_report in report['sites'].items():
+            print(f"{site:<20} {site_report['total']:>8} {site_report['coverage']:>12.2f} "
+                  f"{site_report['mrr']:>8.4f} {site_report['ndcg_at_3']:>8.4f}")
+        return report['coverage']
     else:
         print("Не найдено open запросов в файле.")
         return 0
 
 
 if __name__ == "__main__":
-    report_path = "reports/elasticsearch_evaluation_results_v2.csv" # Путь к отчёту v2
-    evaluate_coverage(report_path)
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Оценка покрытия релевантных open запросов")
+    parser.add_argument("report", nargs="?", default="reports/elasticsearch_evaluation_results_v2.csv") # Путь к отчёту v2
+    parser.add_argument("--processes", type=int, default=1, help="Число процессов для больших отчётов")
+    args = parser.parse_args()
+    evaluate_coverage(args.report, processes=args.processes)
@@ -0,0 +1,147 @@
+# keystroke_session.py - инкрементальный поиск по нажатиям: сужение кандидатов предыдущего нажатия
+
+from typing import List, Dict, Optional, Tuple
+import logging
+import time
+
+from local_search_engine import tokenize, INDEXED_FIELDS
+from search_engine import SearchResults
+
+logger = logging.getLogger(__name__)
+
+# Сколько кандидатов запрашиваем из OpenSearch при промахе (топ, который потом сужается локально)
+DEFAULT_CANDIDATE_POOL = 200
+
+
+def _match_score(query_tokens: List[str], product: Dict[str, str]) -> Optional[float]:
+    """
+    Вес совпадения товара с запросом или None, если какой-то токен запроса не является
+    префиксом ни одного токена name/brand/category. Веса - как у LocalPrefixSearchEngine.
+    """
+    field_tokens = [(weight, tokenize(product.get(field))) for field, weight in INDEXED_FIELDS.items()]
+    total = 0.0
+    for query_token in query_tokens:
+        best = 0.0
+        for weight, tokens in field_tokens:
+            for position, token in enumerate(tokens):
+                if token.startswith(query_token):
+                    best = max(best, weight + (0.5 if position == 0 else 0.0))
+                    break
+        if not best:
+            return None
+        total += best
+    return total
+
+
+class KeystrokeSession:
+    """
+    Поиск в рамках одной сессии ввода ("й", "йо", "йог", ...).
+    При обращении в OpenSearch запрашивается candidate_pool кандидатов. Если следующий префикс
+    продолжает предыдущий (и после корректировки тоже), а набор кандидатов полный (OpenSearch вернул
+    меньше candidate_pool), кандидаты фильтруются и переранжируются локально. В OpenSearch идём снова, когда:
+      * префикс укорочен или изменён не дописыванием;
+      * корректировка изменила запрос (скорректированный префикс не продолжает предыдущий);
+      * набор был обрезан candidate_pool: товары за его пределами могут ранжироваться выше оставшихся;
+      * запрос был нечётким (fuzzy) и после фильтрации осталось меньше top_k кандидатов.
+    Деградированный ответ (SearchResults.degraded) отдаётся с той же пометкой, но не запоминается:
+    сужать неполный запасной набор нельзя, следующее нажатие снова пойдёт в бэкенд.
+    Порядок при равном весе - порядок OpenSearch.
+    """
+
+    def __init__(self, search_engine, candidate_pool: int = DEFAULT_CANDIDATE_POOL):
+        self.search_engine = search_engine
+        self.candidate_pool = candidate_pool
+        self._prefix = ""
+        self._corrected_prefix = ""
+        self._candidates: List[Dict[str, str]] = []
+        self._complete = False
+        self._fuzzy = True
+        self.stats = {"keystrokes": 0, "local": 0, "backend": 0}
+
+    def reset(self):
+        """Забыть кандидатов (например, пользователь очистил поле ввода)."""
+        self._prefix = ""
+        self._corrected_prefix = ""
+        self._candidates = []
+
+    def _can_narrow(self, prefix: str, corrected_prefix: str) -> bool:
+        return bool(self._candidates) and prefix.lower().startswith(self._prefix.lower()) \
+            and corrected_prefix.startswith(self._corrected_prefix)
+
+    def search(self, prefix: str, top_k: int = 10) -> SearchResults:
+        """Тот же контракт, что и у search() движка, но с учётом предыдущего нажатия."""
+        self.stats["keystrokes"] += 1
+        corrected_prefix, fuzzy = self.search_engine.correct(prefix)
+        if self._can_narrow(prefix, corrected_prefix):
+            narrowed = self._narrow(corrected_prefix)
+            if self._complete and (len(narrowed) >= top_k or not self._fuzzy):
+                self.stats["local"] += 1
+                self._prefix, self._corrected_prefix, self._candidates = prefix, corrected_prefix, narrowed
+                return SearchResults(narrowed[:top_k])
+
+        self.stats["backend"] += 1
+        # Корректировка этого нажатия уже посчитана - движок её не повторяет
+        candidates = self.search_engine.search(prefix, top_k=max(top_k, self.candidate_pool),
+                                               correction=(corrected_prefix, fuzzy))
+        degraded = getattr(candidates, "degraded", False)
+        if degraded:
+            # Запасной (или пустой) набор не запоминаем - следующее нажатие снова пойдёт в бэкенд
+            self.reset()
+        else:
+            # Пустой ответ тоже не сужается (_can_narrow требует кандидатов)
+            self._prefix, self._corrected_prefix, self._candidates = prefix, corrected_prefix, list(candidates)
+            self._complete = len(candidates) < max(top_k, self.candidate_pool)
+            self._fuzzy = fuzzy
+        return SearchResults(candidates[:top_k], degraded=degraded)
+
+    def _narrow(self, corrected_prefix: str) -> List[Dict[str, str]]:
+        query_tokens = tokenize(corrected_prefix)
+        scored: List[Tuple[float, int, Dict[str, str]]] = []
+        for rank, product in enumerate(self._candidates):
+            score = _match_score(query_tokens, product)
+            if score is not None:
+                scored.append((-score, rank, product))
+        scored.sort(key=lambda item: item[:2])
+        return [product for _, _, product in scored]
+
+
+def replay_keystrokes(search_engine, queries: List[str], top_k: int = 3,
+                      candidate_pool: int = DEFAULT_CANDIDATE_POOL) -> Dict:
+    """
+    Прогоняет каждый запрос как последовательность нажатий в отдельной сессии.
+    Возвращает долю нажатий, отвеченных без OpenSearch, и среднюю задержку нажатия.
+    """
+    totals = {"keystrokes": 0, "local": 0, "backend": 0}
+    elapsed_s = 0.0
+    for query in queries:
+        session = KeystrokeSession(search_engine, candidate_pool=candidate_pool)
+        for length in range(1, len(query) + 1):
+            if not query[:length].strip():
+                continue
+            start_time = time.perf_counter()
+            session.search(query[:length], top_k=top_k)
+            elapsed_s += time.perf_counter() - start_time
+        for name in totals:
+            totals[name] += session.stats[name]
+    keystrokes = totals["keystrokes"]
+    totals["local_share"] = totals["local"] / keystrokes if keystrokes else 0.0
+    totals["mean_ms"] = elapsed_s * 1000 / keystrokes if keystrokes else 0.0
+    return totals
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from benchmark import load_queries
+    from search_engine import ElasticsearchSearchEngine
+
+    parser = argparse.ArgumentParser(description="Повтор запросов по нажатиям через KeystrokeSession")
+    parser.add_argument("--queries", default="data/prefix_queries.csv")
+    parser.add_argument("--candidate-pool", type=int, default=DEFAULT_CANDIDATE_POOL)
+    args = parser.parse_args()
+
+    engine = ElasticsearchSearchEngine()
+    logging.getLogger("search_engine").setLevel(logging.WARNING)
+    result = replay_keystrokes(engine, load_queries(args.queries), candidate_pool=args.candidate_pool)
+    print(f"Нажатий: {result['keystrokes']}, локально: {result['local']} ({result['local_share'] * 100:.1f}%), "
+          f"в OpenSearch: {result['backend']}, средняя задержка {result['mean_ms']:.3f} мс")
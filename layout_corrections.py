@@ -0,0 +1,186 @@
+# layout_corrections.py - алгоритмическое исправление раскладки и транслитерации
+
+from typing import List, Dict, Iterable, Optional
+import logging
+
+from local_search_engine import tokenize, load_catalog_products, INDEXED_FIELDS, MAX_PREFIX_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Соответствие клавиш QWERTY -> ЙЦУКЕН (набрал по-русски в английской раскладке: "xfq" -> "чай")
+_EN_KEYS = "`qwertyuiop[]asdfghjkl;'zxcvbnm,."
+_RU_KEYS = "ёйцукенгшщзхъфывапролджэячсмитьбю"
+EN_TO_RU_LAYOUT = str.maketrans(_EN_KEYS, _RU_KEYS)
+RU_TO_EN_LAYOUT = str.maketrans(_RU_KEYS, _EN_KEYS)
+
+# Транслитерация кириллица -> латиница: основной и альтернативный варианты ("холс" -> "hols"/"khols")
+RU_TO_LATIN_TABLES = [
+    {"а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+     "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+     "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "",
+     "э": "e", "ю": "yu", "я": "ya"},
+    {"х": "kh", "ц": "c", "й": "i", "ю": "ju", "я": "ja", "ж": "j", "щ": "shch", "ы": "i"},
+]
+# Транслитерация латиница -> кириллица: многобуквенные сочетания проверяются раньше одиночных букв
+LATIN_TO_RU_TABLES = [
+    {"shch": "щ", "sch": "щ", "zh": "ж", "kh": "х", "ch": "ч", "sh": "ш", "ts": "ц", "yu": "ю", "ya": "я",
+     "yo": "ё", "ye": "е", "ju": "ю", "ja": "я", "a": "а", "b": "б", "c": "к", "d": "д", "e": "е", "f": "ф",
+     "g": "г", "h": "х", "i": "и", "j": "й", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п",
+     "q": "к", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс", "y": "ы", "z": "з"},
+    {"c": "ц", "y": "й", "e": "э", "i": "й"},
+]
+
+
+def _compile_tables(tables: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Каждая альтернативная таблица дополняется основной, чтобы давать полный вариант."""
+    base = tables[0]
+    return [base] + [dict(base, **alternative) for alternative in tables[1:]]
+
+
+_RU_TO_LATIN = _compile_tables(RU_TO_LATIN_TABLES)
+_LATIN_TO_RU = _compile_tables(LATIN_TO_RU_TABLES)
+
+
+def transliterate(token: str, table: Dict[str, str]) -> str:
+    """Жадная транслитерация: на каждой позиции берётся самое длинное сочетание из таблицы."""
+    max_key = max(len(key) for key in table)
+    parts = []
+    position = 0
+    while position < len(token):
+        for length in range(min(max_key, len(token) - position), 0, -1):
+            chunk = token[position:position + length]
+            if chunk in table:
+                parts.append(table[chunk])
+                position += length
+                break
+        else:
+            parts.append(token[position])
+            position += 1
+    return ''.join(parts)
+
+
+def _is_cyrillic(token: str) -> bool:
+    return any('а' <= char <= 'я' or char == 'ё' for char in token)
+
+
+def generate_candidates(token: str) -> List[str]:
+    """
+    Кандидаты исправления токена по порядку предпочтения:
+    смена раскладки, затем варианты транслитерации. Дубликаты и сам токен исключаются.
+    """
+    if _is_cyrillic(token):
+        candidates = [token.translate(RU_TO_EN_LAYOUT)]
+        candidates += [transliterate(token, table) for table in _RU_TO_LATIN]
+    else:
+        candidates = [token.translate(EN_TO_RU_LAYOUT)]
+        candidates += [transliterate(token, table) for table in _LATIN_TO_RU]
+    return [candidate for candidate in dict.fromkeys(candidates) if candidate and candidate != token]
+
+
+class CatalogVocabulary:
+    """
+    Префиксный индекс словаря каталога: префикс токена -> число токенов каталога с таким префиксом.
+    Проверка кандидата - одно обращение к dict, O(1).
+    """
+
+    def __init__(self, tokens: Iterable[str]):
+        self.prefix_counts: Dict[str, int] = {}
+        for token in tokens:
+            for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1):
+                prefix = token[:length]
+                self.prefix_counts[prefix] = self.prefix_counts.get(prefix, 0) + 1
+        logger.info(f"CatalogVocabulary: {len(self.prefix_counts)} префиксов")
+
+    @classmethod
+    def from_products(cls, products: Iterable[Dict[str, str]]) -> "CatalogVocabulary":
+        return cls(token for product in products for field in INDEXED_FIELDS
+                   for token in tokenize(product.get(field)))
+
+    @classmethod
+    def from_xml(cls, xml_path: str) -> "CatalogVocabulary":
+        return cls.from_products(load_catalog_products(xml_path))
+
+    def count(self, prefix: str) -> int:
+        return self.prefix_counts.get(prefix[:MAX_PREFIX_LENGTH], 0)
+
+
+class LayoutRewriter:
+    """
+    Стадия переписывания запроса перед OpenSearch: токен, которого нет в словаре каталога,
+    заменяется на лучший кандидат смены раскладки/транслитерации, который в словаре есть
+    (лучший - с наибольшим числом токенов каталога с таким префиксом).
+    Токены, уже найденные в словаре, и числа не трогаются.
+    """
+
+    def __init__(self, vocabulary: CatalogVocabulary):
+        self.vocabulary = vocabulary
+
+    def rewrite_token(self, token: str) -> Optional[str]:
+        """Исправленный токен или None, если токен в порядке либо кандидатов нет."""
+        if token.isdigit() or self.vocabulary.count(token):
+            return None
+        best_candidate, best_count = None, 0
+        for candidate in generate_candidates(token):
+            count = self.vocabulary.count(candidate)
+            if count > best_count:
+                best_candidate, best_count = candidate, count
+        return best_candidate
+
+    def rewrite_raw(self, raw_token: str) -> Optional[str]:
+        """
+        Смена раскладки для слова целиком, до tokenize(): клавиши [ ] ; ' , . ` в русской раскладке -
+        буквы х ъ ж э б ю ё, а tokenize() их отбрасывает (",fnfhtqrb" -> "батарейки", "[kt," -> "хлеб").
+        None, если в слове нет таких клавиш, слово уже есть в словаре или после смены его там нет.
+        """
+        tokens = tokenize(raw_token)
+        if tokens == [raw_token] or _is_cyrillic(raw_token) or all(self.vocabulary.count(token) for token in tokens):
+            return None
+        switched = raw_token.translate(EN_TO_RU_LAYOUT)
+        if tokenize(switched) == [switched] and self.vocabulary.count(switched):
+            return switched
+        return None
+
+    def rewrite(self, query: str) -> str:
+        """Переписывает запрос по токенам; если исправлять нечего, возвращает его без изменений."""
+        tokens, rewritten = [], []
+        for raw_token in query.lower().split():
+            switched = self.rewrite_raw(raw_token)
+            if switched is not None:
+                tokens.append(raw_token)
+                rewritten.append(switched)
+                continue
+            for token in tokenize(raw_token):
+                tokens.append(token)
+                rewritten.append(self.rewrite_token(token))
+        if not any(rewritten):
+            return query
+        return ' '.join(new or token for new, token in zip(rewritten, tokens))
+
+
+# Запросы в английской раскладке и ожидаемое исправление (включая буквы на клавишах пунктуации)
+LAYOUT_EXAMPLES = {
+    "vfckj": "масло",
+    ",fnfhtqrb": "батарейки",
+    "[kt,": "хлеб",
+    ";dfxrf": "жвачка",
+    "'ythutnbxtcrbq": "энергетический",
+}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Проверка LayoutRewriter на примерах LAYOUT_EXAMPLES")
+    parser.add_argument("--catalog", default="data/catalog_products.xml")
+    args = parser.parse_args()
+
+    # Слова примеров добавляются к словарю каталога, чтобы проверка не зависела от его ассортимента
+    catalog_tokens = [token for product in load_catalog_products(args.catalog) for field in INDEXED_FIELDS
+                      for token in tokenize(product.get(field))]
+    rewriter = LayoutRewriter(CatalogVocabulary(catalog_tokens + list(LAYOUT_EXAMPLES.values())))
+    failed = 0
+    for query, expected in LAYOUT_EXAMPLES.items():
+        actual = rewriter.rewrite(query)
+        failed += actual != expected
+        print(f"{'OK ' if actual == expected else 'ERR'} {query!r} -> {actual!r} (ожидалось {expected!r})")
+    exit(1 if failed else 0)
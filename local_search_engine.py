@@ -0,0 +1,258 @@
+# local_search_engine.py - in-process префиксный движок без OpenSearch
+
+import xml.etree.ElementTree as ET
+import re
+from bisect import bisect_left
+from typing import List, Dict, Tuple
+import heapq
+import logging
+import time
+
+from corrections import apply_corrections
+
+logger = logging.getLogger(__name__)
+
+# Поля, по которым строится префиксный индекс, и их веса (как буст полей в ранжировании)
+INDEXED_FIELDS = {"name": 3.0, "brand": 2.0, "category": 1.0}
+# Поля, которые возвращаются в результатах (тот же набор, что и _source в ElasticsearchSearchEngine)
+RESULT_FIELDS = ["name", "brand", "category", "price", "url", "store"]
+# Сколько лучших товаров храним в каждом узле префиксного дерева
+PRECOMPUTED_TOP_K = 10
+# Максимальная длина префикса в дереве (аналог max_gram у edge_ngram_filter)
+MAX_PREFIX_LENGTH = 20
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Нормализует строку (нижний регистр) и разбивает её на токены из букв и цифр."""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+
+def load_catalog_products(xml_path: str) -> List[Dict[str, str]]:
+    """
+    Читает товары из XML каталога в список словарей (тег -> текст).
+    Атрибут id у <product>, если он есть, сохраняется в поле 'id'.
+    Путь с расширением .snap читается как колоночный снапшот (catalog_snapshot.py) - без разбора XML;
+    снапшот хранит все теги товара, только пустые теги (None) в нём опущены.
+    """
+    if xml_path.endswith(".snap"):
+        from catalog_snapshot import CatalogSnapshot
+        snapshot = CatalogSnapshot(xml_path)
+        try:
+            return list(snapshot)
+        finally:
+            snapshot.close()
+
+    tree = ET.parse(xml_path)
+    products = []
+    for product_elem in tree.getroot().findall('product'):
+        product_data = {}
+        if product_elem.get('id') is not None:
+            product_data['id'] = product_elem.get('id')
+        for child in product_elem:
+            product_data[child.tag] = child.text
+        products.append(product_data)
+    return products
+
+
+class SnapshotProducts:
+    """Товары снапшота каталога по doc_id (только RESULT_FIELDS), декодируются при обращении."""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self._snapshot)
+
+    def __getitem__(self, doc_id: int) -> Dict[str, str]:
+        product = self._snapshot.product(int(doc_id))
+        return {field: product[field] for field in RESULT_FIELDS if field in product}
+
+
+class _SnapshotStrings:
+    """Отсортированная колонка номеров строк пула как последовательность строк (для bisect)."""
+
+    def __init__(self, snapshot, column: str):
+        self._snapshot = snapshot
+        self._ids = snapshot.column(column)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __getitem__(self, index: int) -> str:
+        return self._snapshot.pool_string(self._ids[index])
+
+
+class _SnapshotPostings:
+    """Постинг-листы токенов из снапшота: [(doc_id, score)] по номеру токена."""
+
+    def __init__(self, snapshot):
+        self._starts = snapshot.column("term_start")
+        self._docs = snapshot.column("posting_doc")
+        self._scores = snapshot.column("posting_score")
+
+    def __getitem__(self, index: int) -> List[Tuple[int, float]]:
+        start, end = self._starts[index], self._starts[index + 1]
+        return list(zip(self._docs[start:end], self._scores[start:end]))
+
+
+class _SnapshotPrefixTop:
+    """Префикс -> топ-K doc_id из снапшота (бинарный поиск по отсортированным префиксам)."""
+
+    def __init__(self, snapshot):
+        self._prefixes = _SnapshotStrings(snapshot, "prefix")
+        self._starts = snapshot.column("prefix_start")
+        self._docs = snapshot.column("prefix_doc")
+
+    def __len__(self) -> int:
+        return len(self._prefixes)
+
+    def get(self, prefix: str, default: Tuple[int, ...] = ()) -> Tuple[int, ...]:
+        index = bisect_left(self._prefixes, prefix)
+        if index == len(self._prefixes) or self._prefixes[index] != prefix:
+            return default
+        return tuple(self._docs[self._starts[index]:self._starts[index + 1]])
+
+
+class LocalPrefixSearchEngine:
+    """
+    Префиксный поиск в памяти процесса с тем же контрактом search(prefix, top_k),
+    что и у ElasticsearchSearchEngine, поэтому его можно передать в run_evaluation.
+
+    Индекс состоит из двух частей:
+      * отсортированный словарь токенов с постинг-листами (поиск диапазона префикса через bisect);
+      * «сплющенное» префиксное дерево: префикс токена -> заранее посчитанный топ-K товаров.
+    Однословные запросы отвечаются одним обращением к словарю, многословные -
+    пересечением кандидатов по каждому токену.
+    """
+
+    def __init__(self, products: List[Dict[str, str]], precomputed_top_k: int = PRECOMPUTED_TOP_K):
+        start_time = time.perf_counter()
+        self.precomputed_top_k = precomputed_top_k
+        # Храним только поля, которые отдаём наружу
+        self._products = [
+            {field: product[field] for field in RESULT_FIELDS if product.get(field) is not None}
+            for product in products
+        ]
+
+        # Лучший вес каждого токена для каждого товара
+        term_scores: Dict[str, Dict[int, float]] = {}
+        for doc_id, product in enumerate(products):
+            for field, weight in INDEXED_FIELDS.items():
+                for position, token in enumerate(tokenize(product.get(field))):
+                    # Небольшой бонус первому слову поля: "йогурт ..." важнее "... йогурт"
+                    score = weight + (0.5 if position == 0 else 0.0)
+                    docs = term_scores.setdefault(token, {})
+                    if score > docs.get(doc_id, 0.0):
+                        docs[doc_id] = score
+
+        self._terms: List[str] = sorted(term_scores)
+        # Постинг-лист токена: [(doc_id, score)], отсортирован по убыванию score
+        self._postings: List[List[Tuple[int, float]]] = [
+            sorted(term_scores[term].items(), key=lambda item: (-item[1], item[0]))
+            for term in self._terms
+        ]
+
+        # Префикс -> топ-K doc_id. Считаем через объединение постингов всех токенов с этим префиксом.
+        prefix_scores: Dict[str, Dict[int, float]] = {}
+        for term, postings in zip(self._terms, self._postings):
+            for length in range(1, min(len(term), MAX_PREFIX_LENGTH) + 1):
+                docs = prefix_scores.setdefault(term[:length], {})
+                for doc_id, score in postings:
+                    if score > docs.get(doc_id, 0.0):
+                        docs[doc_id] = score
+        self._prefix_top: Dict[str, Tuple[int, ...]] = {
+            prefix: tuple(self._top_doc_ids(docs, precomputed_top_k))
+            for prefix, docs in prefix_scores.items()
+        }
+
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        logger.info(
+            f"LocalPrefixSearchEngine: {len(self._products)} товаров, {len(self._terms)} токенов, "
+            f"{len(self._prefix_top)} префиксов, построено за {elapsed_ms:.1f} мс"
+        )
+
+    @classmethod
+    def from_xml(cls, xml_path: str, **kwargs) -> "LocalPrefixSearchEngine":
+        """
+        Строит движок по XML каталога (тот же файл, что грузится в OpenSearch) или по его снапшоту .snap.
+        Если в снапшоте сохранён индекс с тем же precomputed_top_k, движок подключается к нему без перестроения.
+        """
+        if xml_path.endswith(".snap"):
+            from catalog_snapshot import CatalogSnapshot
+            snapshot = CatalogSnapshot(xml_path)
+            if snapshot.has_index and \
+                    snapshot.column("index_top_k")[0] == kwargs.get("precomputed_top_k", PRECOMPUTED_TOP_K):
+                return cls.from_snapshot(snapshot)
+            snapshot.close()
+        return cls(load_catalog_products(xml_path), **kwargs)
+
+    @classmethod
+    def from_snapshot(cls, snapshot) -> "LocalPrefixSearchEngine":
+        """
+        Подключается к индексу, сохранённому в снапшоте (catalog_snapshot.build_catalog_snapshot), через mmap:
+        словарь токенов, постинги, топ-K префиксов и товары читаются из файла при обращении,
+        поэтому старт не зависит от размера каталога. Снапшот остаётся открытым, пока жив движок.
+        """
+        start_time = time.perf_counter()
+        engine = cls.__new__(cls)
+        engine.precomputed_top_k = snapshot.column("index_top_k")[0]
+        engine._products = SnapshotProducts(snapshot)
+        engine._terms = _SnapshotStrings(snapshot, "term")
+        engine._postings = _SnapshotPostings(snapshot)
+        engine._prefix_top = _SnapshotPrefixTop(snapshot)
+        logger.info(
+            f"LocalPrefixSearchEngine: {len(engine._products)} товаров, {len(engine._terms)} токенов, "
+            f"{len(engine._prefix_top)} префиксов из {snapshot.path} за {(time.perf_counter() - start_time) * 1000:.2f} мс"
+        )
+        return engine
+
+    def export_index(self) -> Tuple[List[str], List[List[Tuple[int, float]]], Dict[str, Tuple[int, ...]]]:
+        """Построенный индекс (токены, постинги, топ-K префиксов) для сохранения в снапшот."""
+        return self._terms, self._postings, self._prefix_top
+
+    @staticmethod
+    def _top_doc_ids(doc_scores: Dict[int, float], top_k: int) -> List[int]:
+        """Возвращает top_k doc_id по убыванию score (при равенстве - в порядке каталога)."""
+        best = heapq.nsmallest(top_k, doc_scores.items(), key=lambda item: (-item[1], item[0]))
+        return [doc_id for doc_id, _ in best]
+
+    def _token_candidates(self, token: str) -> Dict[int, float]:
+        """Все товары, у которых есть токен с префиксом token, с лучшим весом совпадения."""
+        candidates: Dict[int, float] = {}
+        index = bisect_left(self._terms, token)
+        while index < len(self._terms) and self._terms[index].startswith(token):
+            for doc_id, score in self._postings[index]:
+                if score > candidates.get(doc_id, 0.0):
+                    candidates[doc_id] = score
+            index += 1
+        return candidates
+
+    def search(self, prefix: str, top_k: int = 10, rewrite: bool = True) -> List[Dict[str, str]]:
+        """
+        Выполняет префиксный поиск в памяти.
+        Применяет Query Rewriting (apply_corrections), как и ElasticsearchSearchEngine.
+        rewrite=False - префикс уже скорректирован (ElasticsearchSearchEngine.correct), повторно не переписывается.
+        Каждый токен запроса должен совпасть с префиксом какого-либо токена name/brand/category.
+        """
+        query_tokens = tokenize(apply_corrections(prefix) if rewrite else prefix)
+        if not query_tokens or top_k <= 0:
+            return []
+
+        if len(query_tokens) == 1 and top_k <= self.precomputed_top_k:
+            # Быстрый путь: готовый топ из префиксного дерева
+            doc_ids = self._prefix_top.get(query_tokens[0], ())[:top_k]
+            if doc_ids or len(query_tokens[0]) <= MAX_PREFIX_LENGTH:
+                return [self._products[doc_id] for doc_id in doc_ids]
+
+        # Общий путь: пересекаем кандидатов по всем токенам, начиная с самого редкого
+        per_token = sorted((self._token_candidates(token) for token in query_tokens), key=len)
+        scores = dict(per_token[0])
+        for candidates in per_token[1:]:
+            scores = {doc_id: score + candidates[doc_id] for doc_id, score in scores.items() if doc_id in candidates}
+            if not scores:
+                return []
+        return [self._products[doc_id] for doc_id in self._top_doc_ids(scores, top_k)]
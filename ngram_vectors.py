@@ -0,0 +1,287 @@
+# ngram_vectors.py - нечёткий второй этап: хэшированные символьные 3-граммы и матричное умножение NumPy
+
+from typing import List, Dict, Iterable, Set, Tuple
+import json
+import logging
+import time
+import zlib
+
+import numpy as np
+
+from corrections import apply_corrections
+from local_search_engine import tokenize, load_catalog_products, RESULT_FIELDS, SnapshotProducts
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+# Размерность хэшированного пространства: 2048 float32 = 8 КБ на товар
+DEFAULT_DIM = 2048
+# Поля товара, из которых строится вектор
+VECTOR_FIELDS = ("name", "brand")
+# Скор - доля n-грамм запроса, найденных у товара (recall). Косинус занижал опечатки в начале
+# короткого слова ниже порога 0.2 ("йогкрт" - 0.198, "йгурт" - 0.162), у recall это 0.4 и 0.5.
+# Ниже порога - «не найдено»
+DEFAULT_MIN_SCORE = 0.35
+# N-граммы запроса, которых нет ни в одном товаре каталога, в вектор не попадают (только в знаменатель
+# recall): иначе они совпадали бы с товарами только через коллизии корзин. Кроме того, второй этап
+# не отвечает на запросы короче MIN_QUERY_NGRAMS настоящих 3-грамм ("м", "мо" - это дело основного движка)
+# и требует у товара не меньше MIN_MATCHED_NGRAMS совпавших n-грамм.
+MIN_QUERY_NGRAMS = 2
+MIN_MATCHED_NGRAMS = 2
+# Вклад косинусной близости в скор: только упорядочивает товары с одинаковым recall (более
+# короткие и точные названия выше) и меньше шага recall (1 / число n-грамм запроса)
+TIE_BREAK_WEIGHT = 0.01
+# Сколько запросов умножается на матрицу за раз (ограничивает память под матрицу скоров batch x N)
+DEFAULT_QUERY_BATCH = 1024
+# Запросы из исходной задачи, которые второй этап обязан спасать (проверка: python ngram_vectors.py --check)
+RESCUE_EXAMPLES = {
+    "кар тофель": "картофель",
+    "йогкрт": "йогурт",
+    "йгурт": "йогурт",
+}
+# Мусорные запросы, на которые второй этап не должен отвечать (та же проверка)
+GARBAGE_EXAMPLES = ("м", "йо", "ъь", "щщщщ", "ыъьэ", "qwerty", "жщцфх", "ьъыьъ ёёё")
+# Суффикс файла словаря n-грамм рядом с матрицей (save/attach)
+VOCABULARY_SUFFIX = ".ngrams.json"
+
+
+def char_ngrams(text: str, prefix_mode: bool = False, n: int = NGRAM_SIZE) -> List[str]:
+    """
+    Символьные n-граммы токенов с маркерами границ слова ("_кар", ..., "ль_").
+    prefix_mode=True (запрос): последний токен считается недописанным и не получает маркер конца,
+    а у многословного запроса добавляются n-граммы слитного написания всех токенов.
+    """
+    tokens = tokenize(text)
+    # Токены с этого индекса - недописанные (без маркера конца)
+    open_from = len(tokens) - 1
+    if prefix_mode and len(tokens) > 1:
+        # Слово, разбитое пробелом ("кар тофель"), должно совпасть и со слитным написанием
+        tokens.append("".join(tokens))
+    ngrams = []
+    for index, token in enumerate(tokens):
+        marked = "_" + token
+        if not (prefix_mode and index >= open_from):
+            marked += "_"
+        if len(marked) < n:
+            ngrams.append(marked)
+            continue
+        ngrams.extend(marked[start:start + n] for start in range(len(marked) - n + 1))
+    return ngrams
+
+
+def _bucket(ngram: str, dim: int) -> int:
+    # crc32 стабилен между процессами (в отличие от hash() с рандомизацией)
+    return zlib.crc32(ngram.encode('utf-8')) % dim
+
+
+def vectorize(texts: Iterable[str], dim: int = DEFAULT_DIM, prefix_mode: bool = False) -> np.ndarray:
+    """Матрица (len(texts), dim) float32: счётчики хэшированных n-грамм, нормированные по L2."""
+    texts = list(texts)
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for ngram in char_ngrams(text, prefix_mode):
+            matrix[row, _bucket(ngram, dim)] += 1.0
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def product_matrix(texts: Iterable[str], dim: int = DEFAULT_DIM) -> np.ndarray:
+    """
+    Матрица товаров: 1 в корзинах их n-грамм плюс TIE_BREAK_WEIGHT * L2-вектор. Умножение на
+    вектор запроса (счётчики n-грамм / их число, см. NgramVectorIndex._query_vectors) даёт recall
+    n-грамм запроса плюс малую добавку, пропорциональную косинусу.
+    """
+    matrix = vectorize(texts, dim)
+    matrix *= TIE_BREAK_WEIGHT
+    matrix[matrix > 0] += 1.0
+    return matrix
+
+
+class NgramVectorIndex:
+    """
+    Каталог как одна непрерывная матрица float32 (товары x dim, см. product_matrix). Пачка префиксов
+    отвечается одним умножением матриц и argpartition по каждой строке - без цикла Python по товарам.
+    Контракт search()/msearch() тот же, что у остальных движков, поэтому индекс можно передать
+    в run_evaluation (с batch_size > 0 - пачками через msearch).
+    query_batch - сколько запросов умножается на матрицу за раз: матрица скоров query_batch x N float32
+    (1024 запроса при 1M товаров - около 4 ГБ).
+    """
+
+    def __init__(self, products: List[Dict[str, str]], dim: int = DEFAULT_DIM, min_score: float = DEFAULT_MIN_SCORE,
+                 query_batch: int = DEFAULT_QUERY_BATCH):
+        start_time = time.perf_counter()
+        self.dim = dim
+        self.min_score = min_score
+        self.query_batch = query_batch
+        self._products = [
+            {field: product[field] for field in RESULT_FIELDS if product.get(field) is not None}
+            for product in products
+        ]
+        texts = [" ".join(product.get(field) or "" for field in VECTOR_FIELDS) for product in products]
+        self.vocabulary: Set[str] = {ngram for text in texts for ngram in char_ngrams(text)}
+        self.matrix = np.ascontiguousarray(product_matrix(texts, dim))
+        logger.info(f"NgramVectorIndex: {len(self._products)} товаров x {dim}, "
+                    f"{self.matrix.nbytes / 2**20:.1f} МБ, построено за {(time.perf_counter() - start_time) * 1000:.1f} мс")
+
+    @classmethod
+    def from_xml(cls, xml_path: str, **kwargs) -> "NgramVectorIndex":
+        """Строит индекс по XML каталога или его снапшоту .snap."""
+        return cls(load_catalog_products(xml_path), **kwargs)
+
+    def save(self, matrix_path: str):
+        """Сохраняет матрицу в .npy и словарь n-грамм рядом, чтобы другие процессы подключались через attach()."""
+        np.save(matrix_path, self.matrix)
+        with open(matrix_path + VOCABULARY_SUFFIX, 'w', encoding='utf-8') as f:
+            json.dump(sorted(self.vocabulary), f, ensure_ascii=False)
+
+    @classmethod
+    def attach(cls, matrix_path: str, snapshot_path: str, min_score: float = DEFAULT_MIN_SCORE,
+               query_batch: int = DEFAULT_QUERY_BATCH) -> "NgramVectorIndex":
+        """
+        Подключается к готовому индексу без копирования: матрица и снапшот каталога открываются
+        через mmap, страницы берутся из общего page cache всех процессов.
+        Строки матрицы должны идти в порядке товаров снапшота (индекс построен по этому снапшоту).
+        """
+        from catalog_snapshot import CatalogSnapshot
+
+        index = cls.__new__(cls)
+        index.min_score = min_score
+        index.query_batch = query_batch
+        index.matrix = np.load(matrix_path, mmap_mode='r')
+        index.dim = index.matrix.shape[1]
+        with open(matrix_path + VOCABULARY_SUFFIX, 'r', encoding='utf-8') as f:
+            index.vocabulary = set(json.load(f))
+        index._products = SnapshotProducts(CatalogSnapshot(snapshot_path))
+        if len(index._products) != index.matrix.shape[0]:
+            raise ValueError(f"{matrix_path}: {index.matrix.shape[0]} строк, а в {snapshot_path} "
+                             f"{len(index._products)} товаров")
+        return index
+
+    def _query_vectors(self, prefixes: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Векторы запросов (счётчики n-грамм из словаря каталога, делённые на число всех n-грамм запроса)
+        и порог скора для каждого: не ниже min_score и MIN_MATCHED_NGRAMS совпадений, inf - не отвечать.
+        """
+        queries = np.zeros((len(prefixes), self.dim), dtype=np.float32)
+        thresholds = np.full(len(prefixes), np.inf, dtype=np.float32)
+        for row, prefix in enumerate(prefixes):
+            ngrams = char_ngrams(apply_corrections(prefix), prefix_mode=True)
+            if sum(len(ngram) == NGRAM_SIZE for ngram in ngrams) < MIN_QUERY_NGRAMS:
+                continue
+            for ngram in ngrams:
+                if ngram in self.vocabulary:
+                    queries[row, _bucket(ngram, self.dim)] += 1.0 / len(ngrams)
+            # Погрешность float32: 2/5 не должно оказаться чуть ниже порога 0.4
+            thresholds[row] = max(self.min_score, MIN_MATCHED_NGRAMS / len(ngrams)) - 1e-6
+        return queries, thresholds
+
+    def search_batch(self, prefixes: List[str], top_k: int = 10) -> List[List[Dict[str, str]]]:
+        """Топ-K товаров по доле найденных n-грамм префикса для каждого префикса (в порядке prefixes)."""
+        if not prefixes or top_k <= 0 or not self._products:
+            return [[] for _ in prefixes]
+        top_k = min(top_k, len(self._products))
+        results = []
+        for start in range(0, len(prefixes), self.query_batch):
+            queries, thresholds = self._query_vectors(prefixes[start:start + self.query_batch])
+            scores = queries @ self.matrix.T
+            # argpartition выбирает top_k за O(N), сортируются только они
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind='stable')
+            ranked = np.take_along_axis(candidates, order, axis=1)
+            ranked_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            for row_ids, row_scores, threshold in zip(ranked, ranked_scores, thresholds):
+                results.append([self._products[doc_id] for doc_id, score in zip(row_ids, row_scores)
+                                if score >= threshold])
+        return results
+
+    def msearch(self, prefixes: List[str], top_k: int = 10) -> List[List[Dict[str, str]]]:
+        return self.search_batch(prefixes, top_k)
+
+    def search(self, prefix: str, top_k: int = 10) -> List[Dict[str, str]]:
+        return self.search_batch([prefix], top_k)[0]
+
+
+class TwoStageSearchEngine:
+    """
+    Основной движок + NgramVectorIndex вторым этапом: если основной вернул меньше min_results
+    товаров (опечатка, слова разбиты пробелом: "кар тофель"), выдача берётся из векторного индекса.
+    В msearch второй этап выполняется одной пачкой для всех пустых ответов.
+    """
+
+    def __init__(self, primary_engine, vector_index: NgramVectorIndex, min_results: int = 1):
+        self.primary_engine = primary_engine
+        self.vector_index = vector_index
+        self.min_results = min_results
+        self.rescued = 0
+
+    def search(self, prefix: str, top_k: int = 10) -> List[Dict[str, str]]:
+        products = self.primary_engine.search(prefix, top_k=top_k)
+        if len(products) >= self.min_results:
+            return products
+        rescued = self.vector_index.search(prefix, top_k)
+        self.rescued += bool(rescued)
+        return rescued or products
+
+    def msearch(self, prefixes: List[str], top_k: int = 10) -> List[List[Dict[str, str]]]:
+        if hasattr(self.primary_engine, 'msearch'):
+            batch_results = self.primary_engine.msearch(prefixes, top_k=top_k)
+        else:
+            batch_results = [self.primary_engine.search(prefix, top_k=top_k) for prefix in prefixes]
+        misses = [index for index, products in enumerate(batch_results) if len(products) < self.min_results]
+        if misses:
+            for index, rescued in zip(misses, self.vector_index.search_batch([prefixes[i] for i in misses], top_k)):
+                if rescued:
+                    batch_results[index] = rescued
+                    self.rescued += 1
+        return batch_results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from search_engine import run_evaluation
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Оценка векторного поиска по символьным 3-граммам")
+    parser.add_argument("--catalog", default="data/catalog_products.xml", help="XML каталога (или снапшот .snap)")
+    parser.add_argument("--queries", default="data/prefix_queries.csv")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_QUERY_BATCH,
+                        help="Запросов в одном умножении матриц (и в одном msearch run_evaluation)")
+    parser.add_argument("--two-stage", choices=["", "opensearch", "local"], default="",
+                        help="Использовать как второй этап после основного движка")
+    parser.add_argument("--output", default="reports/ngram_evaluation_results_v2.csv")
+    parser.add_argument("--check", action="store_true",
+                        help="Только проверить, что RESCUE_EXAMPLES спасаются, а GARBAGE_EXAMPLES остаются без ответа")
+    args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error("--batch-size должен быть больше нуля")
+
+    catalog_products = load_catalog_products(args.catalog)
+    if args.check:
+        # Товары примеров добавляются к каталогу, чтобы проверка не зависела от его ассортимента
+        index = NgramVectorIndex(catalog_products + [{"name": f"{word.capitalize()} (пример)"}
+                                                     for word in RESCUE_EXAMPLES.values()], dim=args.dim)
+        failed = 0
+        for query, expected in RESCUE_EXAMPLES.items():
+            top = index.search(query, top_k=1)
+            actual = top[0]["name"] if top else ""
+            ok = expected in actual.lower()
+            failed += not ok
+            print(f"{'OK ' if ok else 'ERR'} {query!r} -> {actual!r} (ожидалось {expected!r})")
+        for query, top in zip(GARBAGE_EXAMPLES, index.search_batch(list(GARBAGE_EXAMPLES), top_k=1)):
+            failed += bool(top)
+            print(f"{'ERR' if top else 'OK '} {query!r} -> {top[0]['name'] if top else ''!r} (ожидался пустой ответ)")
+        exit(1 if failed else 0)
+    engine = NgramVectorIndex(catalog_products, dim=args.dim, query_batch=args.batch_size)
+    if args.two_stage == "local":
+        from local_search_engine import LocalPrefixSearchEngine
+        engine = TwoStageSearchEngine(LocalPrefixSearchEngine(catalog_products), engine)
+    elif args.two_stage == "opensearch":
+        from search_engine import ElasticsearchSearchEngine
+        engine = TwoStageSearchEngine(ElasticsearchSearchEngine(), engine)
+    run_evaluation(engine, args.queries, args.output, batch_size=args.batch_size)
+    if isinstance(engine, TwoStageSearchEngine):
+        logger.info(f"Второй этап ответил на {engine.rescued} запросов")
@@ -0,0 +1,190 @@
+# parallel_evaluation.py - многопроцессная оценка по общему (mmap) локальному индексу
+
+import os
+
+# Каждый процесс считает своё умножение матриц: потоки BLAS внутри процессов только мешали бы друг другу.
+# Должно быть выставлено до импорта numpy.
+for _variable in ("OPENBLAS_NUM_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_variable, "1")
+
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+import csv
+import logging
+import math
+import shutil
+import tempfile
+import time
+
+from catalog_snapshot import build_catalog_snapshot, CatalogSnapshot, SNAPSHOT_SUFFIX
+from local_search_engine import LocalPrefixSearchEngine, load_catalog_products
+from ngram_vectors import NgramVectorIndex, DEFAULT_DIM, DEFAULT_MIN_SCORE, DEFAULT_QUERY_BATCH
+from search_engine import run_evaluation, EVALUATION_FIELDNAMES
+
+logger = logging.getLogger(__name__)
+
+MATRIX_FILE = "ngram_matrix.npy"
+SNAPSHOT_FILE = "catalog" + SNAPSHOT_SUFFIX
+# Шардов на процесс: мелкие шарды выравнивают нагрузку, если процессы работают с разной скоростью
+SHARDS_PER_PROCESS = 4
+# Оцениваемые движки: local - LocalPrefixSearchEngine по индексу из снапшота, ngram - NgramVectorIndex
+ENGINES = {"local": LocalPrefixSearchEngine, "ngram": NgramVectorIndex}
+DEFAULT_ENGINE = "local"
+
+# Индекс, подключённый в рабочем процессе (_attach_worker)
+_worker_index = None
+
+
+def build_shared_index(catalog_path: str, index_dir: str, engine: str = DEFAULT_ENGINE,
+                       dim: int = DEFAULT_DIM) -> Tuple[str, Optional[str]]:
+    """
+    Один раз строит индекс в index_dir: снапшот каталога с индексом LocalPrefixSearchEngine
+    (если на входе XML), а для engine="ngram" - ещё матрицу 3-грамм .npy.
+    Возвращает (путь к снапшоту, путь к матрице или None) для _attach_worker.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    if catalog_path.endswith(SNAPSHOT_SUFFIX):
+        snapshot_path = catalog_path
+    else:
+        snapshot_path = os.path.join(index_dir, SNAPSHOT_FILE)
+        build_catalog_snapshot(catalog_path, snapshot_path)
+    if engine == "local":
+        snapshot = CatalogSnapshot(snapshot_path)
+        if not snapshot.has_index:
+            logger.warning(f"В {snapshot_path} нет индекса LocalPrefixSearchEngine - каждый процесс построит "
+                           f"его сам; пересоберите снапшот без --no-index")
+        snapshot.close()
+        return snapshot_path, None
+    # Матрица строится по снапшоту, чтобы номер строки совпадал с номером товара в нём
+    matrix_path = os.path.join(index_dir, MATRIX_FILE)
+    NgramVectorIndex(load_catalog_products(snapshot_path), dim=dim).save(matrix_path)
+    return snapshot_path, matrix_path
+
+
+def _attach_worker(engine: str, snapshot_path: str, matrix_path: Optional[str], min_score: float):
+    global _worker_index
+    logging.getLogger("search_engine").setLevel(logging.WARNING)
+    logging.getLogger("local_search_engine").setLevel(logging.WARNING)
+    if engine == "local":
+        _worker_index = LocalPrefixSearchEngine.from_xml(snapshot_path)
+    else:
+        _worker_index = NgramVectorIndex.attach(matrix_path, snapshot_path, min_score=min_score)
+
+
+def _evaluate_shard(task: Tuple[str, str, int]) -> str:
+    shard_input, shard_output, batch_size = task
+    run_evaluation(_worker_index, shard_input, shard_output, batch_size=batch_size)
+    return shard_output
+
+
+def _write_shards(queries_csv_path: str, shard_dir: str, shard_count: int) -> List[str]:
+    """Режет CSV запросов на shard_count подряд идущих кусков (порядок строк сохраняется при слиянии)."""
+    with open(queries_csv_path, 'r', encoding='utf-8') as f_in:
+        reader = csv.DictReader(f_in)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    shard_size = max(1, math.ceil(len(rows) / shard_count))
+    shard_paths = []
+    for start in range(0, len(rows), shard_size):
+        shard_path = os.path.join(shard_dir, f"queries_{len(shard_paths):04d}.csv")
+        with open(shard_path, 'w', newline='', encoding='utf-8') as f_out:
+            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows[start:start + shard_size])
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+def _merge_reports(shard_outputs: List[str], output_csv_path: str, fieldnames: List[str]):
+    """
+    Склеивает отчёты шардов в один: заголовок из первого, у остальных он пропускается.
+    Без шардов (пустой CSV запросов) пишется только заголовок fieldnames.
+    """
+    with open(output_csv_path, 'w', newline='', encoding='utf-8') as f_out:
+        if not shard_outputs:
+            csv.DictWriter(f_out, fieldnames=fieldnames).writeheader()
+        for index, shard_output in enumerate(shard_outputs):
+            with open(shard_output, 'r', newline='', encoding='utf-8') as f_in:
+                header = f_in.readline()
+                if index == 0:
+                    f_out.write(header)
+                shutil.copyfileobj(f_in, f_out)
+
+
+def run_parallel_evaluation(catalog_path: str, queries_csv_path: str, output_csv_path: str, processes: int = 0,
+                            engine: str = DEFAULT_ENGINE, batch_size: int = DEFAULT_QUERY_BATCH,
+                            dim: int = DEFAULT_DIM, min_score: float = DEFAULT_MIN_SCORE,
+                            index_dir: Optional[str] = None) -> Dict[str, float]:
+    """
+    Оценка локального движка (engine: LocalPrefixSearchEngine или NgramVectorIndex) в processes
+    процессах (0 - по числу ядер) без GIL-узкого места. Индекс строится один раз (в index_dir или
+    во временном каталоге), процессы подключаются к нему через mmap без копирования: к индексу
+    в снапшоте (LocalPrefixSearchEngine.from_snapshot) или к матрице 3-грамм (NgramVectorIndex.attach).
+    CSV запросов режется на шарды, каждый шард оценивается обычным run_evaluation, а отчёты
+    склеиваются в output_csv_path в исходном порядке - формат тот же, что у run_evaluation.
+    Возвращает сводку: число запросов, время, пропускную способность.
+    """
+    processes = processes or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(prefix="parallel_evaluation_") as work_dir:
+        build_start = time.perf_counter()
+        snapshot_path, matrix_path = build_shared_index(catalog_path, index_dir or work_dir, engine, dim)
+        build_s = time.perf_counter() - build_start
+
+        shard_inputs = _write_shards(queries_csv_path, work_dir, processes * SHARDS_PER_PROCESS)
+        tasks = [(shard_input, os.path.splitext(shard_input)[0] + "_report.csv", batch_size)
+                 for shard_input in shard_inputs]
+        logger.info(f"Индекс построен за {build_s:.2f} с, {len(tasks)} шардов на {processes} процессов")
+
+        start_time = time.perf_counter()
+        with Pool(processes, initializer=_attach_worker,
+                  initargs=(engine, snapshot_path, matrix_path, min_score)) as pool:
+            # map сохраняет порядок шардов, значит и порядок строк отчёта
+            shard_outputs = pool.map(_evaluate_shard, tasks, chunksize=1)
+        wall_time_s = time.perf_counter() - start_time
+        # Те же колонки, что run_evaluation пишет для этого движка
+        batch_mode = batch_size > 0 and hasattr(ENGINES[engine], 'msearch')
+        _merge_reports(shard_outputs, output_csv_path,
+                       EVALUATION_FIELDNAMES + (['batch_latency_ms'] if batch_mode else []))
+
+    with open(output_csv_path, 'r', encoding='utf-8') as f:
+        queries = sum(1 for _ in csv.DictReader(f))
+    summary = {
+        'engine': engine,
+        'processes': processes,
+        'queries': queries,
+        'build_s': build_s,
+        'wall_time_s': wall_time_s,
+        'throughput_qps': queries / wall_time_s if wall_time_s > 0 else 0.0,
+    }
+    logger.info(f"Параллельная оценка завершена: {queries} запросов за {wall_time_s:.2f} с на {processes} процессах, "
+                f"{summary['throughput_qps']:.1f} QPS. Результаты записаны в {output_csv_path}")
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Многопроцессная оценка локального движка по общему mmap-индексу")
+    parser.add_argument("--catalog", default="data/catalog_products.xml", help="XML каталога (или снапшот .snap)")
+    parser.add_argument("--queries", default="data/prefix_queries.csv")
+    parser.add_argument("--output", default="reports/parallel_evaluation_results_v2.csv")
+    parser.add_argument("--processes", type=int, nargs="+", default=[0],
+                        help="Число процессов (0 - по числу ядер); несколько значений - замер масштабирования")
+    parser.add_argument("--engine", choices=list(ENGINES), default=DEFAULT_ENGINE,
+                        help="local - LocalPrefixSearchEngine, ngram - NgramVectorIndex")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_QUERY_BATCH)
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    parser.add_argument("--index-dir", default=None, help="Куда сохранить индекс (по умолчанию - временный каталог)")
+    args = parser.parse_args()
+
+    summaries = [run_parallel_evaluation(args.catalog, args.queries, args.output, processes=processes,
+                                         engine=args.engine, batch_size=args.batch_size, dim=args.dim, index_dir=args.index_dir)
+                 for processes in args.processes]
+    if len(summaries) > 1:
+        base_qps = summaries[0]['throughput_qps']
+        print(f"{'процессов':>10} {'запросов':>10} {'время, с':>10} {'QPS':>12} {'ускорение':>10}")
+        for summary in summaries:
+            speedup = summary['throughput_qps'] / base_qps if base_qps else 0.0
+            print(f"{summary['processes']:>10} {summary['queries']:>10} {summary['wall_time_s']:>10.2f} "
+                  f"{summary['throughput_qps']:>12.1f} {speedup:>10.2f}")
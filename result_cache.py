@@ -0,0 +1,142 @@
+# result_cache.py - кэш результатов префиксного поиска (LRU + TTL)
+
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional, Callable
+import logging
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 10000 # Ограничение по числу ключей (prefix, top_k)
+DEFAULT_TTL_SECONDS = 300.0
+
+# Подписчики на событие «каталог перезагружен» (см. invalidate_all_caches).
+# Методы объектов храним через WeakMethod, чтобы регистрация не удерживала кэш в памяти.
+_invalidation_listeners: List[Callable[[], Optional[Callable[[], None]]]] = []
+_listeners_lock = threading.Lock()
+
+
+def register_invalidation_listener(listener: Callable[[], None]) -> None:
+    """Регистрирует функцию, которая вызывается после перезагрузки каталога."""
+    if hasattr(listener, '__self__'):
+        reference = weakref.WeakMethod(listener)
+    else:
+        reference = lambda: listener
+    with _listeners_lock:
+        _invalidation_listeners.append(reference)
+
+
+def invalidate_all_caches() -> None:
+    """
+    Хук инвалидации: вызывается из setup_elasticsearch.load_catalog_to_opensearch после
+    успешной загрузки, чтобы после обновления каталога не отдавались устаревшие результаты.
+    Действует только в процессе загрузчика; обслуживающие процессы замечают обновление
+    по смене версии каталога в OpenSearch (PrefixResultCache.set_source).
+    """
+    with _listeners_lock:
+        listeners = [reference() for reference in _invalidation_listeners]
+        listeners = [listener for listener in listeners if listener is not None]
+        _invalidation_listeners[:] = [reference for reference in _invalidation_listeners if reference() is not None]
+    for listener in listeners:
+        listener()
+    logger.info(f"Кэши результатов поиска сброшены ({len(listeners)} шт.)")
+
+
+class PrefixResultCache:
+    """
+    Потокобезопасный кэш результатов search() с ключом (apply_corrections(prefix), top_k, store).
+    Вытеснение: LRU при превышении max_entries и TTL для каждой записи.
+    Счётчики hits/misses/evictions/expirations/stale_puts доступны через stats().
+    generation растёт при каждом clear(): вызывающий запоминает его до запроса в бэкенд и передаёт
+    в put(), чтобы ответ, полученный до инвалидации, не попал в кэш после неё.
+    set_source() сообщает версию каталога, из которой берутся результаты (индекс за алиасом и его
+    catalog_version): при её смене (каталог обновлён другим процессом) кэш сбрасывается.
+    Товары копируются при put() и get(), поэтому изменения на стороне вызывающего кэш не портят.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, int, Optional[str]], Tuple[float, Tuple[Dict[str, str], ...]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_puts = 0
+        self.generation = 0
+        self._source: Optional[str] = None
+        register_invalidation_listener(self.clear)
+
+    def get(self, corrected_prefix: str, top_k: int, store: Optional[str] = None) -> Optional[List[Dict[str, str]]]:
+        """
+        Возвращает результаты из кэша или None, если ключа нет или запись устарела.
+        store - магазин, если поиск был ограничен одним магазином (None - весь каталог).
+        """
+        key = (corrected_prefix, top_k, store)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, products = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [dict(product) for product in products]
+
+    def put(self, corrected_prefix: str, top_k: int, products: List[Dict[str, str]],
+            store: Optional[str] = None, generation: Optional[int] = None) -> None:
+        """
+        Сохраняет результаты; при переполнении вытесняет давно не использованные записи.
+        generation - значение self.generation до запроса в бэкенд; если с тех пор кэш сбрасывался,
+        результаты устарели и не сохраняются.
+        """
+        key = (corrected_prefix, top_k, store)
+        entry = (time.monotonic() + self.ttl_seconds, tuple(dict(product) for product in products))
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                self.stale_puts += 1
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_source(self, source: str) -> None:
+        """Текущий источник результатов (версия каталога); при смене источника кэш сбрасывается."""
+        with self._lock:
+            changed = self._source is not None and source != self._source
+            self._source = source
+            if changed:
+                self._entries.clear()
+                self.generation += 1
+        if changed:
+            logger.info(f"Версия каталога сменилась на '{source}' - кэш результатов сброшен")
+
+    def clear(self) -> None:
+        """Полностью очищает кэш (счётчики сохраняются) и начинает новое поколение."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Снимок счётчиков кэша."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'stale_puts': self.stale_puts,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
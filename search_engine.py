@@ -3,14 +3,23 @@
 import xml.etree.ElementTree as ET
 # import pandas as pd # Не используется
 import re
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 import logging
 import requests # Импортируем requests для Elasticsearch/OpenSearch
 import time
 import csv # Импортируем csv для run_evaluation
+import json # Для NDJSON-тела _msearch
+import random
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Импортируем наш словарь корректировок
+from benchmark import percentile
 from corrections import apply_corrections
+from result_cache import PrefixResultCache
+from search_metrics import SearchMetrics
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,138 +28,993 @@ logger = logging.getLogger(__name__)
 # Конфигурация OpenSearch (используем тот же хост, что и для v1, но теперь для v2)
 OPENSEARCH_HOST = "http://localhost:9200" # Убедимся, что это localhost
 OPENSEARCH_INDEX_NAME = "catalog_products" # Имя индекса из setup_elasticsearch.py
+# Маппинг подполей autocomplete, под который строится запрос (setup_elasticsearch.MAPPING_MODES)
+DEFAULT_MAPPING_MODE = "keyword_edge_ngram"
+
+# Пул keep-alive соединений к OpenSearch (на один движок)
+HTTP_POOL_SIZE = 10
+# Размер батча _msearch по умолчанию для run_evaluation(batch_size=...)
+DEFAULT_MSEARCH_BATCH_SIZE = 50
+# Поля, которые возвращаются из _source
+SOURCE_FIELDS = ["name", "brand", "category", "price", "url", "store"]
+# Доля запросов, которые логируются целиком (структурированный JSON), и порог «медленного» запроса
+LOG_SAMPLE_RATE = 0.01
+SLOW_QUERY_LOG_MS = 200.0
+# Дедлайн одного вызова OpenSearch (connect/read timeout и общее ожидание с учётом hedge-запроса)
+DEFAULT_REQUEST_TIMEOUT_MS = 1000.0
+# Hedged requests: дублирующий запрос отправляется, если ответа нет дольше p95 сетевой задержки.
+# Пока замеров меньше HEDGE_MIN_SAMPLES, используется DEFAULT_HEDGE_DELAY_MS.
+DEFAULT_HEDGE_DELAY_MS = 50.0
+HEDGE_PERCENTILE = 0.95
+HEDGE_WINDOW = 512
+HEDGE_MIN_SAMPLES = 32
+# Как часто фоновый поток движка сверяет версию каталога (индекс за алиасом и _meta.catalog_version его маппинга):
+# каталог может перезагрузить или обновить delta-режимом другой процесс (setup_elasticsearch.py),
+# и тогда кэш результатов этого процесса устарел. search() сам в OpenSearch за версией не ходит.
+INDEX_CHECK_INTERVAL_S = 5.0
+
+# Режим stored search template: тело запроса хранится в OpenSearch (_scripts/<id>), клиент шлёт {id, params}.
+# Ответ урезается: без _index/_id/_score и подсчёта total - doc values строковых полей и TEMPLATE_SOURCE_FIELDS.
+SEARCH_TEMPLATE_ID_PREFIX = "prefix_search"
+# Поле с doc values -> имя поля в результате (как в _source).
+# Подполя .keyword - с ignore_above 256: более длинное значение в doc values не попадает,
+# и в режиме шаблона такого поля (например, очень длинного name) в товаре нет.
+DOCVALUE_FIELDS = {
+    "name.keyword": "name",
+    "brand.keyword": "brand",
+    "category.keyword": "category",
+    "url": "url",
+    "store": "store",
+}
+# Поля, которые и в режиме шаблона берутся из _source: doc value price - double (89.9 вместо "89.90")
+TEMPLATE_SOURCE_FIELDS = ["price"]
+TEMPLATE_FILTER_PATH = "took,hits.hits.fields,hits.hits._source"
+TEMPLATE_MSEARCH_FILTER_PATH = "responses.hits.hits.fields,responses.hits.hits._source,responses.error"
+_PREFIX_PLACEHOLDER = "__prefix__"
+_SIZE_PLACEHOLDER = "__size__"
+_STORE_FILTER_PLACEHOLDER = "__store_filter__"
+# Необязательный параметр store шаблона: фильтр по магазину добавляется, только если он передан
+_STORE_FILTER_TEMPLATE = '[{{#store}}{"term":{"store":{{#toJson}}store{{/toJson}}}}{{/store}}]'
+# Сколько магазинов опрашивается параллельно в search_stores (одним _msearch)
+FAN_OUT_MAX_STORES = 64
+# Параметры запроса по умолчанию (перебираются config_sweep.py): fuzziness и prefix_length
+# fuzzy-запроса, бусты полей {"name": 3.0, ...} (пустой словарь - без бустов)
+DEFAULT_QUERY_PARAMS = {"fuzziness": "AUTO", "prefix_length": 1, "boosts": {}}
+
+
+def search_template_id(mapping_mode: str = DEFAULT_MAPPING_MODE, fuzzy: bool = True) -> str:
+    """Имя stored template для маппинга и вида запроса (fuzzy или точный)."""
+    return f"{SEARCH_TEMPLATE_ID_PREFIX}_{mapping_mode}_{'fuzzy' if fuzzy else 'exact'}"
+
+
+def build_search_template_source(mapping_mode: str = DEFAULT_MAPPING_MODE, fuzzy: bool = True) -> str:
+    """
+    Mustache-шаблон того же запроса, что build_query_body, с параметрами prefix, size и store (необязательный)
+    и урезанным ответом (_source: TEMPLATE_SOURCE_FIELDS, track_total_hits: false, docvalue_fields).
+    """
+    body = build_query_body(_PREFIX_PLACEHOLDER, 0, fuzzy, mapping_mode)
+    body["query"]["bool"]["filter"] = _STORE_FILTER_PLACEHOLDER
+    body["query"]["bool"]["minimum_should_match"] = 1
+    body["size"] = _SIZE_PLACEHOLDER
+    body["_source"] = TEMPLATE_SOURCE_FIELDS
+    body["track_total_hits"] = False
+    body["docvalue_fields"] = list(DOCVALUE_FIELDS)
+    source = json.dumps(body, ensure_ascii=False, separators=(',', ':'))
+    # toJson экранирует префикс как JSON-строку (кавычки и обратные слэши в запросе пользователя)
+    return source.replace(json.dumps(_PREFIX_PLACEHOLDER), "{{#toJson}}prefix{{/toJson}}") \
+                 .replace(json.dumps(_SIZE_PLACEHOLDER), "{{size}}") \
+                 .replace(json.dumps(_STORE_FILTER_PLACEHOLDER), _STORE_FILTER_TEMPLATE)
+
+
+def _hit_product(hit: Dict) -> Dict[str, str]:
+    """
+    Товар из хита: _source в обычном режиме; в режиме шаблона - doc values (списки из одного значения)
+    и TEMPLATE_SOURCE_FIELDS из _source.
+    """
+    if 'fields' not in hit:
+        return hit.get('_source', {})
+    product = {DOCVALUE_FIELDS[field]: values[0] for field, values in hit['fields'].items()
+               if field in DOCVALUE_FIELDS and values}
+    product.update(hit.get('_source', {}))
+    return product
+
+
+class SearchResults(list):
+    """
+    Результат search(): обычный список товаров с пометкой degraded.
+    degraded=True - ответ из запасного индекса (или пустой), потому что OpenSearch недоступен,
+    не уложился в дедлайн или разомкнут circuit breaker.
+    """
+
+    def __init__(self, products=(), degraded: bool = False):
+        super().__init__(products)
+        self.degraded = degraded
+
+    @property
+    def status(self) -> str:
+        return "degraded" if self.degraded else "full"
+
+
+def _boosted_fields(fields: List[str], boosts: Dict[str, float]) -> List[str]:
+    """Добавляет ^буст к полю (и его подполям: name.autocomplete, name.autocomplete._2gram) по имени поля."""
+    return [f"{field}^{boosts[field.split('.')[0]]}" if field.split('.')[0] in boosts else field
+            for field in fields]
+
+
+def build_query_body(corrected_prefix: str, top_k: int, fuzzy: bool = True,
+                     mapping_mode: str = DEFAULT_MAPPING_MODE, store: Optional[str] = None,
+                     query_params: Optional[Dict] = None) -> Dict:
+    """
+    Формирует тело запроса к OpenSearch для уже скорректированного префикса.
+    Использует multi_match с разными полями.
+    fuzzy=True - первый multi_match с fuzziness AUTO (самая дорогая форма запроса);
+    fuzzy=False - точный префиксный поиск, когда опечатки уже исправлены на клиенте.
+    mapping_mode - маппинг подполей autocomplete (см. setup_elasticsearch.MAPPING_MODES):
+    для search_as_you_type используется multi_match типа bool_prefix по подполям _2gram/_3gram.
+    store - ограничить выдачу одним магазином (фильтр term, на скоринг не влияет).
+    query_params - переопределение DEFAULT_QUERY_PARAMS (fuzziness, prefix_length, boosts).
+    """
+    params = dict(DEFAULT_QUERY_PARAMS, **(query_params or {}))
+    if mapping_mode == "search_as_you_type":
+        fields = [f"{field}.autocomplete{suffix}" for field in ("name", "brand", "category")
+                  for suffix in ("", "._2gram", "._3gram")]
+        autocomplete_match = {"query": corrected_prefix, "fields": _boosted_fields(fields, params["boosts"]),
+                              "type": "bool_prefix"}
+    else:
+        autocomplete_match = {
+            "query": corrected_prefix,
+            "fields": _boosted_fields(["name.autocomplete", "brand.autocomplete", "category.autocomplete"],
+                                      params["boosts"]),
+            "type": "best_fields", # Ищем лучшие совпадения
+        }
+    if fuzzy:
+        # Поиск с fuzziness для опечаток (на 1 символ)
+        autocomplete_match["fuzziness"] = params["fuzziness"] # AUTO позволяет опечатки
+        autocomplete_match["prefix_length"] = params["prefix_length"] # Минимальная длина префикса для fuzziness
+    body = {
+        "query": {
+            "bool": {
+                "should": [
+                    {"multi_match": autocomplete_match},
+                    # Также ищем по основному анализатору
+                    {
+                        "multi_match": {
+                            "query": corrected_prefix,
+                            "fields": _boosted_fields(["name", "brand", "category"], params["boosts"]),
+                            "type": "best_fields"
+                        }
+                    }
+                ]
+            }
+        },
+        "size": top_k,
+        "_source": SOURCE_FIELDS # Возвращаем только нужные поля
+    }
+    if store is not None:
+        body["query"]["bool"]["filter"] = [{"term": {"store": store}}]
+        # С filter should перестаёт быть обязательным - требуем хотя бы одно совпадение явно
+        body["query"]["bool"]["minimum_should_match"] = 1
+    return body
+
+
+def _source_index_loop(engine_ref, stop: threading.Event):
+    """
+    Фоновая проверка версии каталога движка раз в INDEX_CHECK_INTERVAL_S (первая - сразу).
+    Завершается по close() или когда движок собран сборщиком мусора.
+    """
+    while True:
+        engine = engine_ref()
+        if engine is None:
+            return
+        try:
+            engine._refresh_source_index()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой проверки версии каталога: {e}")
+        del engine
+        if stop.wait(INDEX_CHECK_INTERVAL_S):
+            return
+
 
 class ElasticsearchSearchEngine:
-    def __init__(self):
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, cache: Optional[PrefixResultCache] = None,
+                 metrics: Optional[SearchMetrics] = None, log_sample_rate: float = LOG_SAMPLE_RATE,
+                 layout_rewriter=None, typo_corrector=None, fuzzy_fallback: bool = False,
+                 index_name: str = OPENSEARCH_INDEX_NAME, mapping_mode: str = DEFAULT_MAPPING_MODE,
+                 short_prefix_table=None, request_timeout_ms: float = DEFAULT_REQUEST_TIMEOUT_MS,
+                 hedge: bool = False, hedge_delay_ms: Optional[float] = None,
+                 circuit_breaker=None, fallback_engine=None, use_template: bool = False,
+                 store_routing: bool = False, query_params: Optional[Dict] = None):
         """
         Инициализирует движок поиска, взаимодействуя с OpenSearch.
         Предполагается, что индекс уже создан и заполнен.
+        Все запросы идут через общую requests.Session с пулом keep-alive соединений.
+        cache - необязательный PrefixResultCache; ключ кэша - (скорректированный префикс, top_k, магазин).
+        Фоновый поток раз в INDEX_CHECK_INTERVAL_S сверяет версию каталога (catalog_source) и при её смене
+        сбрасывает кэш; search() на эту проверку не ждёт. Поток останавливает close().
+        metrics - куда пишутся метрики этапов search() (по умолчанию свой SearchMetrics).
+        layout_rewriter - необязательный layout_corrections.LayoutRewriter: после apply_corrections
+        исправляет раскладку/транслитерацию токенов, которых нет в словаре каталога.
+        typo_corrector - необязательный typo_corrections.SymSpellPrefixCorrector: опечатки исправляются
+        на клиенте и в OpenSearch уходит точный префиксный запрос без fuzziness. Если для какого-то
+        токена кандидат не найден, fuzziness включается только по явному fuzzy_fallback=True.
+        index_name/mapping_mode - индекс (или алиас) и его маппинг autocomplete.
+        short_prefix_table - необязательная short_prefix_table.ShortPrefixTable: короткие префиксы
+        отвечаются из memory-mapped таблицы без обращения к OpenSearch, пока версия каталога совпадает
+        с той, из которой таблица построена. Таблицу (как и cache) нужно передавать в конструктор:
+        фоновая проверка версии каталога запускается только в __init__. Таблица, построенная другим
+        конвейером запроса (query_pipeline: корректоры, fuzzy_fallback, маппинг), отклоняется (ValueError).
+        request_timeout_ms - дедлайн вызова OpenSearch по умолчанию (search(..., deadline_ms=...) - на вызов).
+        hedge - отправлять дублирующий запрос, если ответа нет дольше hedge_delay_ms
+        (None - адаптивно, p95 последних сетевых задержек).
+        circuit_breaker - необязательный circuit_breaker.CircuitBreaker; пока он разомкнут,
+        OpenSearch не вызывается.
+        fallback_engine - запасной движок в памяти (например, LocalPrefixSearchEngine), который отвечает
+        при ошибке, таймауте или разомкнутом автомате; такие ответы помечаются degraded. Ему передаётся
+        уже скорректированный префикс с rewrite=False, чтобы правила не применялись второй раз.
+        use_template - слать {id, params} stored search template (setup_elasticsearch.register_search_templates)
+        и получать урезанный ответ (filter_path, doc values) вместо полного тела запроса и hits;
+        name/brand/category длиннее 256 символов в таком ответе нет (ignore_above подполей .keyword).
+        store_routing - индекс разбит по магазинам custom routing (setup_elasticsearch.py --store-routing):
+        search(..., store=...) уходит с routing=<store> на один шард.
+        query_params - fuzziness/prefix_length/boosts запроса (см. DEFAULT_QUERY_PARAMS); шаблоны use_template
+        строятся с параметрами по умолчанию, поэтому query_params действует только без use_template.
         """
         logger.info(f"Инициализация ElasticsearchSearchEngine (для OpenSearch v2), подключение к {OPENSEARCH_HOST}")
+        self.session = requests.Session()
+        self.pool_size = pool_size
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else SearchMetrics()
+        self.log_sample_rate = log_sample_rate
+        self.layout_rewriter = layout_rewriter
+        self.typo_corrector = typo_corrector
+        self.fuzzy_fallback = fuzzy_fallback
+        self.index_name = index_name
+        self.mapping_mode = mapping_mode
+        self.short_prefix_table = short_prefix_table
+        self.request_timeout_ms = request_timeout_ms
+        self.hedge = hedge
+        self.hedge_delay_ms = hedge_delay_ms
+        self.circuit_breaker = circuit_breaker
+        self.fallback_engine = fallback_engine
+        self.use_template = use_template
+        self.store_routing = store_routing
+        self.query_params = query_params
+        self._source_index: Optional[str] = None
+        self._short_prefix_table_current = True
+        self._network_samples = deque(maxlen=HEDGE_WINDOW)
+        # Счётчик всех замеров: длина deque после заполнения окна больше не растёт
+        self._network_sample_count = 0
+        self._adaptive_hedge_delay_ms = DEFAULT_HEDGE_DELAY_MS
+        # Потоки для основного и дублирующего запросов (используются только при hedge=True)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=pool_size * 2, thread_name_prefix="hedge") if hedge else None
+        if short_prefix_table is not None and short_prefix_table.pipeline != self.query_pipeline():
+            raise ValueError(f"Таблица коротких префиксов {short_prefix_table.path} построена конвейером "
+                             f"{short_prefix_table.pipeline or '-'}, а движок - {self.query_pipeline()}: "
+                             f"пересоберите её с теми же --layout-fix/--typo-fix/--fuzzy-fallback/--mapping")
+        self._index_check_stop = threading.Event()
+        if cache is not None or short_prefix_table is not None:
+            # Поток держит только слабую ссылку: движок, который больше не используется, не «залипает» в памяти
+            threading.Thread(target=_source_index_loop, args=(weakref.ref(self), self._index_check_stop),
+                             name="catalog-version", daemon=True).start()
+
+    def close(self):
+        """Останавливает фоновую проверку версии каталога и пулы соединений/потоков движка."""
+        self._index_check_stop.set()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        self.session.close()
+
+    def correct(self, prefix: str) -> Tuple[str, bool]:
+        """
+        Query Rewriting: правила apply_corrections, затем (если заданы) layout_rewriter и typo_corrector.
+        Возвращает (скорректированный префикс, нужен ли fuzzy-запрос).
+        """
+        corrected_prefix = apply_corrections(prefix)
+        if self.layout_rewriter is not None:
+            corrected_prefix = self.layout_rewriter.rewrite(corrected_prefix)
+        if self.typo_corrector is None:
+            return corrected_prefix, True
+        corrected_prefix, resolved = self.typo_corrector.correct(corrected_prefix)
+        return corrected_prefix, self.fuzzy_fallback and not resolved
+
+    def query_pipeline(self) -> str:
+        """
+        Описание конвейера запроса: какие корректоры включены, fuzzy_fallback, маппинг и параметры запроса.
+        Пишется в таблицу коротких префиксов, чтобы её ответы совпадали с ответами search().
+        """
+        return json.dumps({
+            "layout_rewriter": self.layout_rewriter is not None,
+            "typo_corrector": self.typo_corrector is not None,
+            # Без typo_corrector fuzziness включена всегда, и fuzzy_fallback ни на что не влияет
+            "fuzzy_fallback": self.typo_corrector is not None and self.fuzzy_fallback,
+            "mapping": self.mapping_mode,
+            "query_params": dict(DEFAULT_QUERY_PARAMS, **(self.query_params or {})),
+        }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+    def catalog_source(self) -> Optional[str]:
+        """
+        Версия каталога, из которого отвечает index_name: "<физический индекс>@<_meta.catalog_version>"
+        (setup_elasticsearch.set_catalog_version). Меняется при полной перезагрузке (новый индекс за алиасом)
+        и при delta-обновлении. None - OpenSearch не ответил.
+        """
+        try:
+            response = self.session.get(f"{OPENSEARCH_HOST}/{self.index_name}/_mapping",
+                                        timeout=self.request_timeout_ms / 1000)
+            response.raise_for_status()
+            mappings = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"Не удалось получить версию каталога '{self.index_name}': {e}")
+            return None
+        return ",".join(f"{index}@{body.get('mappings', {}).get('_meta', {}).get('catalog_version', '')}"
+                        for index, body in sorted(mappings.items()))
+
+    def _refresh_source_index(self):
+        """
+        Обновляет версию каталога и сообщает её кэшу; таблица коротких префиксов другой версии каталога
+        перестаёт использоваться. Вызывается только из фонового потока (_source_index_loop).
+        """
+        source_index = self.catalog_source()
+        if source_index is None:
+            return
+        self._source_index = source_index
+        if self.cache is not None:
+            self.cache.set_source(source_index)
+        if self.short_prefix_table is not None:
+            table_current = self.short_prefix_table.source == source_index
+            if self._short_prefix_table_current and not table_current:
+                logger.warning(f"Таблица коротких префиксов построена по '{self.short_prefix_table.source}', "
+                               f"а каталог - '{source_index}': таблица не используется до пересборки")
+            self._short_prefix_table_current = table_current
 
-    def search(self, prefix: str, top_k: int = 10) -> List[Dict[str, str]]:
+    def keystroke_session(self, **kwargs):
+        """Новая сессия ввода (keystroke_session.KeystrokeSession): нажатия сужают кандидатов предыдущего."""
+        from keystroke_session import KeystrokeSession
+        return KeystrokeSession(self, **kwargs)
+
+    def search(self, prefix: str, top_k: int = 10, deadline_ms: Optional[float] = None,
+               store: Optional[str] = None, correction: Optional[Tuple[str, bool]] = None) -> SearchResults:
         """
         Выполняет поиск в OpenSearch по префиксу.
         Применяет Query Rewriting.
-        Использует multi_match с разными полями.
-        Попытка использовать fuzziness (может отличаться в OpenSearch).
-        Использует ngram-анализатор для префиксного поиска.
+        Время каждого этапа (корректировка, сериализация, сеть, took OpenSearch, разбор ответа)
+        записывается в self.metrics; в лог попадает только выборка запросов и медленные запросы.
+        deadline_ms - дедлайн вызова OpenSearch (по умолчанию request_timeout_ms). При ошибке, таймауте
+        или разомкнутом circuit breaker возвращается ответ fallback_engine с пометкой degraded.
+        store - искать только в одном магазине (сайте); при store_routing запрос идёт на один шард.
+        correction - уже вычисленный correct(prefix), если вызывающий делал его сам (повторно не считается).
         """
-        logger.info(f"Выполняется OpenSearch-поиск для префикса: '{prefix}'")
+        start_time = time.perf_counter()
         # Применяем корректировку к префиксу
-        corrected_prefix = apply_corrections(prefix)
-        if corrected_prefix != prefix.lower():
-            logger.info(f"Запрос '{prefix}' скорректирован в '{corrected_prefix}'")
+        corrected_prefix, fuzzy = correction if correction is not None else self.correct(prefix)
+        corrected = corrected_prefix != prefix.lower()
+        stage_ms = {"corrections": (time.perf_counter() - start_time) * 1000}
+
+        if self.short_prefix_table is not None and self._short_prefix_table_current and store is None:
+            table_products = self.short_prefix_table.lookup(corrected_prefix, top_k)
+            if table_products is not None:
+                stage_ms["total"] = (time.perf_counter() - start_time) * 1000
+                self.metrics.record(stage_ms, queries=1, corrections_applied=int(corrected),
+                                    zero_results=int(not table_products))
+                return SearchResults(table_products)
+
+        cache_generation = None
+        if self.cache is not None:
+            # Поколение до запроса в бэкенд: если каталог перезагрузят, пока запрос идёт, ответ не закэшируется
+            cache_generation = self.cache.generation
+            cached_products = self.cache.get(corrected_prefix, top_k, store)
+            if cached_products is not None:
+                stage_ms["total"] = (time.perf_counter() - start_time) * 1000
+                self.metrics.record(stage_ms, queries=1, corrections_applied=int(corrected),
+                                    zero_results=int(not cached_products))
+                return SearchResults(cached_products)
+
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            return self._degraded_search(corrected_prefix, top_k, stage_ms, start_time, corrected,
+                                         stores=None if store is None else [store])
 
         # Запрос к OpenSearch
         # Используем скорректированный префикс для поиска
-        query_body = {
-            "query": {
-                "bool": {
-                    "should": [
-                        # Поиск с fuzziness для опечаток (на 1 символ)
-                        {
-                            "multi_match": {
-                                "query": corrected_prefix,
-                                "fields": ["name.autocomplete", "brand.autocomplete", "category.autocomplete"],
-                                "type": "best_fields", # Ищем лучшие совпадения
-                                "fuzziness": "AUTO", # Позволяет опечатки
-                                "prefix_length": 1 # Минимальная длина префикса для fuzziness
-                            }
-                        },
-                        # Также ищем по основному анализатору
-                        {
-                            "multi_match": {
-                                "query": corrected_prefix,
-                                "fields": ["name", "brand", "category"],
-                                "type": "best_fields"
-                            }
-                        }
-                    ]
-                }
-            },
-            "size": top_k,
-            "_source": ["name", "brand", "category", "price", "url", "store"] # Возвращаем только нужные поля
-        }
+        stage_start = time.perf_counter()
+        if self.use_template:
+            query_body = json.dumps({"id": search_template_id(self.mapping_mode, fuzzy),
+                                     "params": self._template_params(corrected_prefix, top_k, store)},
+                                    ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        else:
+            query_body = json.dumps(build_query_body(corrected_prefix, top_k, fuzzy, self.mapping_mode, store,
+                                                     self.query_params),
+                                    ensure_ascii=False).encode('utf-8')
+        stage_ms["serialize"] = (time.perf_counter() - stage_start) * 1000
 
-        search_url = f"{OPENSEARCH_HOST}/{OPENSEARCH_INDEX_NAME}/_search"
+        deadline_s = (deadline_ms if deadline_ms is not None else self.request_timeout_ms) / 1000
         try:
-            response = requests.post(search_url, json=query_body, headers={"Content-Type": "application/json"})
-            response.raise_for_status() # Вызовет исключение, если статус != 200
+            routing = store if self.store_routing else None
+            response, stage_ms["network"] = self._fetch(query_body, deadline_s, routing)
+            self._observe_network(stage_ms["network"])
 
+            stage_start = time.perf_counter()
             results = response.json()
             hits = results.get('hits', {}).get('hits', [])
-            products = [hit.get('_source') for hit in hits]
-            logger.info(f"Найдено {len(products)} результатов для '{prefix}' (используя '{corrected_prefix}')")
-            return products
+            products = [_hit_product(hit) for hit in hits]
+            stage_ms["parse"] = (time.perf_counter() - stage_start) * 1000
+            if 'took' in results:
+                stage_ms["opensearch_took"] = float(results['took'])
+            if self.cache is not None:
+                # Кэшируем только успешные ответы, ошибки не должны «залипать»
+                self.cache.put(corrected_prefix, top_k, products, store, generation=cache_generation)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(True, stage_ms["network"])
+            stage_ms["total"] = (time.perf_counter() - start_time) * 1000
+            self.metrics.record(stage_ms, queries=1, corrections_applied=int(corrected),
+                                zero_results=int(not products), request_bytes=len(query_body),
+                                response_bytes=len(response.content))
+            self._log_query(prefix, corrected_prefix, len(products), stage_ms)
+            return SearchResults(products)
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка при поиске в OpenSearch: {e}")
-            return []
         except Exception as e:
             logger.error(f"Неожиданная ошибка при обработке результата OpenSearch: {e}")
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(False, (time.perf_counter() - start_time) * 1000)
+        return self._degraded_search(corrected_prefix, top_k, stage_ms, start_time, corrected,
+                                     errors=1, stores=None if store is None else [store])
+
+    @staticmethod
+    def _template_params(corrected_prefix: str, top_k: int, store: Optional[str]) -> Dict:
+        params = {"prefix": corrected_prefix, "size": top_k}
+        if store is not None:
+            params["store"] = store
+        return params
+
+    def _post_search(self, query_body: bytes, timeout_s: float,
+                     routing: Optional[str] = None) -> Tuple[requests.Response, float]:
+        """Один POST _search с таймаутом; возвращает (ответ, сетевое время в мс)."""
+        stage_start = time.perf_counter()
+        params = {}
+        if self.use_template:
+            search_url = f"{OPENSEARCH_HOST}/{self.index_name}/_search/template"
+            params["filter_path"] = TEMPLATE_FILTER_PATH
+        else:
+            search_url = f"{OPENSEARCH_HOST}/{self.index_name}/_search"
+        if routing is not None:
+            params["routing"] = routing
+        response = self.session.post(search_url, params=params, data=query_body,
+                                     headers={"Content-Type": "application/json"}, timeout=timeout_s)
+        response.raise_for_status() # Вызовет исключение, если статус != 200
+        return response, (time.perf_counter() - stage_start) * 1000
+
+    def _fetch(self, query_body: bytes, deadline_s: float,
+               routing: Optional[str] = None) -> Tuple[requests.Response, float]:
+        """
+        Вызов OpenSearch в пределах дедлайна. С hedge=True, если основной запрос не ответил
+        за hedge-задержку, отправляется дублирующий и берётся первый успешный ответ.
+        """
+        if self._hedge_executor is None:
+            return self._post_search(query_body, deadline_s, routing)
+
+        start_time = time.perf_counter()
+        primary = self._hedge_executor.submit(self._post_search, query_body, deadline_s, routing)
+        hedge_delay_s = (self.hedge_delay_ms if self.hedge_delay_ms is not None else self._adaptive_hedge_delay_ms) / 1000
+        done, _ = wait([primary], timeout=min(hedge_delay_s, deadline_s))
+        if done:
+            return primary.result()
+
+        pending = {primary}
+        remaining_s = deadline_s - (time.perf_counter() - start_time)
+        # Hedge-задержка не меньше дедлайна: на дублирующий запрос времени не осталось (и timeout <= 0 requests не примет)
+        if remaining_s > 0:
+            pending.add(self._hedge_executor.submit(self._post_search, query_body, remaining_s, routing))
+            self.metrics.record({}, hedged=1)
+        last_error = None
+        while pending:
+            remaining_s = deadline_s - (time.perf_counter() - start_time)
+            done, pending = wait(pending, timeout=max(remaining_s, 0.0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    response, _ = future.result()
+                    # Сетевое время считаем от отправки основного запроса - его видит вызывающий
+                    return response, (time.perf_counter() - start_time) * 1000
+                except requests.exceptions.RequestException as e:
+                    last_error = e
+        raise last_error or requests.exceptions.Timeout(f"Дедлайн {deadline_s * 1000:.0f} мс истёк")
+
+    def _observe_network(self, network_ms: float):
+        """Копит сетевые задержки и раз в HEDGE_MIN_SAMPLES замеров пересчитывает адаптивную hedge-задержку."""
+        if not self.hedge:
+            return
+        self._network_samples.append(network_ms)
+        self._network_sample_count += 1
+        if self._network_sample_count % HEDGE_MIN_SAMPLES == 0:
+            samples = sorted(self._network_samples)
+            self._adaptive_hedge_delay_ms = samples[int(HEDGE_PERCENTILE * (len(samples) - 1))]
+
+    def _fallback_products(self, corrected_prefix: str, top_k: int,
+                           stores: Optional[List[str]] = None) -> List[Dict[str, str]]:
+        """Выдача fallback_engine (пустая, если его нет или он упал); stores - только товары этих магазинов."""
+        if self.fallback_engine is None:
             return []
+        try:
+            if not stores:
+                return self.fallback_engine.search(corrected_prefix, top_k=top_k, rewrite=False)
+            # Запасной движок не умеет фильтровать по магазину - берём с запасом и фильтруем
+            return [product for product in self.fallback_engine.search(corrected_prefix, top_k=top_k * 10,
+                                                                       rewrite=False)
+                    if product.get('store') in stores][:top_k]
+        except Exception as e:
+            logger.error(f"Ошибка запасного движка: {e}")
+            return []
+
+    def _degraded_search(self, corrected_prefix: str, top_k: int, stage_ms: Dict[str, float],
+                         start_time: float, corrected: bool, errors: int = 0,
+                         stores: Optional[List[str]] = None) -> SearchResults:
+        """Ответ запасного движка (или пустой) с пометкой degraded; в кэш не попадает."""
+        products = self._fallback_products(corrected_prefix, top_k, stores)
+        stage_ms["total"] = (time.perf_counter() - start_time) * 1000
+        # Без запасного движка пустой ответ - это ошибка, а не «ничего не найдено»
+        self.metrics.record(stage_ms, queries=1, errors=errors, degraded=1, corrections_applied=int(corrected),
+                            zero_results=int(self.fallback_engine is not None and not products))
+        return SearchResults(products, degraded=True)
+
+    def _log_query(self, prefix: str, corrected_prefix: str, hits: int, stage_ms: Dict[str, float]):
+        """Структурированный лог запроса: доля LOG_SAMPLE_RATE запросов плюс все медленные."""
+        if stage_ms["total"] < SLOW_QUERY_LOG_MS and random.random() >= self.log_sample_rate:
+            return
+        logger.info(json.dumps({
+            "event": "search",
+            "prefix": prefix,
+            "corrected": corrected_prefix,
+            "hits": hits,
+            "stages_ms": {stage: round(value, 3) for stage, value in stage_ms.items()},
+        }, ensure_ascii=False))
+
+    def msearch(self, prefixes: List[str], top_k: int = 10,
+                stores: Optional[List[Optional[str]]] = None) -> List[SearchResults]:
+        """
+        Выполняет пачку префиксных запросов одним вызовом _msearch.
+        Возвращает список SearchResults в том же порядке, что и prefixes.
+        stores - необязательный магазин для каждого префикса (как store в search()).
+        Ошибка отдельного запроса даёт SearchResults(degraded=True) только для него, ошибка всего вызова
+        или разомкнутый circuit breaker - для всех; как и в search(), их выдача берётся из fallback_engine.
+        """
+        if not prefixes:
+            return []
+
+        start_time = time.perf_counter()
+        stores = stores or [None] * len(prefixes)
+        corrected_prefixes = []
+        header_line = json.dumps({"index": self.index_name}, separators=(',', ':'))
+        lines = []
+        corrections_applied = 0
+        for prefix, store in zip(prefixes, stores):
+            if self.store_routing and store is not None:
+                lines.append(json.dumps({"index": self.index_name, "routing": store},
+                                        ensure_ascii=False, separators=(',', ':')))
+            else:
+                lines.append(header_line)
+            corrected_prefix, fuzzy = self.correct(prefix)
+            corrected_prefixes.append(corrected_prefix)
+            corrections_applied += corrected_prefix != prefix.lower()
+            if self.use_template:
+                query_body = {"id": search_template_id(self.mapping_mode, fuzzy),
+                              "params": self._template_params(corrected_prefix, top_k, store)}
+            else:
+                query_body = build_query_body(corrected_prefix, top_k, fuzzy, self.mapping_mode, store,
+                                              self.query_params)
+            lines.append(json.dumps(query_body, ensure_ascii=False, separators=(',', ':')))
+
+        def degraded(index: int) -> SearchResults:
+            store = stores[index]
+            return SearchResults(self._fallback_products(corrected_prefixes[index], top_k,
+                                                         None if store is None else [store]), degraded=True)
+
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            self.metrics.record({}, queries=len(prefixes), degraded=len(prefixes), corrections_applied=corrections_applied)
+            return [degraded(index) for index in range(len(prefixes))]
+        msearch_body = '\n'.join(lines) + '\n' # _msearch требует завершающий \n
+
+        if self.use_template:
+            msearch_url = f"{OPENSEARCH_HOST}/_msearch/template?filter_path={TEMPLATE_MSEARCH_FILTER_PATH}"
+        else:
+            msearch_url = f"{OPENSEARCH_HOST}/_msearch"
+        try:
+            response = self.session.post(msearch_url, data=msearch_body.encode('utf-8'),
+                                         headers={"Content-Type": "application/x-ndjson"},
+                                         # Батч получает один дедлайн request_timeout_ms на каждые 10 запросов
+                                         timeout=self.request_timeout_ms / 1000 * max(1, len(prefixes) // 10))
+            response.raise_for_status()
+            responses = response.json().get('responses', [])
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ошибка при _msearch в OpenSearch: {e}")
+            responses = None
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка при обработке результата _msearch: {e}")
+            responses = None
+        if self.circuit_breaker is not None:
+            # Как и дедлайн, порог медленного вызова масштабируется на каждые 10 запросов батча
+            self.circuit_breaker.record(responses is not None,
+                                        (time.perf_counter() - start_time) * 1000 / max(1, len(prefixes) // 10))
+        if responses is None:
+            self.metrics.record({}, queries=len(prefixes), errors=len(prefixes), degraded=len(prefixes),
+                                corrections_applied=corrections_applied)
+            return [degraded(index) for index in range(len(prefixes))]
+
+        batch_results = []
+        for index, (prefix, item) in enumerate(zip(prefixes, responses)):
+            if 'error' in item:
+                logger.error(f"Ошибка _msearch для префикса '{prefix}': {item['error']}")
+                batch_results.append(degraded(index))
+                continue
+            hits = item.get('hits', {}).get('hits', [])
+            batch_results.append(SearchResults(_hit_product(hit) for hit in hits))
+        # Если OpenSearch вернул меньше ответов, чем запросов, недостающие - как ошибки
+        batch_results.extend(degraded(index) for index in range(len(batch_results), len(prefixes)))
+        item_errors = sum(1 for products in batch_results if products.degraded)
+        self.metrics.record({}, queries=len(prefixes), errors=item_errors, degraded=item_errors,
+                            corrections_applied=corrections_applied,
+                            zero_results=sum(1 for products in batch_results if not products and not products.degraded))
+        return batch_results
+
+    def search_stores(self, prefix: str, stores: List[str], top_k: int = 10) -> SearchResults:
+        """
+        Поиск сразу по нескольким магазинам: по подзапросу с фильтром на магазин (при store_routing -
+        с routing на свой шард) в одном _msearch, который OpenSearch выполняет параллельно.
+        Выдачи сливаются по _score (при равенстве - по позиции в выдаче магазина и порядку stores).
+        При ошибке вызова или разомкнутом circuit breaker - ответ fallback_engine по этим магазинам (degraded).
+        """
+        stores = list(dict.fromkeys(stores))[:FAN_OUT_MAX_STORES]
+        if not stores or top_k <= 0:
+            return SearchResults()
+        start_time = time.perf_counter()
+        corrected_prefix, fuzzy = self.correct(prefix)
+        lines = []
+        for store in stores:
+            header = {"index": self.index_name}
+            if self.store_routing:
+                header["routing"] = store
+            if self.use_template:
+                query_body = {"id": search_template_id(self.mapping_mode, fuzzy),
+                              "params": self._template_params(corrected_prefix, top_k, store)}
+            else:
+                query_body = build_query_body(corrected_prefix, top_k, fuzzy, self.mapping_mode, store,
+                                              self.query_params)
+            lines.append(json.dumps(header, ensure_ascii=False, separators=(',', ':')))
+            lines.append(json.dumps(query_body, ensure_ascii=False, separators=(',', ':')))
+        msearch_body = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        if self.use_template:
+            msearch_url = f"{OPENSEARCH_HOST}/_msearch/template"
+            params = {"filter_path": TEMPLATE_MSEARCH_FILTER_PATH + ",responses.hits.hits._score"}
+        else:
+            msearch_url = f"{OPENSEARCH_HOST}/_msearch"
+            params = {}
+        corrected = corrected_prefix != prefix.lower()
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            return self._degraded_search(corrected_prefix, top_k, {}, start_time, corrected, stores=stores)
+        try:
+            response = self.session.post(msearch_url, params=params, data=msearch_body,
+                                         headers={"Content-Type": "application/x-ndjson"},
+                                         timeout=self.request_timeout_ms / 1000)
+            response.raise_for_status()
+            responses = response.json().get('responses', [])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Ошибка при поиске по магазинам {stores}: {e}")
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(False, (time.perf_counter() - start_time) * 1000)
+            return self._degraded_search(corrected_prefix, top_k, {}, start_time, corrected, errors=1, stores=stores)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(True, (time.perf_counter() - start_time) * 1000)
+
+        merged = []
+        errors = 0
+        for store_rank, (store, item) in enumerate(zip(stores, responses)):
+            if 'error' in item:
+                logger.error(f"Ошибка поиска в магазине '{store}': {item['error']}")
+                errors += 1
+                continue
+            for rank, hit in enumerate(item.get('hits', {}).get('hits', [])):
+                merged.append((-(hit.get('_score') or 0.0), rank, store_rank, _hit_product(hit)))
+        merged.sort(key=lambda entry: entry[:3])
+        products = [product for _, _, _, product in merged[:top_k]]
+        self.metrics.record({"total": (time.perf_counter() - start_time) * 1000}, queries=1,
+                            corrections_applied=int(corrected), zero_results=int(not products),
+                            request_bytes=len(msearch_body), response_bytes=len(response.content))
+        # Если часть магазинов не ответила, выдача неполная
+        return SearchResults(products, degraded=bool(errors) or len(responses) < len(stores))
+
+
+EVALUATION_FIELDNAMES = ['query', 'site', 'type', 'notes', 'top_3', 'top_3_score', 'latency_ms', 'judgement']
+
 
+def _format_result_row(row: Dict[str, str], results: List[Dict[str, str]], latency_ms: float) -> Dict[str, str]:
+    """Формирует строку отчёта run_evaluation из входной строки CSV и результатов поиска."""
+    # Используем 'name' как идентификатор, как и раньше
+    top_3_ids = "|".join([prod.get('name', 'unknown_name') for prod in results])
+    # top_3_score оставляем пустым, как раньше
+    top_3_scores = "|".join([""] * len(results))
+    return {
+        'query': row['query'],
+        'site': row['site'],
+        'type': row['type'],
+        'notes': row['notes'],
+        'top_3': top_3_ids,
+        'top_3_score': top_3_scores,
+        'latency_ms': f"{latency_ms:.2f}",
+        'judgement': '' # Оставляем пустым
+    }
 
-def run_evaluation(search_engine, queries_csv_path: str, output_csv_path: str):
+
+def run_evaluation(search_engine, queries_csv_path: str, output_csv_path: str, batch_size: int = 0,
+                   per_site: bool = False):
     """
     Запускает оценку поискового движка на основе CSV с префиксами.
     Принимает объект search_engine с методом search().
+    per_site=True - искать только в магазине из колонки site (search(..., store=row['site'])).
+
+    Если batch_size > 0 и у движка есть метод msearch(), запросы отправляются пачками
+    по batch_size через _msearch. Тогда latency_ms - амортизированная задержка на запрос,
+    а в дополнительную колонку batch_latency_ms пишется полное время батча.
     """
     logger.info(f"Запуск оценки. Префиксы: {queries_csv_path}, Вывод: {output_csv_path}")
+    batch_mode = batch_size > 0 and hasattr(search_engine, 'msearch')
 
     with open(queries_csv_path, 'r', encoding='utf-8') as f_in, \
          open(output_csv_path, 'w', newline='', encoding='utf-8') as f_out:
 
         reader = csv.DictReader(f_in)
-        fieldnames = ['query', 'site', 'type', 'notes', 'top_3', 'top_3_score', 'latency_ms', 'judgement']
+        fieldnames = EVALUATION_FIELDNAMES + (['batch_latency_ms'] if batch_mode else [])
         writer = csv.DictWriter(f_out, fieldnames=fieldnames)
         writer.writeheader()
 
-        for row in reader:
-            query = row['query']
-            site = row['site']
-            query_type = row['type']
-            notes = row['notes']
-
-            # Замеряем время поиска
-            start_time = time.time()
-            results = search_engine.search(query, top_k=3) # Получаем топ-3
-            end_time = time.time()
-            latency_ms = (end_time - start_time) * 1000
-
-            # Формируем строки для top_3
-            # Используем 'name' как идентификатор, как и раньше
-            top_3_ids = "|".join([prod.get('name', 'unknown_name') for prod in results])
-            # top_3_score оставляем пустым, как раньше
-            top_3_scores = "|".join([""] * len(results))
-
-            writer.writerow({
-                'query': query,
-                'site': site,
-                'type': query_type,
-                'notes': notes,
-                'top_3': top_3_ids,
-                'top_3_score': top_3_scores,
-                'latency_ms': f"{latency_ms:.2f}",
-                'judgement': '' # Оставляем пустым
-            })
+        if not batch_mode:
+            for row in reader:
+                # Замеряем время поиска
+                start_time = time.perf_counter()
+                site_kwargs = {"store": row['site']} if per_site else {}
+                results = search_engine.search(row['query'], top_k=3, **site_kwargs) # Получаем топ-3
+                latency_ms = (time.perf_counter() - start_time) * 1000
+                writer.writerow(_format_result_row(row, results, latency_ms))
+        else:
+            total_queries = 0
+            total_batch_ms = 0.0
+            batch_rows = []
+            for row in reader:
+                batch_rows.append(row)
+                if len(batch_rows) < batch_size:
+                    continue
+                total_batch_ms += _run_msearch_batch(search_engine, batch_rows, writer, per_site)
+                total_queries += len(batch_rows)
+                batch_rows = []
+            if batch_rows:
+                total_batch_ms += _run_msearch_batch(search_engine, batch_rows, writer, per_site)
+                total_queries += len(batch_rows)
+            if total_queries:
+                logger.info(
+                    f"Batch-режим: {total_queries} запросов, общее время батчей {total_batch_ms:.2f} мс, "
+                    f"амортизированная задержка {total_batch_ms / total_queries:.3f} мс/запрос"
+                )
 
     logger.info(f"Оценка завершена. Результаты записаны в {output_csv_path}")
 
 
+def _run_msearch_batch(search_engine, batch_rows: List[Dict[str, str]], writer, per_site: bool = False) -> float:
+    """Выполняет один батч _msearch, пишет строки в отчёт в исходном порядке и возвращает время батча (мс)."""
+    start_time = time.perf_counter()
+    site_kwargs = {"stores": [row['site'] for row in batch_rows]} if per_site else {}
+    batch_results = search_engine.msearch([row['query'] for row in batch_rows], top_k=3, **site_kwargs)
+    batch_ms = (time.perf_counter() - start_time) * 1000
+    amortized_ms = batch_ms / len(batch_rows)
+    for row, results in zip(batch_rows, batch_results):
+        result_row = _format_result_row(row, results, amortized_ms)
+        result_row['batch_latency_ms'] = f"{batch_ms:.2f}"
+        writer.writerow(result_row)
+    return batch_ms
+
+
+def _timed_search(search_engine, query: str, not_before: float,
+                  store: Optional[str] = None) -> Tuple[List[Dict[str, str]], float]:
+    """
+    Выполняет search() в рабочем потоке и замеряет задержку внутри потока,
+    чтобы время ожидания в очереди пула не попадало в latency_ms.
+    not_before - момент (perf_counter), раньше которого запрос нельзя отправлять (пейсинг по QPS).
+    """
+    delay = not_before - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+    start_time = time.perf_counter()
+    results = search_engine.search(query, top_k=3, **({"store": store} if store is not None else {}))
+    return results, (time.perf_counter() - start_time) * 1000
+
+
+def run_concurrent_evaluation(search_engine, queries_csv_path: str, output_csv_path: str,
+                              concurrency: int = 8, target_qps: float = 0.0, per_site: bool = False) -> Dict[str, float]:
+    """
+    Параллельная версия run_evaluation на пуле потоков с ограничением concurrency.
+    Строки пишутся в output_csv_path в порядке входного CSV, формат отчёта тот же.
+    Если target_qps > 0, запросы отправляются не чаще target_qps в секунду (open-loop пейсинг).
+    Возвращает сводку прогона: число запросов, время, пропускную способность и задержки.
+    """
+    logger.info(f"Запуск параллельной оценки (concurrency={concurrency}, target_qps={target_qps or '-'}). "
+                f"Префиксы: {queries_csv_path}, Вывод: {output_csv_path}")
+    interval = 1.0 / target_qps if target_qps > 0 else 0.0
+    # Окно незавершённых запросов ограничено, чтобы не держать в памяти весь CSV
+    max_in_flight = concurrency * 4
+    latencies = []
+
+    with open(queries_csv_path, 'r', encoding='utf-8') as f_in, \
+         open(output_csv_path, 'w', newline='', encoding='utf-8') as f_out, \
+         ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        reader = csv.DictReader(f_in)
+        writer = csv.DictWriter(f_out, fieldnames=EVALUATION_FIELDNAMES)
+        writer.writeheader()
+
+        def write_oldest():
+            row, future = in_flight.popleft()
+            results, latency_ms = future.result()
+            latencies.append(latency_ms)
+            writer.writerow(_format_result_row(row, results, latency_ms))
+
+        in_flight = deque()
+        start_time = time.perf_counter()
+        for index, row in enumerate(reader):
+            not_before = start_time + index * interval
+            in_flight.append((row, executor.submit(_timed_search, search_engine, row['query'], not_before,
+                                                   row['site'] if per_site else None)))
+            if len(in_flight) >= max_in_flight:
+                write_oldest()
+        while in_flight:
+            write_oldest()
+        wall_time_s = time.perf_counter() - start_time
+
+    latencies.sort()
+    summary = {
+        'concurrency': concurrency,
+        'queries': len(latencies),
+        'wall_time_s': wall_time_s,
+        'throughput_qps': len(latencies) / wall_time_s if wall_time_s > 0 else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+    logger.info(f"Параллельная оценка завершена: {summary['queries']} запросов за {wall_time_s:.2f} с, "
+                f"{summary['throughput_qps']:.1f} QPS, p50 {summary['p50_ms']:.2f} мс, p99 {summary['p99_ms']:.2f} мс")
+    return summary
+
+
+def sweep_concurrency(search_engine, queries_csv_path: str, output_csv_path: str,
+                      levels: List[int], target_qps: float = 0.0, per_site: bool = False) -> List[Dict[str, float]]:
+    """
+    Прогоняет run_concurrent_evaluation для каждого уровня параллелизма и печатает таблицу,
+    по которой видно, где узел OpenSearch перестаёт масштабироваться (QPS не растёт, p99 растёт).
+    Отчёт уровня N пишется в <output_csv_path без .csv>_cN.csv.
+    Пул соединений движка должен быть не меньше max(levels), иначе лишние потоки ждут соединение
+    на клиенте и точка насыщения OpenSearch не видна.
+    """
+    pool_size = getattr(search_engine, 'pool_size', None)
+    if pool_size is not None and pool_size < max(levels):
+        logger.warning(f"Пул соединений ({pool_size}) меньше максимального уровня параллелизма ({max(levels)}): "
+                       f"верхние уровни упрутся в пул клиента, а не в OpenSearch")
+    base_path = output_csv_path[:-4] if output_csv_path.endswith('.csv') else output_csv_path
+    summaries = []
+    for level in levels:
+        summaries.append(run_concurrent_evaluation(search_engine, queries_csv_path, f"{base_path}_c{level}.csv",
+                                                   concurrency=level, target_qps=target_qps, per_site=per_site))
+
+    print(f"{'concurrency':>11} {'QPS':>10} {'mean, мс':>10} {'p50, мс':>10} {'p99, мс':>10}")
+    for summary in summaries:
+        print(f"{summary['concurrency']:>11} {summary['throughput_qps']:>10.1f} {summary['mean_ms']:>10.2f} "
+              f"{summary['p50_ms']:>10.2f} {summary['p99_ms']:>10.2f}")
+    return summaries
+
+
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Оценка префиксного поиска по data/prefix_queries.csv")
+    parser.add_argument("--engine", choices=["opensearch", "local"], default="opensearch",
+                        help="opensearch - ElasticsearchSearchEngine, local - LocalPrefixSearchEngine в памяти")
+    parser.add_argument("--catalog", default="data/catalog_products.xml", help="XML каталога (или снапшот .snap) для --engine local, --layout-fix и --typo-fix")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help=f"Размер батча _msearch (0 - по одному запросу; например {DEFAULT_MSEARCH_BATCH_SIZE})")
+    parser.add_argument("--layout-fix", action="store_true",
+                        help="Исправлять раскладку/транслитерацию по словарю каталога (--catalog)")
+    parser.add_argument("--typo-fix", action="store_true",
+                        help="Исправлять опечатки на клиенте (SymSpell по словарю --catalog) вместо fuzziness AUTO")
+    parser.add_argument("--fuzzy-fallback", action="store_true",
+                        help="С --typo-fix включать fuzziness, если для токена не найден кандидат")
+    parser.add_argument("--mapping", choices=["keyword_edge_ngram", "token_edge_ngram", "search_as_you_type"],
+                        default=DEFAULT_MAPPING_MODE, help="Маппинг autocomplete, с которым создан индекс")
+    parser.add_argument("--prefix-table", default="",
+                        help="Файл таблицы коротких префиксов (setup_elasticsearch.py --build-prefix-table)")
+    parser.add_argument("--cache", action="store_true", help="Кэшировать результаты префиксов (LRU + TTL)")
+    parser.add_argument("--metrics-file", default="", help="Сохранить метрики search() в Prometheus text format")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="Число параллельных запросов (0 - последовательный run_evaluation)")
+    parser.add_argument("--target-qps", type=float, default=0.0, help="Ограничение скорости отправки запросов (0 - без ограничения)")
+    parser.add_argument("--sweep", default="", help="Уровни параллелизма через запятую для поиска точки насыщения, например 1,2,4,8,16")
+    parser.add_argument("--timeout-ms", type=float, default=DEFAULT_REQUEST_TIMEOUT_MS, help="Дедлайн вызова OpenSearch")
+    parser.add_argument("--hedge", action="store_true", help="Дублировать запрос, если ответа нет дольше p95 задержки")
+    parser.add_argument("--hedge-delay-ms", type=float, default=None, help="Фиксированная задержка hedge-запроса вместо p95")
+    parser.add_argument("--circuit-breaker", action="store_true",
+                        help="Размыкать вызовы OpenSearch при всплеске ошибок или медленных ответов")
+    parser.add_argument("--fallback-local", action="store_true",
+                        help="Отвечать из LocalPrefixSearchEngine по --catalog, когда OpenSearch недоступен (degraded)")
+    parser.add_argument("--per-site", action="store_true",
+                        help="Искать только в магазине из колонки site (search(..., store=site))")
+    parser.add_argument("--store-routing", action="store_true",
+                        help="Индекс разбит по магазинам (setup_elasticsearch.py --store-routing): --per-site идёт на один шард")
+    args = parser.parse_args()
+    if args.per_site and args.engine == "local":
+        parser.error("--per-site поддерживается только для --engine opensearch")
+
     print("DEBUG: Запуск main блока search_engine.py v2") # <-- Добавить отладочный принт
-    # --- Запуск оценки с использованием ElasticsearchSearchEngine ---
-    print("\n--- Запуск оценки с использованием ElasticsearchSearchEngine v2 ---")
-    # Создаём движок
-    es_search_engine = ElasticsearchSearchEngine()
+    queries_path = "data/prefix_queries.csv"
+    sweep_levels = [int(level) for level in args.sweep.split(',')] if args.sweep else []
+    if args.engine == "local":
+        from local_search_engine import LocalPrefixSearchEngine
+
+        print("\n--- Запуск оценки с использованием LocalPrefixSearchEngine ---")
+        search_engine = LocalPrefixSearchEngine.from_xml(args.catalog)
+        output_path = "reports/local_evaluation_results_v2.csv"
+    else:
+        # --- Запуск оценки с использованием ElasticsearchSearchEngine ---
+        print("\n--- Запуск оценки с использованием ElasticsearchSearchEngine v2 ---")
+        # Создаём движок
+        layout_rewriter = None
+        typo_corrector = None
+        if args.layout_fix or args.typo_fix:
+            from layout_corrections import CatalogVocabulary, LayoutRewriter
+            vocabulary = CatalogVocabulary.from_xml(args.catalog)
+            if args.layout_fix:
+                layout_rewriter = LayoutRewriter(vocabulary)
+            if args.typo_fix:
+                from typo_corrections import SymSpellPrefixCorrector
+                typo_corrector = SymSpellPrefixCorrector(vocabulary)
+        circuit_breaker = None
+        if args.circuit_breaker:
+            from circuit_breaker import CircuitBreaker
+            circuit_breaker = CircuitBreaker()
+        fallback_engine = None
+        if args.fallback_local:
+            from local_search_engine import LocalPrefixSearchEngine
+            fallback_engine = LocalPrefixSearchEngine.from_xml(args.catalog)
+        short_prefix_table = None
+        if args.prefix_table:
+            from short_prefix_table import ShortPrefixTable
+            short_prefix_table = ShortPrefixTable(args.prefix_table)
+        # Пул соединений - не меньше числа параллельных запросов, иначе потоки ждут соединение на клиенте
+        search_engine = ElasticsearchSearchEngine(pool_size=max([HTTP_POOL_SIZE, args.concurrency] + sweep_levels),
+                                                  cache=PrefixResultCache() if args.cache else None,
+                                                  layout_rewriter=layout_rewriter, typo_corrector=typo_corrector,
+                                                  fuzzy_fallback=args.fuzzy_fallback,
+                                                  mapping_mode=args.mapping, request_timeout_ms=args.timeout_ms,
+                                                  hedge=args.hedge, hedge_delay_ms=args.hedge_delay_ms,
+                                                  circuit_breaker=circuit_breaker, fallback_engine=fallback_engine,
+                                                  store_routing=args.store_routing,
+                                                  short_prefix_table=short_prefix_table)
+        output_path = "reports/elasticsearch_evaluation_results_v2.csv" # Отличный путь для v2
 
     # Запускаем оценку
-    queries_path = "data/prefix_queries.csv"
-    output_path = "reports/elasticsearch_evaluation_results_v2.csv" # Отличный путь для v2
     print(f"DEBUG: Попытка запустить run_evaluation с {queries_path} в {output_path}") # <-- Добавить отладочный принт
-    run_evaluation(es_search_engine, queries_path, output_path)
+    if args.sweep:
+        sweep_concurrency(search_engine, queries_path, output_path, sweep_levels, target_qps=args.target_qps,
+                          per_site=args.per_site)
+    elif args.concurrency > 0:
+        run_concurrent_evaluation(search_engine, queries_path, output_path,
+                                  concurrency=args.concurrency, target_qps=args.target_qps, per_site=args.per_site)
+    else:
+        run_evaluation(search_engine, queries_path, output_path, batch_size=args.batch_size, per_site=args.per_site)
+    if getattr(search_engine, 'metrics', None) is not None:
+        logger.info(f"Метрики поиска: {search_engine.metrics.snapshot()}")
+        if args.metrics_file:
+            search_engine.metrics.write_prometheus_file(args.metrics_file)
+    if getattr(search_engine, 'cache', None) is not None:
+        logger.info(f"Статистика кэша: {search_engine.cache.stats()}")
     print(f"DEBUG: run_evaluation завершена. Результаты сохранены в {output_path}") # <-- Добавить отладочный принт
     print(f"Оценка завершена. Результаты сохранены в {output_path}")
 
@@ -160,6 +1024,6 @@ if __name__ == "__main__":
     # test_queries = ["xfq", "san pelle", "ма", "йогурт гр"]
     # for example_prefix in test_queries:
     #     print(f"\n--- Результаты для префикса '{example_prefix}' ---")
-    #     es_results = es_search_engine.search(example_prefix, top_k=5)
+    #     es_results = search_engine.search(example_prefix, top_k=5)
     #     for i, product in enumerate(es_results):
     #         print(f"{i+1}. {product.get('name')} - {product.get('brand')} - {product.get('category')}")
\ No newline at end of file
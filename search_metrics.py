@@ -0,0 +1,112 @@
+# search_metrics.py - дешёвые метрики горячего пути поиска (счётчики и гистограммы)
+
+from typing import Dict, List, Sequence
+import threading
+
+# Границы бакетов гистограмм задержки, мс (последний бакет +Inf добавляется автоматически)
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Этапы search(), по которым копится время
+SEARCH_STAGES = ("corrections", "serialize", "network", "opensearch_took", "parse", "total")
+
+# degraded - ответы из запасного индекса, hedged - отправленные дублирующие запросы,
+# request_bytes/response_bytes - размер тела запроса и ответа OpenSearch
+COUNTERS = ("queries", "errors", "corrections_applied", "zero_results", "degraded", "hedged",
+            "request_bytes", "response_bytes")
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами в формате Prometheus (кумулятивные счётчики при экспорте)."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = 0
+        # Бакетов мало, линейный проход дешевле bisect с его накладными расходами
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе бакета (для быстрых сводок без хранения значений)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class SearchMetrics:
+    """
+    Метрики ElasticsearchSearchEngine.search: счётчики запросов, ошибок, применённых
+    корректировок и пустых выдач, а также гистограммы времени по этапам (мс).
+    Экспорт - snapshot() в dict или Prometheus text format.
+    """
+
+    def __init__(self, prefix: str = "prefix_search"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {name: 0 for name in COUNTERS}
+        self.stages: Dict[str, Histogram] = {stage: Histogram() for stage in SEARCH_STAGES}
+
+    def record(self, stage_ms: Dict[str, float], **counter_increments: int):
+        """Записывает времена этапов одного запроса и увеличивает счётчики."""
+        with self._lock:
+            for stage, value in stage_ms.items():
+                self.stages[stage].observe(value)
+            for name, increment in counter_increments.items():
+                self.counters[name] += increment
+
+    def snapshot(self) -> Dict:
+        """Снимок метрик: счётчики, zero_result_rate и по каждому этапу count/sum/p50/p99."""
+        with self._lock:
+            queries = self.counters["queries"]
+            return {
+                "counters": dict(self.counters),
+                "zero_result_rate": self.counters["zero_results"] / queries if queries else 0.0,
+                "error_rate": self.counters["errors"] / queries if queries else 0.0,
+                "stages_ms": {
+                    stage: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "p50": histogram.quantile(0.50),
+                        "p99": histogram.quantile(0.99),
+                    }
+                    for stage, histogram in self.stages.items()
+                },
+            }
+
+    def to_prometheus_text(self) -> str:
+        """Метрики в Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            for name, value in self.counters.items():
+                metric = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+            metric = f"{self.prefix}_stage_duration_ms"
+            lines.append(f"# TYPE {metric} histogram")
+            for stage, histogram in self.stages.items():
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path: str):
+        """Пишет метрики в файл (например, для node_exporter textfile collector)."""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus_text())
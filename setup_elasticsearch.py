@@ -1,251 +1,844 @@
-# setup_elasticsearch.py для v2 проекта (с исправленным bulk, таймаутом и проверкой)
-
-import xml.etree.ElementTree as ET
-# import pandas as pd # Не используется
-import re
-from typing import Dict, List
-import logging
-import requests # Импортируем requests для OpenSearch
-import time
-import json # Импортируем json для работы с телом bulk-запроса
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-# Конфигурация OpenSearch (для v2)
-OPENSEARCH_HOST = "http://localhost:9200" # Убедимся, что это localhost
-OPENSEARCH_INDEX_NAME = "catalog_products" # Имя индекса
-
-# Определение маппинга индекса (адаптировано из v1, возможно, без русской морфологии)
-INDEX_MAPPING = {
-    "settings": {
-        "number_of_shards": 1,
-        "number_of_replicas": 0,
-        "analysis": {
-            "analyzer": {
-                # Упрощённый анализатор, использующий стандартные фильтры OpenSearch
-                "default_analyzer": {
-                    "type": "custom",
-                    "tokenizer": "standard",
-                    "filter": [
-                        "lowercase",
-                        # "russian_morphology", # Убираем, если не установлен плагин
-                        "stop", # Фильтр стоп-слов (использует встроенные, например, _english_)
-                        "snowball" # Лемматизация (использует встроенные, например, English)
-                    ],
-                    "char_filter": [
-                        "html_strip"
-                    ]
-                },
-                # Аналайзер для префиксного поиска (ngram) на основе стандартных токенов
-                "autocomplete_analyzer": {
-                    "type": "custom",
-                    "tokenizer": "keyword", # Используем keyword для ngram
-                    "filter": [
-                        "lowercase",
-                        "edge_ngram_filter" # Переименовали из 'edge_ngram' для ясности
-                    ]
-                }
-            },
-            "filter": {
-                "edge_ngram_filter": { # Переименовали из 'edge_ngram'
-                    "type": "edge_ngram",
-                    "min_gram": 1,
-                    "max_gram": 20,
-                    "token_chars": ["letter"]
-                },
-                "stop": {
-                    "type": "stop",
-                    # Используем встроенный список стоп-слов. OpenSearch не всегда имеет _russian_.
-                    # Для русского языка может потребоваться плагин или кастомный список.
-                    # Пока используем _english_ как пример или оставим пустым.
-                    # "stopwords": "_russian_" # <- Может не работать без плагина
-                    "stopwords": "_english_" # <- Используем английские стоп-слова как пример
-                },
-                "snowball": {
-                    "type": "snowball",
-                    # Язык для лемматизации. OpenSearch не всегда имеет Russian.
-                    # "language": "Russian" # <- Может не работать без плагина
-                    "language": "English" # <- Используем English как пример
-                }
-            }
-        }
-    },
-    "mappings": {
-        "properties": {
-            "name": {
-                "type": "text",
-                "analyzer": "default_analyzer", # Используем упрощённый
-                "fields": {
-                    "autocomplete": {
-                        "type": "text",
-                        "analyzer": "autocomplete_analyzer"
-                    },
-                    "keyword": {
-                        "type": "keyword",
-                        "ignore_above": 256
-                    }
-                }
-            },
-            "brand": {
-                "type": "text",
-                "analyzer": "default_analyzer",
-                "fields": {
-                    "autocomplete": {
-                        "type": "text",
-                        "analyzer": "autocomplete_analyzer"
-                    },
-                    "keyword": {
-                        "type": "keyword",
-                        "ignore_above": 256
-                    }
-                }
-            },
-            "category": {
-                "type": "text",
-                "analyzer": "default_analyzer",
-                "fields": {
-                    "autocomplete": {
-                        "type": "text",
-                        "analyzer": "autocomplete_analyzer"
-                    },
-                    "keyword": {
-                        "type": "keyword",
-                        "ignore_above": 256
-                    }
-                }
-            },
-            "price": {
-                "type": "double"
-            },
-            "url": {
-                "type": "keyword"
-            },
-            "store": {
-                "type": "keyword"
-            }
-        }
-    }
-}
-
-
-def wait_for_opensearch():
-    """Ждём, пока OpenSearch станет доступен."""
-    logger.info("Ожидание запуска OpenSearch...")
-    for _ in range(120): # Попробуем 120 раз с интервалом 5 секунд = 10 мин
-        try:
-            # --- ДОБАВЛЕН ТАЙМАУТ ---
-            response = requests.get(OPENSEARCH_HOST, timeout=10) # Добавляем таймаут 10 секунд
-            if response.status_code == 200:
-                logger.info("OpenSearch доступен.")
-                return True
-        except requests.exceptions.RequestException as e:
-            logger.debug(f"Попытка подключения к OpenSearch: {e}") # Логируем ошибку, если нужно, чтобы видеть, что происходит
-            pass
-        time.sleep(5)
-    logger.error("OpenSearch не стал доступен за отведённое время.")
-    return False
-
-
-def create_index():
-    """Создаёт индекс с заданным маппингом."""
-    url = f"{OPENSEARCH_HOST}/{OPENSEARCH_INDEX_NAME}"
-    response = requests.put(url, json=INDEX_MAPPING, headers={"Content-Type": "application/json"})
-    if response.status_code in [200, 201]:
-        logger.info(f"Индекс '{OPENSEARCH_INDEX_NAME}' создан или уже существует.")
-        return True
-    else:
-        logger.error(f"Ошибка при создании индекса: {response.status_code} - {response.text}")
-        return False
-
-
-def load_catalog_to_opensearch(xml_path: str):
-    """Загружает товары из XML в OpenSearch."""
-    logger.info(f"Загрузка каталога из {xml_path} в OpenSearch...")
-    try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-
-        # Собираем строки для bulk-запроса в список
-        bulk_lines = []
-        for product_elem in root.findall('product'):
-            product_data = {}
-            for child in product_elem:
-                product_data[child.tag] = child.text
-
-            # Формируем строку действия индексации и добавляем её в список с \n
-            action = {"index": {"_index": OPENSEARCH_INDEX_NAME}}
-            # Используем json.dumps с ensure_ascii=False и без лишних пробелов
-            action_line = json.dumps(action, ensure_ascii=False, separators=(',', ':'))
-            bulk_lines.append(action_line) # Добавляем строку БЕЗ \n сюда
-
-            # Формируем строку с данными документа и добавляем её в список с \n
-            doc_line = json.dumps(product_data, ensure_ascii=False, separators=(',', ':'))
-            bulk_lines.append(doc_line) # Добавляем строку БЕЗ \n сюда
-
-                # --- ПРАВИЛЬНАЯ ПРОВЕРКА: Проверяем, есть ли что отправлять ---
-        if bulk_lines: # Проверяем, что список строк не пуст
-            # Объединяем все строки с \n и ДОБАВЛЯЕМ финальный \n
-            # join добавляет \n между элементами списка.
-            # bulk_lines = ["action1", "doc1", "action2", "doc2"] -> "action1\ndoc1\naction2\ndoc2\n"
-            bulk_body = '\n'.join(bulk_lines) + '\n'
-
-            bulk_url = f"{OPENSEARCH_HOST}/_bulk"
-            # Теперь bulk_body гарантированно заканчивается на \n (если bulk_lines не был пуст)
-
-            # --- ОТЛАДКА: Выводим последние 100 символов bulk_body ---
-            print(f"DEBUG: Last 100 chars of bulk_body: {repr(bulk_body[-100:])}")
-            # --- ПРАВИЛЬНАЯ проверка на завершающий \n ---
-            print(f"DEBUG: Does bulk_body end with \\n? {bulk_body.endswith(chr(10))}") # chr(10) - символ новой строки
-            # --- /ОТЛАДКА ---
-
-            # --- ОТЛАДКА: Сохраняем bulk_body в файл ---
-            print("DEBUG: Saving bulk_body to bulk_request.ndjson for manual inspection/curl test.")
-            with open("bulk_request.ndjson", "wb") as f:
-                # Записываем тело как байты, чтобы точно сохранить \n
-                f.write(bulk_body.encode('utf-8'))
-            # --- /ОТЛАДКА ---
-
-            response = requests.post(bulk_url, data=bulk_body, headers={"Content-Type": "application/x-ndjson"})
-
-            if response.status_code == 200:
-                # Подсчитываем количество загруженных документов (каждая запись = 2 строки: action + doc)
-                # len(bulk_lines) - это общее количество строк (действий и документов)
-                num_docs = len(bulk_lines) // 2
-                logger.info(f"Загружено {num_docs} товаров в OpenSearch.")
-                # Принудительно обновляем индекс, чтобы изменения стали видны
-                refresh_url = f"{OPENSEARCH_HOST}/{OPENSEARCH_INDEX_NAME}/_refresh"
-                requests.post(refresh_url)
-                logger.info("Индекс обновлён.")
-                return True
-            else:
-                logger.error(f"Ошибка при bulk-загрузке: {response.status_code} - {response.text}")
-                return False
-        else:
-            logger.warning("Нет данных для загрузки (bulk_lines пуст).")
-            # Возвращаем True, если пустой каталог - это не ошибка, иначе False
-            return True # Или False, если считать пустой каталог ошибкой
-
-    except ET.ParseError as e:
-        logger.error(f"Ошибка парсинга XML: {e}")
-        return False
-    except FileNotFoundError:
-        logger.error(f"Файл не найден: {xml_path}")
-        return False
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка при загрузке каталога: {e}")
-        return False
-
-
-if __name__ == "__main__":
-    if not wait_for_opensearch():
-        exit(1)
-
-    if not create_index():
-        exit(1)
-
-    if not load_catalog_to_opensearch("data/catalog_products.xml"):
-        exit(1)
-
-    logger.info("Настройка OpenSearch v2 завершена.")
\ No newline at end of file
+# setup_elasticsearch.py для v2 проекта (с исправленным bulk, таймаутом и проверкой)
+
+import xml.etree.ElementTree as ET
+# import pandas as pd # Не используется
+import re
+from typing import Dict, List, Iterable, Iterator, Optional, Tuple
+import logging
+import requests # Импортируем requests для OpenSearch
+import time
+import json # Импортируем json для работы с телом bulk-запроса
+import copy
+import hashlib
+import os
+import threading
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from result_cache import invalidate_all_caches
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Конфигурация OpenSearch (для v2)
+OPENSEARCH_HOST = "http://localhost:9200" # Убедимся, что это localhost
+OPENSEARCH_INDEX_NAME = "catalog_products" # Имя алиаса; физические индексы - catalog_products_v<timestamp>_<суффикс>
+KEEP_PREVIOUS_INDICES = 1 # Сколько предыдущих версий индекса оставлять для отката
+INDEX_STATE_PATH = "data/catalog_index_state.json" # {product_id: content_hash} и маппинг последней загрузки (для delta)
+PRODUCT_ID_FIELDS = ("id", "url", "image_url") # Поля, из которых берётся стабильный _id товара
+WARMUP_PREFIXES = ["а", "м", "ма", "ch", "йо", "сыр"] # Префиксы для прогрева нового индекса
+
+# Параметры потоковой bulk-загрузки
+BULK_CHUNK_DOCS = 1000 # Документов в одном _bulk-запросе
+BULK_CHUNK_BYTES = 5 * 1024 * 1024 # ...или не больше ~5 МБ тела
+BULK_WORKERS = 4 # Параллельных bulk-запросов
+BULK_MAX_RETRIES = 5 # Повторов при 429/5xx
+BULK_RETRY_BACKOFF_SECONDS = 0.5 # Начальная пауза между повторами (растёт экспоненциально)
+BULK_TIMEOUT_SECONDS = 120
+
+# Определение маппинга индекса (адаптировано из v1, возможно, без русской морфологии)
+INDEX_MAPPING = {
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 0,
+        "analysis": {
+            "analyzer": {
+                # Упрощённый анализатор, использующий стандартные фильтры OpenSearch
+                "default_analyzer": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": [
+                        "lowercase",
+                        # "russian_morphology", # Убираем, если не установлен плагин
+                        "stop", # Фильтр стоп-слов (использует встроенные, например, _english_)
+                        "snowball" # Лемматизация (использует встроенные, например, English)
+                    ],
+                    "char_filter": [
+                        "html_strip"
+                    ]
+                },
+                # Аналайзер для префиксного поиска (ngram) на основе стандартных токенов
+                "autocomplete_analyzer": {
+                    "type": "custom",
+                    "tokenizer": "keyword", # Используем keyword для ngram
+                    "filter": [
+                        "lowercase",
+                        "edge_ngram_filter" # Переименовали из 'edge_ngram' для ясности
+                    ]
+                }
+            },
+            "filter": {
+                "edge_ngram_filter": { # Переименовали из 'edge_ngram'
+                    "type": "edge_ngram",
+                    "min_gram": 1,
+                    "max_gram": 20,
+                    "token_chars": ["letter"]
+                },
+                "stop": {
+                    "type": "stop",
+                    # Используем встроенный список стоп-слов. OpenSearch не всегда имеет _russian_.
+                    # Для русского языка может потребоваться плагин или кастомный список.
+                    # Пока используем _english_ как пример или оставим пустым.
+                    # "stopwords": "_russian_" # <- Может не работать без плагина
+                    "stopwords": "_english_" # <- Используем английские стоп-слова как пример
+                },
+                "snowball": {
+                    "type": "snowball",
+                    # Язык для лемматизации. OpenSearch не всегда имеет Russian.
+                    # "language": "Russian" # <- Может не работать без плагина
+                    "language": "English" # <- Используем English как пример
+                }
+            }
+        }
+    },
+    "mappings": {
+        "properties": {
+            "name": {
+                "type": "text",
+                "analyzer": "default_analyzer", # Используем упрощённый
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete_analyzer"
+                    },
+                    "keyword": {
+                        "type": "keyword",
+                        "ignore_above": 256
+                    }
+                }
+            },
+            "brand": {
+                "type": "text",
+                "analyzer": "default_analyzer",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete_analyzer"
+                    },
+                    "keyword": {
+                        "type": "keyword",
+                        "ignore_above": 256
+                    }
+                }
+            },
+            "category": {
+                "type": "text",
+                "analyzer": "default_analyzer",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete_analyzer"
+                    },
+                    "keyword": {
+                        "type": "keyword",
+                        "ignore_above": 256
+                    }
+                }
+            },
+            "price": {
+                "type": "double"
+            },
+            "url": {
+                "type": "keyword"
+            },
+            "store": {
+                "type": "keyword"
+            }
+        }
+    }
+}
+
+
+# Варианты маппинга подполей autocomplete (выбираются в create_index):
+#   keyword_edge_ngram - исходный: edge_ngram по всей строке (keyword tokenizer), не находит префиксы внутренних слов;
+#   token_edge_ngram   - edge_ngram по каждому токену (standard tokenizer), запрос анализируется без ngram;
+#   search_as_you_type - встроенный тип search_as_you_type (шинглы + index_prefixes), запрос bool_prefix.
+MAPPING_MODES = ("keyword_edge_ngram", "token_edge_ngram", "search_as_you_type")
+DEFAULT_MAPPING_MODE = "keyword_edge_ngram"
+
+# Разбиение по магазинам: документы маршрутизируются по store (custom routing), поэтому все товары
+# одного магазина лежат на одном шарде и запрос search(..., store=...) обрабатывает только его.
+STORE_ROUTING_SHARDS = 4
+NO_STORE_ROUTING_KEY = "_no_store"
+
+
+def build_index_mapping(mapping_mode: str = DEFAULT_MAPPING_MODE, store_routing: bool = False,
+                        edge_ngram_range: Optional[Tuple[int, int]] = None) -> Dict:
+    """
+    Возвращает копию INDEX_MAPPING с подполями autocomplete для выбранного режима.
+    store_routing=True - STORE_ROUTING_SHARDS шардов и обязательный routing (ключ - магазин).
+    edge_ngram_range - (min_gram, max_gram) для edge_ngram_filter вместо (1, 20);
+    на search_as_you_type не влияет.
+    """
+    if mapping_mode not in MAPPING_MODES:
+        raise ValueError(f"Неизвестный режим маппинга: {mapping_mode}")
+    mapping = copy.deepcopy(INDEX_MAPPING)
+    if edge_ngram_range is not None:
+        edge_ngram_filter = mapping["settings"]["analysis"]["filter"]["edge_ngram_filter"]
+        edge_ngram_filter["min_gram"], edge_ngram_filter["max_gram"] = edge_ngram_range
+    if store_routing:
+        mapping["settings"]["number_of_shards"] = STORE_ROUTING_SHARDS
+        # Документ без routing отклоняется: иначе он попал бы на шард по _id и потерялся для поиска по магазину
+        mapping["mappings"]["_routing"] = {"required": True}
+    if mapping_mode == "keyword_edge_ngram":
+        return mapping
+
+    analysis = mapping["settings"]["analysis"]
+    # Анализатор запроса для префиксных подполей: токены в нижнем регистре без ngram
+    analysis["analyzer"]["autocomplete_search_analyzer"] = {
+        "type": "custom",
+        "tokenizer": "standard",
+        "filter": ["lowercase"]
+    }
+    if mapping_mode == "token_edge_ngram":
+        analysis["analyzer"]["autocomplete_token_analyzer"] = {
+            "type": "custom",
+            "tokenizer": "standard", # ngram от каждого слова, а не от всей строки
+            "filter": ["lowercase", "edge_ngram_filter"]
+        }
+        autocomplete_field = {
+            "type": "text",
+            "analyzer": "autocomplete_token_analyzer",
+            "search_analyzer": "autocomplete_search_analyzer"
+        }
+    else:
+        autocomplete_field = {
+            "type": "search_as_you_type",
+            "analyzer": "autocomplete_search_analyzer"
+        }
+    for field in ("name", "brand", "category"):
+        mapping["mappings"]["properties"][field]["fields"]["autocomplete"] = dict(autocomplete_field)
+    return mapping
+
+
+def wait_for_opensearch():
+    """Ждём, пока OpenSearch станет доступен."""
+    logger.info("Ожидание запуска OpenSearch...")
+    for _ in range(120): # Попробуем 120 раз с интервалом 5 секунд = 10 мин
+        try:
+            # --- ДОБАВЛЕН ТАЙМАУТ ---
+            response = requests.get(OPENSEARCH_HOST, timeout=10) # Добавляем таймаут 10 секунд
+            if response.status_code == 200:
+                logger.info("OpenSearch доступен.")
+                return True
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Попытка подключения к OpenSearch: {e}") # Логируем ошибку, если нужно, чтобы видеть, что происходит
+            pass
+        time.sleep(5)
+    logger.error("OpenSearch не стал доступен за отведённое время.")
+    return False
+
+
+def create_index(index_name: str = OPENSEARCH_INDEX_NAME, mapping_mode: str = DEFAULT_MAPPING_MODE,
+                 store_routing: bool = False, edge_ngram_range: Optional[Tuple[int, int]] = None):
+    """
+    Создаёт индекс с маппингом выбранного режима (см. MAPPING_MODES), при store_routing - разбитый по магазинам.
+    edge_ngram_range - (min_gram, max_gram) префиксных подполей (см. build_index_mapping).
+    """
+    url = f"{OPENSEARCH_HOST}/{index_name}"
+    response = requests.put(url, json=build_index_mapping(mapping_mode, store_routing, edge_ngram_range),
+                            headers={"Content-Type": "application/json"})
+    if response.status_code in [200, 201]:
+        logger.info(f"Индекс '{index_name}' ({mapping_mode}) создан или уже существует.")
+        return True
+    else:
+        logger.error(f"Ошибка при создании индекса: {response.status_code} - {response.text}")
+        return False
+
+
+def iter_catalog_products(xml_path: str) -> Iterator[Dict[str, str]]:
+    """
+    Потоково читает товары из XML через iterparse, не строя всё дерево в памяти.
+    Атрибут id у <product>, если он есть, сохраняется в поле 'id'.
+    """
+    context = ET.iterparse(xml_path, events=("start", "end"))
+    _, root = next(context) # Корневой элемент, из которого удаляем уже обработанные товары
+    for event, elem in context:
+        if event != "end" or elem.tag != "product":
+            continue
+        product_data = {}
+        if elem.get('id') is not None:
+            product_data['id'] = elem.get('id')
+        for child in elem:
+            product_data[child.tag] = child.text
+        yield product_data
+        elem.clear()
+        root.clear()
+
+
+def product_id(product_data: Dict[str, str]) -> str:
+    """
+    Стабильный идентификатор товара для _id: первое непустое поле из PRODUCT_ID_FIELDS,
+    иначе хэш от name/brand/store.
+    """
+    for field in PRODUCT_ID_FIELDS:
+        if product_data.get(field):
+            return product_data[field]
+    key = "|".join(product_data.get(field) or "" for field in ("name", "brand", "store"))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def store_routing_key(product_data: Dict[str, str]) -> str:
+    """Ключ routing товара - его магазин (тот же, что передаёт search(..., store=...))."""
+    return product_data.get("store") or NO_STORE_ROUTING_KEY
+
+
+def content_hash(product_data: Dict[str, str]) -> str:
+    """Хэш содержимого товара: по нему delta-режим понимает, что товар изменился."""
+    canonical = json.dumps(product_data, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def iter_bulk_chunks(actions: Iterable[Tuple[Dict, Optional[Dict]]], chunk_docs: int = BULK_CHUNK_DOCS,
+                     chunk_bytes: int = BULK_CHUNK_BYTES) -> Iterator[List[str]]:
+    """
+    Группирует bulk-операции (action, документ или None для delete) в чанки.
+    Элемент чанка - готовый фрагмент NDJSON одной операции ("action\\ndoc" или "action").
+    Чанк закрывается по достижении chunk_docs операций или chunk_bytes байт.
+    """
+    chunk_entries = []
+    chunk_size = 0
+    for action, product_data in actions:
+        # Используем json.dumps с ensure_ascii=False и без лишних пробелов
+        entry = json.dumps(action, ensure_ascii=False, separators=(',', ':'))
+        if product_data is not None:
+            entry += '\n' + json.dumps(product_data, ensure_ascii=False, separators=(',', ':'))
+        chunk_entries.append(entry)
+        chunk_size += len(entry.encode('utf-8')) + 1
+        if len(chunk_entries) >= chunk_docs or chunk_size >= chunk_bytes:
+            yield chunk_entries
+            chunk_entries = []
+            chunk_size = 0
+    if chunk_entries:
+        yield chunk_entries
+
+
+def send_bulk_chunk(session: requests.Session, chunk_entries: List[str],
+                    max_retries: int = BULK_MAX_RETRIES) -> Tuple[int, int]:
+    """
+    Отправляет один чанк в _bulk. Повторяет весь чанк при 429/5xx и только
+    неудавшиеся операции при частичных ошибках 429 (es_rejected_execution).
+    Возвращает (число успешных, число окончательно неудавшихся) операций.
+    """
+    bulk_url = f"{OPENSEARCH_HOST}/_bulk"
+    pending = chunk_entries
+    succeeded = 0
+    failed = 0
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(BULK_RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)))
+        # bulk-тело обязано заканчиваться \n
+        bulk_body = '\n'.join(pending) + '\n'
+        try:
+            response = session.post(bulk_url, data=bulk_body.encode('utf-8'),
+                                    headers={"Content-Type": "application/x-ndjson"}, timeout=BULK_TIMEOUT_SECONDS)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Ошибка отправки bulk-чанка (попытка {attempt + 1}): {e}")
+            continue
+        if response.status_code == 429 or response.status_code >= 500:
+            logger.warning(f"OpenSearch вернул {response.status_code} на bulk-чанк (попытка {attempt + 1})")
+            continue
+        if response.status_code != 200:
+            logger.error(f"Ошибка при bulk-загрузке: {response.status_code} - {response.text[:500]}")
+            return succeeded, failed + len(pending)
+
+        result = response.json()
+        if not result.get('errors'):
+            return succeeded + len(pending), failed
+
+        # Частичная ошибка: повторяем только операции, отклонённые из-за перегрузки
+        retry_entries = []
+        for item_index, item in enumerate(result.get('items', [])):
+            operation, item_result = next(iter(item.items()))
+            status = item_result.get('status', 500)
+            if status < 300 or (operation == 'delete' and status == 404):
+                # delete уже отсутствующего документа - не ошибка
+                succeeded += 1
+            elif status == 429:
+                retry_entries.append(pending[item_index])
+            else:
+                failed += 1
+                logger.error(f"Операция не выполнена: {item}")
+        if not retry_entries:
+            return succeeded, failed
+        logger.warning(f"{len(retry_entries)} операций отклонены с 429, повторяем")
+        pending = retry_entries
+    logger.error(f"Не удалось выполнить {len(pending)} операций после {max_retries + 1} попыток")
+    return succeeded, failed + len(pending)
+
+
+def run_bulk(actions: Iterable[Tuple[Dict, Optional[Dict]]], workers: int = BULK_WORKERS,
+             chunk_docs: int = BULK_CHUNK_DOCS, chunk_bytes: int = BULK_CHUNK_BYTES,
+             debug_dump_path: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Отправляет поток bulk-операций чанками в workers параллельных потоков.
+    Одновременно в работе не больше workers * 2 чанков (backpressure),
+    поэтому память не зависит от размера каталога.
+    debug_dump_path - если задан, копия bulk-тела пишется в этот NDJSON-файл (для ручной отладки через curl).
+    Возвращает (число успешных, число неудавшихся) операций.
+    """
+    start_time = time.perf_counter()
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    in_flight_limit = threading.BoundedSemaphore(workers * 2)
+    totals = {"succeeded": 0, "failed": 0}
+    totals_lock = threading.Lock()
+
+    def send_and_release(chunk_entries: List[str]):
+        try:
+            succeeded, failed = send_bulk_chunk(session, chunk_entries)
+            with totals_lock:
+                totals["succeeded"] += succeeded
+                totals["failed"] += failed
+        finally:
+            in_flight_limit.release()
+
+    dump_file = None
+    try:
+        if debug_dump_path:
+            logger.info(f"DEBUG: bulk-тело дублируется в {debug_dump_path}")
+            dump_file = open(debug_dump_path, "wb")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for chunk_entries in iter_bulk_chunks(actions, chunk_docs, chunk_bytes):
+                if dump_file is not None:
+                    # Записываем тело как байты, чтобы точно сохранить \n
+                    dump_file.write(('\n'.join(chunk_entries) + '\n').encode('utf-8'))
+                in_flight_limit.acquire() # Ждём, пока освободится место (backpressure)
+                futures.append(executor.submit(send_and_release, chunk_entries))
+            for future in futures:
+                future.result()
+    finally:
+        if dump_file is not None:
+            dump_file.close()
+
+    elapsed = time.perf_counter() - start_time
+    docs_per_sec = totals["succeeded"] / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Bulk: выполнено {totals['succeeded']} операций за {elapsed:.2f} с "
+                f"({docs_per_sec:.0f} docs/sec), ошибок: {totals['failed']}.")
+    return totals["succeeded"], totals["failed"]
+
+
+def set_catalog_version(index_name: str) -> bool:
+    """
+    Записывает версию каталога (время загрузки) в _meta маппинга индекса. По ней обслуживающие процессы
+    (ElasticsearchSearchEngine.catalog_source) замечают перезагрузку или delta-обновление и сбрасывают кэши.
+    """
+    response = requests.put(f"{OPENSEARCH_HOST}/{index_name}/_mapping",
+                            json={"_meta": {"catalog_version": f"{time.time():.6f}"}})
+    if response.status_code != 200:
+        logger.error(f"Не удалось записать версию каталога в '{index_name}': {response.status_code} {response.text}")
+        return False
+    return True
+
+
+def get_alias_indices(alias: str = OPENSEARCH_INDEX_NAME) -> List[str]:
+    """Физические индексы, на которые сейчас указывает алиас (пусто, если алиаса нет)."""
+    response = requests.get(f"{OPENSEARCH_HOST}/_alias/{alias}")
+    if response.status_code != 200:
+        return []
+    return sorted(response.json().keys())
+
+
+def drop_unserved_index(index_name: str, alias: str = OPENSEARCH_INDEX_NAME):
+    """
+    Удаляет версию индекса неудавшейся загрузки, чтобы она не считалась предыдущей версией
+    при очистке (KEEP_PREVIOUS_INDICES). Индекс под алиасом не удаляется.
+    """
+    try:
+        if index_name in get_alias_indices(alias):
+            logger.warning(f"Индекс '{index_name}' уже под алиасом '{alias}' и не удаляется.")
+            return
+        requests.delete(f"{OPENSEARCH_HOST}/{index_name}")
+        logger.info(f"Удалён индекс неудавшейся загрузки '{index_name}'.")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Не удалось удалить индекс неудавшейся загрузки '{index_name}': {e}")
+
+
+def list_versioned_indices(alias: str = OPENSEARCH_INDEX_NAME) -> List[str]:
+    """Все версии индекса вида <alias>_v<timestamp>[_<суффикс>], от старых к новым."""
+    response = requests.get(f"{OPENSEARCH_HOST}/_cat/indices/{alias}_v*", params={"format": "json", "h": "index"})
+    if response.status_code != 200:
+        return []
+    return sorted(row["index"] for row in response.json())
+
+
+def warm_index(index_name: str):
+    """
+    Готовит свежепостроенный индекс к трафику до переключения алиаса:
+    возвращает refresh_interval, сливает сегменты и прогревает кэши частыми префиксами.
+    """
+    requests.put(f"{OPENSEARCH_HOST}/{index_name}/_settings", json={"index": {"refresh_interval": "1s"}})
+    requests.post(f"{OPENSEARCH_HOST}/{index_name}/_refresh")
+    requests.post(f"{OPENSEARCH_HOST}/{index_name}/_forcemerge", params={"max_num_segments": 1},
+                  timeout=BULK_TIMEOUT_SECONDS * 10)
+    for prefix in WARMUP_PREFIXES:
+        requests.post(f"{OPENSEARCH_HOST}/{index_name}/_search", json={
+            "query": {"multi_match": {"query": prefix, "fields": ["name.autocomplete", "brand.autocomplete",
+                                                                   "category.autocomplete"]}},
+            "size": 10,
+        })
+    logger.info(f"Индекс '{index_name}' прогрет.")
+
+
+def swap_alias(new_index: str, alias: str = OPENSEARCH_INDEX_NAME) -> bool:
+    """
+    Атомарно переключает алиас на new_index одним вызовом _aliases.
+    Если вместо алиаса существует старый физический индекс с тем же именем (до версионирования),
+    он удаляется в той же операции.
+    """
+    old_indices = get_alias_indices(alias)
+    actions = [{"remove": {"index": index, "alias": alias}} for index in old_indices if index != new_index]
+    if not old_indices and requests.head(f"{OPENSEARCH_HOST}/{alias}").status_code == 200:
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": new_index, "alias": alias}})
+    response = requests.post(f"{OPENSEARCH_HOST}/_aliases", json={"actions": actions})
+    if response.status_code != 200:
+        logger.error(f"Ошибка переключения алиаса: {response.status_code} - {response.text}")
+        return False
+    logger.info(f"Алиас '{alias}' переключён на '{new_index}' (было: {old_indices or '-'})")
+    return True
+
+
+def load_index_state(state_path: str = INDEX_STATE_PATH) -> Optional[Dict]:
+    """Читает состояние последней загрузки: индекс, его маппинг и {product_id: content_hash}."""
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_index_state(index_name: str, hashes: Dict[str, str], state_path: str = INDEX_STATE_PATH,
+                     routing: Optional[Dict[str, str]] = None, mapping_mode: str = DEFAULT_MAPPING_MODE):
+    """
+    Сохраняет состояние загрузки атомарно (через временный файл).
+    routing - {product_id: ключ routing} для индекса, разбитого по магазинам (нужен delta-режиму для delete).
+    mapping_mode и store_routing индекса сохраняются, чтобы полная перезагрузка из delta-режима
+    создала индекс с тем же маппингом.
+    """
+    state = {"index": index_name, "mapping": mapping_mode, "store_routing": routing is not None, "products": hashes}
+    if routing is not None:
+        state["routing"] = routing
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, state_path)
+
+
+def load_catalog_to_opensearch(xml_path: str, workers: int = BULK_WORKERS, chunk_docs: int = BULK_CHUNK_DOCS,
+                               chunk_bytes: int = BULK_CHUNK_BYTES, debug_dump_path: Optional[str] = None,
+                               state_path: str = INDEX_STATE_PATH, mapping_mode: str = DEFAULT_MAPPING_MODE,
+                               store_routing: bool = False):
+    """
+    Полная перезагрузка каталога без простоя поиска.
+    Создаёт новый физический индекс <alias>_v<timestamp>_<суффикс>, потоково загружает в него XML
+    (документы с _id = product_id, поэтому повторный запуск не плодит дубли),
+    прогревает его и атомарно переключает алиас catalog_products. Старые версии, кроме
+    KEEP_PREVIOUS_INDICES последних, удаляются. Состояние сохраняется для delta-режима.
+    При любой ошибке до переключения алиаса новый индекс удаляется.
+    store_routing=True - индекс из STORE_ROUTING_SHARDS шардов, документы маршрутизируются по магазину.
+    """
+    # Микросекунды и короткий случайный суффикс: две загрузки в одну секунду (повтор после быстрой ошибки)
+    # не должны столкнуться на PUT существующего индекса. Имена по-прежнему сортируются по времени.
+    new_index = f"{OPENSEARCH_INDEX_NAME}_v{datetime.now():%Y%m%d%H%M%S%f}_{uuid.uuid4().hex[:6]}"
+    logger.info(f"Загрузка каталога из {xml_path} в новый индекс '{new_index}' (workers={workers}, chunk_docs={chunk_docs})...")
+    hashes = {}
+    routing = {} if store_routing else None
+
+    def index_actions():
+        for product_data in iter_catalog_products(xml_path):
+            doc_id = product_id(product_data)
+            hashes[doc_id] = content_hash(product_data)
+            action = {"_index": new_index, "_id": doc_id}
+            if routing is not None:
+                action["routing"] = routing[doc_id] = store_routing_key(product_data)
+            yield {"index": action}, product_data
+
+    created = swapped = False
+    try:
+        if not create_index(new_index, mapping_mode, store_routing):
+            return False
+        created = True
+        # Во время загрузки refresh не нужен: индекс ещё не обслуживает поиск
+        requests.put(f"{OPENSEARCH_HOST}/{new_index}/_settings", json={"index": {"refresh_interval": "-1"}})
+
+        indexed, failed = run_bulk(index_actions(), workers, chunk_docs, chunk_bytes, debug_dump_path)
+        if failed:
+            logger.error(f"Загрузка в '{new_index}' завершилась с ошибками, алиас не переключён.")
+            return False
+        if indexed == 0:
+            logger.warning("Нет данных для загрузки (каталог пуст).")
+        logger.info(f"Загружено {indexed} товаров в '{new_index}'.")
+
+        set_catalog_version(new_index)
+        warm_index(new_index)
+        if not swap_alias(new_index):
+            return False
+        swapped = True
+        save_index_state(new_index, hashes, state_path, routing, mapping_mode)
+
+        # Удаляем устаревшие версии (текущая и KEEP_PREVIOUS_INDICES предыдущих остаются)
+        for old_index in list_versioned_indices()[:-(KEEP_PREVIOUS_INDICES + 1)]:
+            requests.delete(f"{OPENSEARCH_HOST}/{old_index}")
+            logger.info(f"Удалён устаревший индекс '{old_index}'.")
+
+        # Каталог поменялся - сбрасываем кэши результатов поиска в этом процессе
+        invalidate_all_caches()
+        return True
+
+    except ET.ParseError as e:
+        logger.error(f"Ошибка парсинга XML: {e}")
+        return False
+    except FileNotFoundError:
+        logger.error(f"Файл не найден: {xml_path}")
+        return False
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при загрузке каталога: {e}")
+        return False
+    finally:
+        if created and not swapped:
+            drop_unserved_index(new_index)
+
+
+def update_catalog_delta(xml_path: str, workers: int = BULK_WORKERS, chunk_docs: int = BULK_CHUNK_DOCS,
+                         chunk_bytes: int = BULK_CHUNK_BYTES, state_path: str = INDEX_STATE_PATH,
+                         mapping_mode: Optional[str] = None, store_routing: Optional[bool] = None):
+    """
+    Инкрементальное обновление: сравнивает XML с состоянием последней загрузки и отправляет
+    в текущий индекс алиаса только upsert изменившихся/новых товаров и delete исчезнувших.
+    Если состояния нет или алиас указывает на другой индекс, выполняется полная перезагрузка
+    с mapping_mode/store_routing; не заданные (None) берутся из состояния, а без него - по умолчанию.
+    Маппинг и разбиение по магазинам текущего индекса берутся из состояния.
+    """
+    state = load_index_state(state_path)
+    current_indices = get_alias_indices()
+    if state is None or current_indices != [state.get("index")]:
+        logger.warning("Состояние последней загрузки не найдено или устарело - выполняем полную перезагрузку.")
+        previous = state or {}
+        if mapping_mode is None:
+            mapping_mode = previous.get("mapping", DEFAULT_MAPPING_MODE)
+        if store_routing is None:
+            store_routing = previous.get("store_routing", "routing" in previous)
+        return load_catalog_to_opensearch(xml_path, workers, chunk_docs, chunk_bytes, state_path=state_path,
+                                          mapping_mode=mapping_mode, store_routing=store_routing)
+
+    target_index = state["index"]
+    old_hashes: Dict[str, str] = state["products"]
+    # Для индекса, разбитого по магазинам, каждой операции нужен routing товара
+    old_routing: Optional[Dict[str, str]] = state.get("routing")
+    new_routing = {} if old_routing is not None else None
+    new_hashes = {}
+    counts = {"upsert": 0, "delete": 0}
+
+    def delta_actions():
+        for product_data in iter_catalog_products(xml_path):
+            doc_id = product_id(product_data)
+            new_hashes[doc_id] = content_hash(product_data)
+            action = {"_index": target_index, "_id": doc_id}
+            if new_routing is not None:
+                action["routing"] = new_routing[doc_id] = store_routing_key(product_data)
+                previous_key = old_routing.get(doc_id)
+                if previous_key is not None and previous_key != action["routing"]:
+                    # Товар переехал в другой магазин: копия на старом шарде иначе осталась бы в выдаче
+                    yield {"delete": {"_index": target_index, "_id": doc_id, "routing": previous_key}}, None
+            if old_hashes.get(doc_id) != new_hashes[doc_id]:
+                counts["upsert"] += 1
+                yield {"index": action}, product_data
+        for doc_id in old_hashes.keys() - new_hashes.keys():
+            counts["delete"] += 1
+            action = {"_index": target_index, "_id": doc_id}
+            if old_routing is not None:
+                action["routing"] = old_routing.get(doc_id, NO_STORE_ROUTING_KEY)
+            yield {"delete": action}, None
+
+    try:
+        _, failed = run_bulk(delta_actions(), workers, chunk_docs, chunk_bytes)
+    except ET.ParseError as e:
+        logger.error(f"Ошибка парсинга XML: {e}")
+        return False
+    except FileNotFoundError:
+        logger.error(f"Файл не найден: {xml_path}")
+        return False
+    if failed:
+        # Состояние не сохраняем: следующий delta-запуск повторит неудавшиеся операции
+        logger.error(f"Delta-обновление '{target_index}' завершилось с ошибками ({failed}).")
+        return False
+
+    requests.post(f"{OPENSEARCH_HOST}/{target_index}/_refresh")
+    if counts["upsert"] or counts["delete"]:
+        set_catalog_version(target_index)
+    save_index_state(target_index, new_hashes, state_path, new_routing, state.get("mapping", DEFAULT_MAPPING_MODE))
+    logger.info(f"Delta-обновление '{target_index}': upsert {counts['upsert']}, delete {counts['delete']}, "
+                f"без изменений {len(new_hashes) - counts['upsert']}.")
+    if counts["upsert"] or counts["delete"]:
+        invalidate_all_caches()
+    return True
+
+
+def index_store_size(index_name: str) -> int:
+    """Размер первичных шардов индекса на диске, байт."""
+    response = requests.get(f"{OPENSEARCH_HOST}/{index_name}/_stats/store")
+    response.raise_for_status()
+    return response.json()["_all"]["primaries"]["store"]["size_in_bytes"]
+
+
+def register_search_templates(mapping_mode: str = DEFAULT_MAPPING_MODE) -> bool:
+    """
+    Сохраняет запрос автокомплита как stored search templates (_scripts/<id>) - fuzzy и точный вариант
+    для маппинга mapping_mode. Их использует ElasticsearchSearchEngine(use_template=True).
+    """
+    from search_engine import search_template_id, build_search_template_source
+
+    ok = True
+    for fuzzy in (True, False):
+        template_id = search_template_id(mapping_mode, fuzzy)
+        response = requests.put(f"{OPENSEARCH_HOST}/_scripts/{template_id}",
+                                json={"script": {"lang": "mustache",
+                                                 "source": build_search_template_source(mapping_mode, fuzzy)}})
+        if response.status_code in [200, 201]:
+            logger.info(f"Search template '{template_id}' сохранён.")
+        else:
+            logger.error(f"Ошибка сохранения search template '{template_id}': {response.text}")
+            ok = False
+    return ok
+
+
+def build_comparison_index(index_name: str, xml_path: str, mapping_mode: str, workers: int = BULK_WORKERS,
+                           edge_ngram_range: Optional[Tuple[int, int]] = None) -> Optional[Dict]:
+    """
+    Пересоздаёт отдельный индекс index_name (не под алиасом) и загружает в него каталог без refresh,
+    затем прогревает (forcemerge). Возвращает {"docs", "failed", "indexing_s"} или None, если индекс не создан.
+    """
+    requests.delete(f"{OPENSEARCH_HOST}/{index_name}")
+    if not create_index(index_name, mapping_mode, edge_ngram_range=edge_ngram_range):
+        return None
+    requests.put(f"{OPENSEARCH_HOST}/{index_name}/_settings", json={"index": {"refresh_interval": "-1"}})
+    start_time = time.perf_counter()
+    actions = (({"index": {"_index": index_name, "_id": product_id(product_data)}}, product_data)
+               for product_data in iter_catalog_products(xml_path))
+    indexed, failed = run_bulk(actions, workers)
+    indexing_s = time.perf_counter() - start_time
+    warm_index(index_name)
+    return {"docs": indexed, "failed": failed, "indexing_s": indexing_s}
+
+
+def compare_mappings(xml_path: str, queries_csv_path: str, modes=MAPPING_MODES, workers: int = BULK_WORKERS,
+                     output_path: str = "reports/mapping_comparison.json", keep_indices: bool = False) -> List[Dict]:
+    """
+    Сравнивает режимы маппинга на одном каталоге и наборе запросов: для каждого режима строит
+    отдельный индекс <alias>_cmp_<mode>, замеряет время индексации, размер на диске
+    (после forcemerge) и задержку запросов (closed-loop, один клиент, с прогревом).
+    Печатает таблицу и сохраняет её в output_path. Алиас боевого индекса не трогается.
+    """
+    from benchmark import load_queries, run_benchmark
+    from search_engine import ElasticsearchSearchEngine
+
+    queries = load_queries(queries_csv_path)
+    results = []
+    for mode in modes:
+        index_name = f"{OPENSEARCH_INDEX_NAME}_cmp_{mode}"
+        build = build_comparison_index(index_name, xml_path, mode, workers)
+        if build is None:
+            continue
+
+        engine = ElasticsearchSearchEngine(index_name=index_name, mapping_mode=mode, log_sample_rate=0.0)
+        latency = run_benchmark(engine, queries, mode="closed", concurrency=1)
+        results.append({
+            "mapping": mode,
+            "docs": build["docs"],
+            "failed": build["failed"],
+            "indexing_s": build["indexing_s"],
+            "size_bytes": index_store_size(index_name),
+            "p50_ms": latency["p50_ms"],
+            "p99_ms": latency["p99_ms"],
+            "zero_result_rate": engine.metrics.snapshot()["zero_result_rate"],
+        })
+        if not keep_indices:
+            requests.delete(f"{OPENSEARCH_HOST}/{index_name}")
+
+    print(f"{'mapping':<20} {'размер, МБ':>11} {'индексация, с':>14} {'p50, мс':>9} {'p99, мс':>9} {'пустых, %':>10}")
+    for row in results:
+        print(f"{row['mapping']:<20} {row['size_bytes'] / 2**20:>11.2f} {row['indexing_s']:>14.2f} "
+              f"{row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['zero_result_rate'] * 100:>10.1f}")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    logger.info(f"Сравнение маппингов сохранено в {output_path}")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Создание индекса и загрузка каталога в OpenSearch")
+    parser.add_argument("--catalog", default="data/catalog_products.xml", help="XML каталога")
+    parser.add_argument("--delta", action="store_true",
+                        help="Обновить только изменившиеся товары вместо полной перезагрузки")
+    parser.add_argument("--mapping", choices=MAPPING_MODES, default=None,
+                        help=f"Маппинг подполей autocomplete для нового индекса (по умолчанию {DEFAULT_MAPPING_MODE}, "
+                             f"с --delta - как у последней загрузки)")
+    parser.add_argument("--store-routing", action="store_true", default=None,
+                        help=f"Разбить индекс по магазинам: {STORE_ROUTING_SHARDS} шардов, routing по полю store "
+                             f"(с --delta - как у последней загрузки)")
+    parser.add_argument("--compare-mappings", action="store_true",
+                        help="Сравнить все маппинги по размеру индекса, времени индексации и задержке запросов")
+    parser.add_argument("--queries", default="data/prefix_queries.csv", help="Запросы для --compare-mappings")
+    parser.add_argument("--build-prefix-table", metavar="PATH", default=None,
+                        help="После загрузки построить таблицу топ-K коротких префиксов (например, data/short_prefix_table.bin)")
+    parser.add_argument("--layout-fix", action="store_true",
+                        help="Строить таблицу с исправлением раскладки, как search_engine.py --layout-fix")
+    parser.add_argument("--typo-fix", action="store_true",
+                        help="Строить таблицу с исправлением опечаток на клиенте, как search_engine.py --typo-fix")
+    parser.add_argument("--fuzzy-fallback", action="store_true",
+                        help="Строить таблицу с --fuzzy-fallback, как search_engine.py --fuzzy-fallback")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="Число параллельных bulk-запросов")
+    parser.add_argument("--chunk-docs", type=int, default=BULK_CHUNK_DOCS, help="Документов в одном bulk-запросе")
+    parser.add_argument("--chunk-bytes", type=int, default=BULK_CHUNK_BYTES, help="Максимальный размер bulk-запроса в байтах")
+    parser.add_argument("--dump-bulk", metavar="PATH", default=None,
+                        help="Сохранить bulk-тело в NDJSON-файл для отладки (например, bulk_request.ndjson)")
+    args = parser.parse_args()
+
+    if not wait_for_opensearch():
+        exit(1)
+
+    if args.compare_mappings:
+        compare_mappings(args.catalog, args.queries, workers=args.workers)
+        exit(0)
+
+    if args.delta:
+        ok = update_catalog_delta(args.catalog, workers=args.workers, chunk_docs=args.chunk_docs,
+                                  chunk_bytes=args.chunk_bytes, mapping_mode=args.mapping,
+                                  store_routing=args.store_routing)
+    else:
+        ok = load_catalog_to_opensearch(args.catalog, workers=args.workers, chunk_docs=args.chunk_docs,
+                                        chunk_bytes=args.chunk_bytes, debug_dump_path=args.dump_bulk,
+                                        mapping_mode=args.mapping or DEFAULT_MAPPING_MODE,
+                                        store_routing=bool(args.store_routing))
+    if not ok:
+        exit(1)
+    # Маппинг фактически загруженного индекса (в delta-режиме - из состояния)
+    mapping_mode = (load_index_state() or {}).get("mapping", args.mapping or DEFAULT_MAPPING_MODE)
+    register_search_templates(mapping_mode)
+
+    if args.build_prefix_table:
+        from search_engine import ElasticsearchSearchEngine
+        from short_prefix_table import build_short_prefix_table
+        # Таблица отвечает вместо search(), поэтому строится тем же конвейером запроса, что и обслуживающий движок
+        layout_rewriter = None
+        typo_corrector = None
+        if args.layout_fix or args.typo_fix:
+            from layout_corrections import CatalogVocabulary, LayoutRewriter
+            vocabulary = CatalogVocabulary.from_xml(args.catalog)
+            if args.layout_fix:
+                layout_rewriter = LayoutRewriter(vocabulary)
+            if args.typo_fix:
+                from typo_corrections import SymSpellPrefixCorrector
+                typo_corrector = SymSpellPrefixCorrector(vocabulary)
+        build_short_prefix_table(ElasticsearchSearchEngine(mapping_mode=mapping_mode, layout_rewriter=layout_rewriter,
+                                                           typo_corrector=typo_corrector,
+                                                           fuzzy_fallback=args.fuzzy_fallback),
+                                 args.catalog, args.build_prefix_table)
+
+    logger.info("Настройка OpenSearch v2 завершена.")
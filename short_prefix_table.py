@@ -0,0 +1,205 @@
+# short_prefix_table.py - предвычисленный топ-K для коротких префиксов в memory-mapped файле
+
+from typing import List, Dict, Optional, Iterable
+import json
+import logging
+import mmap
+import struct
+import time
+
+from local_search_engine import tokenize, INDEXED_FIELDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TABLE_PATH = "data/short_prefix_table.bin"
+DEFAULT_MAX_PREFIX_LENGTH = 3
+DEFAULT_TABLE_TOP_K = 10
+MSEARCH_BATCH_SIZE = 100
+
+# Формат файла (все числа little-endian):
+#   заголовок  : magic, версия, max_prefix_length, top_k, число префиксов, число товаров, длина result_ids,
+#                длина source, длина pipeline
+#   source     : UTF-8 версия каталога, из которой построена таблица (ElasticsearchSearchEngine.catalog_source)
+#   pipeline   : UTF-8 конвейер запроса, которым она построена (ElasticsearchSearchEngine.query_pipeline)
+#   префиксы   : [offset ключа в пуле, длина ключа, число результатов, индекс первого результата], по ключу
+#   result_ids : uint32 номера товаров для всех префиксов подряд
+#   товары     : [offset JSON товара в пуле, длина]
+#   пул строк  : UTF-8 ключи и JSON товаров (каждый товар хранится один раз)
+_MAGIC = b"SPT1"
+_VERSION = 3
+_HEADER = struct.Struct("<4sHHIIIIHH")
+_ENTRY = struct.Struct("<IHHI")
+_PRODUCT = struct.Struct("<II")
+_RESULT_ID = struct.Struct("<I")
+
+
+def iter_short_prefixes(products: Iterable[Dict[str, str]], max_prefix_length: int) -> Iterable[str]:
+    """Все префиксы длиной до max_prefix_length токенов name/brand/category (без повторов)."""
+    seen = set()
+    for product in products:
+        for field in INDEXED_FIELDS:
+            for token in tokenize(product.get(field)):
+                for length in range(1, min(len(token), max_prefix_length) + 1):
+                    prefix = token[:length]
+                    if prefix not in seen:
+                        seen.add(prefix)
+                        yield prefix
+
+
+def write_short_prefix_table(output_path: str, results_by_prefix: Dict[str, List[Dict[str, str]]],
+                             max_prefix_length: int, top_k: int, source: str, pipeline: str = ""):
+    """
+    Сериализует {префикс: товары}, построенные по версии каталога source конвейером запроса pipeline,
+    в файл формата SPT1.
+    """
+    pool = bytearray()
+    product_index: Dict[str, int] = {}
+    product_refs = []
+    result_ids = []
+    entries = []
+    for prefix in sorted(results_by_prefix, key=lambda key: key.encode('utf-8')):
+        key_bytes = prefix.encode('utf-8')
+        key_offset = len(pool)
+        pool += key_bytes
+        first_result = len(result_ids)
+        for product in results_by_prefix[prefix][:top_k]:
+            product_json = json.dumps(product, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+            if product_json not in product_index:
+                product_bytes = product_json.encode('utf-8')
+                product_index[product_json] = len(product_refs)
+                product_refs.append((len(pool), len(product_bytes)))
+                pool += product_bytes
+            result_ids.append(product_index[product_json])
+        entries.append((key_offset, len(key_bytes), len(result_ids) - first_result, first_result))
+
+    source_bytes = source.encode('utf-8')
+    pipeline_bytes = pipeline.encode('utf-8')
+    with open(output_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, max_prefix_length, top_k, len(entries), len(product_refs),
+                             len(result_ids), len(source_bytes), len(pipeline_bytes)))
+        f.write(source_bytes)
+        f.write(pipeline_bytes)
+        for entry in entries:
+            f.write(_ENTRY.pack(*entry))
+        for result_id in result_ids:
+            f.write(_RESULT_ID.pack(result_id))
+        for product_ref in product_refs:
+            f.write(_PRODUCT.pack(*product_ref))
+        f.write(pool)
+    logger.info(f"Таблица коротких префиксов: {len(entries)} префиксов, {len(product_refs)} товаров, "
+                f"{_HEADER.size + len(source_bytes) + len(pipeline_bytes) + len(entries) * _ENTRY.size + len(result_ids) * 4 + len(product_refs) * 8 + len(pool)} байт "
+                f"-> {output_path}")
+
+
+def build_short_prefix_table(search_engine, xml_path: str, output_path: str = DEFAULT_TABLE_PATH,
+                             max_prefix_length: int = DEFAULT_MAX_PREFIX_LENGTH, top_k: int = DEFAULT_TABLE_TOP_K):
+    """
+    Офлайн-сборка таблицы после load_catalog_to_opensearch: перечисляет короткие префиксы каталога,
+    применяет к ним ту же корректировку, что и search(), и запрашивает топ-K пачками через msearch.
+    Ключ таблицы - скорректированный префикс (как ключ кэша результатов).
+    Префиксы, на которые msearch ответил ошибкой (degraded), в таблицу не пишутся: иначе пустой ответ
+    навсегда считался бы «ничего не найдено», а так они идут в OpenSearch. Если ошибками ответили
+    все префиксы, таблица не записывается. В заголовок пишется версия каталога (catalog_source), чтобы
+    search() не отвечал из таблицы после перезагрузки каталога, и конвейер запроса (query_pipeline):
+    движок с другими корректорами или маппингом таблицу не примет. Возвращает True, если таблица записана.
+    """
+    from setup_elasticsearch import iter_catalog_products
+
+    start_time = time.perf_counter()
+    source = search_engine.catalog_source()
+    if source is None:
+        logger.error("Таблица коротких префиксов не построена: не удалось получить версию каталога")
+        return False
+    prefix_by_key: Dict[str, str] = {}
+    for prefix in iter_short_prefixes(iter_catalog_products(xml_path), max_prefix_length):
+        corrected_prefix, _ = search_engine.correct(prefix)
+        if len(corrected_prefix) <= max_prefix_length:
+            prefix_by_key.setdefault(corrected_prefix, prefix)
+
+    keys = list(prefix_by_key)
+    results_by_prefix = {}
+    failed = 0
+    for start in range(0, len(keys), MSEARCH_BATCH_SIZE):
+        batch_keys = keys[start:start + MSEARCH_BATCH_SIZE]
+        batch_results = search_engine.msearch([prefix_by_key[key] for key in batch_keys], top_k=top_k)
+        for key, products in zip(batch_keys, batch_results):
+            if getattr(products, "degraded", False):
+                failed += 1
+            else:
+                results_by_prefix[key] = products
+
+    if failed:
+        logger.warning(f"Таблица коротких префиксов: {failed} из {len(keys)} префиксов не получены (ошибки OpenSearch) "
+                       f"и будут запрашиваться в OpenSearch")
+    if keys and not results_by_prefix:
+        logger.error("Таблица коротких префиксов не построена: OpenSearch не ответил ни на один префикс")
+        return False
+    write_short_prefix_table(output_path, results_by_prefix, max_prefix_length, top_k, source,
+                             search_engine.query_pipeline())
+    logger.info(f"Таблица коротких префиксов построена за {time.perf_counter() - start_time:.2f} с")
+    return True
+
+
+class ShortPrefixTable:
+    """
+    Чтение таблицы SPT1 через mmap: при открытии читается только заголовок,
+    поиск - бинарный поиск по отсортированным ключам, декодируются только найденные товары.
+    source - версия каталога, из которой построена таблица; pipeline - конвейер запроса, которым она построена.
+    """
+
+    def __init__(self, path: str = DEFAULT_TABLE_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from("<4sH", self._mmap, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path}: не файл таблицы коротких префиксов")
+        if version != _VERSION:
+            raise ValueError(f"{path}: версия формата {version} вместо {_VERSION}, пересоберите таблицу")
+        (_, _, self.max_prefix_length, self.top_k, self._entry_count, product_count, result_count,
+         source_length, pipeline_length) = _HEADER.unpack_from(self._mmap, 0)
+        self.source = self._mmap[_HEADER.size:_HEADER.size + source_length].decode('utf-8')
+        pipeline_offset = _HEADER.size + source_length
+        self.pipeline = self._mmap[pipeline_offset:pipeline_offset + pipeline_length].decode('utf-8')
+        self._entries_offset = pipeline_offset + pipeline_length
+        self._results_offset = self._entries_offset + self._entry_count * _ENTRY.size
+        self._products_offset = self._results_offset + result_count * _RESULT_ID.size
+        self._pool_offset = self._products_offset + product_count * _PRODUCT.size
+
+    def __len__(self) -> int:
+        return self._entry_count
+
+    def _key(self, index: int) -> bytes:
+        key_offset, key_length, _, _ = _ENTRY.unpack_from(self._mmap, self._entries_offset + index * _ENTRY.size)
+        start = self._pool_offset + key_offset
+        return self._mmap[start:start + key_length]
+
+    def lookup(self, corrected_prefix: str, top_k: int) -> Optional[List[Dict[str, str]]]:
+        """
+        Топ-K товаров для префикса или None, если таблица на него ответить не может
+        (префикс длиннее max_prefix_length, top_k больше сохранённого или префикса нет в таблице).
+        """
+        if len(corrected_prefix) > self.max_prefix_length or top_k > self.top_k:
+            return None
+        key = corrected_prefix.encode('utf-8')
+        low, high = 0, self._entry_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._entry_count or self._key(low) != key:
+            return None
+
+        _, _, result_count, first_result = _ENTRY.unpack_from(self._mmap, self._entries_offset + low * _ENTRY.size)
+        products = []
+        for position in range(first_result, first_result + min(result_count, top_k)):
+            (product_id,) = _RESULT_ID.unpack_from(self._mmap, self._results_offset + position * _RESULT_ID.size)
+            offset, length = _PRODUCT.unpack_from(self._mmap, self._products_offset + product_id * _PRODUCT.size)
+            start = self._pool_offset + offset
+            products.append(json.loads(self._mmap[start:start + length].decode('utf-8')))
+        return products
+
+    def close(self):
+        self._mmap.close()
@@ -0,0 +1,132 @@
+# typo_corrections.py - SymSpell-подобное исправление опечаток в префиксах на стороне клиента
+
+from itertools import combinations
+from typing import Dict, List, Set, Tuple, Optional
+import logging
+import time
+
+from layout_corrections import CatalogVocabulary
+from local_search_engine import tokenize
+
+logger = logging.getLogger(__name__)
+
+MAX_EDIT_DISTANCE = 2
+# Префиксы длиннее этого в индекс удалений не попадают (как prefix_length в SymSpell): у более длинного
+# токена исправляется начало этой длины, а хвост сохраняется, если слово с ним есть в словаре
+MAX_INDEXED_PREFIX_LENGTH = 10
+
+
+def auto_distance(token: str) -> int:
+    """Допустимое число правок по длине токена - как fuzziness AUTO в OpenSearch."""
+    if len(token) <= 2:
+        return 0
+    if len(token) <= 5:
+        return 1
+    return 2
+
+
+def _deletes(word: str, max_distance: int) -> Set[str]:
+    """Все строки, получаемые удалением до max_distance символов (включая саму строку)."""
+    result = {word}
+    for distance in range(1, min(max_distance, len(word) - 1) + 1):
+        for positions in combinations(range(len(word)), distance):
+            result.add(''.join(char for index, char in enumerate(word) if index not in positions))
+    return result
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Расстояние Дамерау-Левенштейна (OSA) с отсечкой: больше max_distance -> max_distance + 1."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+class SymSpellPrefixCorrector:
+    """
+    Индекс симметричных удалений над префиксами токенов каталога.
+    Для набранного префикса, которого нет в словаре, генерирует его удаления, находит
+    префиксы каталога с общими удалениями и выбирает ближайший (при равенстве - не короче
+    набранного, затем самый частый).
+    Первый символ должен совпадать (аналог prefix_length: 1 в запросе OpenSearch).
+    """
+
+    def __init__(self, vocabulary: CatalogVocabulary, max_distance: int = MAX_EDIT_DISTANCE):
+        start_time = time.perf_counter()
+        self.vocabulary = vocabulary
+        self.max_distance = max_distance
+        self._deletes_index: Dict[str, List[str]] = {}
+        for prefix in vocabulary.prefix_counts:
+            if len(prefix) > MAX_INDEXED_PREFIX_LENGTH or len(prefix) < 3:
+                continue
+            for deleted in _deletes(prefix, max_distance):
+                self._deletes_index.setdefault(deleted, []).append(prefix)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        logger.info(f"SymSpellPrefixCorrector: {len(self._deletes_index)} ключей удалений за {elapsed_ms:.1f} мс")
+
+    def correct_token(self, token: str) -> Optional[str]:
+        """
+        Ближайший префикс каталога для токена; сам токен, если он уже есть в словаре;
+        None, если кандидата в пределах auto_distance нет.
+        Токен длиннее MAX_INDEXED_PREFIX_LENGTH исправляется по началу этой длины: если исправленное
+        начало с исходным хвостом есть в словаре - возвращается слово целиком, иначе только
+        исправленное начало (префиксный запрос по нему находит то же слово).
+        """
+        if token.isdigit() or self.vocabulary.count(token):
+            return token
+        max_distance = min(auto_distance(token), self.max_distance)
+        if max_distance == 0:
+            return None
+        if len(token) <= MAX_INDEXED_PREFIX_LENGTH:
+            return self._closest_indexed(token, max_distance)
+        head, tail = token[:MAX_INDEXED_PREFIX_LENGTH], token[MAX_INDEXED_PREFIX_LENGTH:]
+        corrected_head = head if self.vocabulary.count(head) else self._closest_indexed(head, max_distance)
+        if corrected_head is None:
+            return None
+        if self.vocabulary.count(corrected_head + tail):
+            return corrected_head + tail
+        return corrected_head
+
+    def _closest_indexed(self, token: str, max_distance: int) -> Optional[str]:
+        """Ближайший префикс каталога из индекса удалений (длиной до MAX_INDEXED_PREFIX_LENGTH) или None."""
+        best: Optional[Tuple[int, bool, int, str]] = None
+        seen = set()
+        for deleted in _deletes(token, max_distance):
+            for candidate in self._deletes_index.get(deleted, ()):
+                if candidate in seen or candidate[0] != token[0]:
+                    continue
+                seen.add(candidate)
+                distance = edit_distance(token, candidate, max_distance)
+                if distance > max_distance:
+                    continue
+                # При равном расстоянии предпочитаем не более короткий префикс, затем более частый
+                key = (distance, len(candidate) < len(token), -self.vocabulary.count(candidate), candidate)
+                if best is None or key < best:
+                    best = key
+        return best[-1] if best else None
+
+    def correct(self, query: str) -> Tuple[str, bool]:
+        """
+        Исправляет каждый токен запроса.
+        Возвращает (исправленный запрос, все ли токены удалось сопоставить со словарём).
+        Неразрешённые токены остаются как есть.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return query, True
+        corrected = [self.correct_token(token) for token in tokens]
+        resolved = all(token is not None for token in corrected)
+        if all(new == token for new, token in zip(corrected, tokens)):
+            return query, resolved
+        return ' '.join(new or token for new, token in zip(corrected, tokens)), resolved